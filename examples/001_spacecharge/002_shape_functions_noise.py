@@ -0,0 +1,67 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+# Noise of the space-charge field versus number of macroparticles for the
+# cloud-in-cell (cic) and triangular-shaped-cloud (tsc) shape functions.
+# The noise is the spread of the horizontal field over independent
+# realizations of the bunch, averaged over the nodes in the beam core and
+# normalized to the peak field.
+
+import time
+
+import numpy as np
+
+import xobjects as xo
+import xpart as xp
+import xfields as xf
+
+context = xo.ContextCpu()
+
+sigma_x = 3e-3
+sigma_y = 2e-3
+sigma_z = 30e-2
+n_realizations = 5
+n_macroparticles_list = [int(1e4), int(3e4), int(1e5), int(3e5), int(1e6)]
+
+grid = dict(x_range=(-5*sigma_x, 5*sigma_x), y_range=(-5*sigma_y, 5*sigma_y),
+            z_range=(-4*sigma_z, 4*sigma_z), nx=64, ny=64, nz=32)
+
+fieldmaps = {}
+for shape_function in ['cic', 'tsc']:
+    fieldmaps[shape_function] = xf.TriLinearInterpolatedFieldMap(
+            _context=context, solver='FFTSolver2p5D',
+            shape_function=shape_function, **grid)
+
+fmap = fieldmaps['cic']
+xg, yg, zg = np.meshgrid(fmap.x_grid, fmap.y_grid, fmap.z_grid, indexing='ij')
+mask_core = ((xg/sigma_x)**2 + (yg/sigma_y)**2 + (zg/sigma_z)**2) < 4
+
+rng = np.random.default_rng(0)
+print(f'{"n_macroparticles":>16} {"noise cic":>10} {"noise tsc":>10}'
+      f' {"t_dep cic [s]":>14} {"t_dep tsc [s]":>14}')
+for n_macroparticles in n_macroparticles_list:
+    fields = {kk: [] for kk in fieldmaps}
+    t_dep = {kk: 0. for kk in fieldmaps}
+    for _ in range(n_realizations):
+        particles = xp.Particles(_context=context, p0c=25.92e9,
+                x=sigma_x * rng.standard_normal(n_macroparticles),
+                y=sigma_y * rng.standard_normal(n_macroparticles),
+                zeta=sigma_z * rng.standard_normal(n_macroparticles),
+                weight=2.5e11/n_macroparticles)
+        for kk, fmap in fieldmaps.items():
+            t0 = time.perf_counter()
+            fmap.update_from_particles(particles=particles, update_phi=False)
+            t_dep[kk] += time.perf_counter() - t0
+            fmap.update_phi_from_rho()
+            fields[kk].append(context.nparray_from_context_array(
+                                                        fmap.dphi_dx).copy())
+    noise = {}
+    for kk, ff in fields.items():
+        ff = np.array(ff)
+        noise[kk] = (np.mean(np.std(ff, axis=0)[mask_core])
+                     / np.max(np.abs(np.mean(ff, axis=0))))
+    print(f'{n_macroparticles:16d} {noise["cic"]:10.4f} {noise["tsc"]:10.4f}'
+          f' {t_dep["cic"]/n_realizations:14.4f}'
+          f' {t_dep["tsc"]/n_realizations:14.4f}')
@@ -0,0 +1,65 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+# Time of the kick of an ElectronCloud with the per-particle evaluation of
+# the tricubic interpolation and with the cell-grouped evaluation
+# (cell_grouped=True), for different numbers of particles per occupied cell
+# of the field map.
+
+import time
+
+import numpy as np
+
+import xobjects as xo
+import xpart as xp
+import xfields as xf
+
+context = xo.ContextCpu()
+n_repetitions = 5
+
+
+def time_track(element, x, y, zeta):
+    t_min = np.inf
+    for _ in range(n_repetitions):
+        part = xp.Particles(_context=context, x=x, y=y, zeta=zeta, p0c=450e9)
+        t0 = time.perf_counter()
+        element.track(part)
+        t_min = min(t_min, time.perf_counter() - t0)
+    return part, t_min
+
+
+rng = np.random.default_rng(0)
+
+nn = 51
+grid = np.linspace(-0.5, 0.5, nn)
+n_cells = (nn - 1)**3
+phi_taylor = rng.standard_normal(8 * nn**3)
+
+print('ElectronCloud, 51x51x51 grid')
+print(f'{"n_part":>9s} {"occup.":>8s} {"per-particle [s]":>17s} '
+      f'{"grouped [s]":>12s} {"speedup":>8s}')
+for n_part, half_width in [(12500, 0.5), (125000, 0.5), (1250000, 0.5),
+                           (1000000, 0.1)]:
+    x = (2 * rng.random(n_part) - 1) * half_width
+    y = (2 * rng.random(n_part) - 1) * half_width
+    zeta = (2 * rng.random(n_part) - 1) * half_width
+
+    results = {}
+    for cell_grouped in [False, True]:
+        fieldmap = xf.TriCubicInterpolatedFieldMap(_context=context,
+                x_grid=grid, y_grid=grid, z_grid=grid,
+                max_grouped_cells=(n_cells if cell_grouped else 0))
+        fieldmap._phi_taylor[:] = phi_taylor
+        ecloud = xf.ElectronCloud(length=1, fieldmap=fieldmap,
+                                  _buffer=fieldmap._buffer,
+                                  cell_grouped=cell_grouped)
+        results[cell_grouped] = time_track(ecloud, x, y, zeta)
+
+    assert np.all(results[True][0].px == results[False][0].px)
+    n_occupied = ecloud._cell_grouping.n_occupied_cells
+    t_ref = results[False][1]
+    t_grouped = results[True][1]
+    print(f'{n_part:9d} {n_part / n_occupied:8.1f} {t_ref:17.4f} '
+          f'{t_grouped:12.4f} {t_ref / t_grouped:8.2f}')
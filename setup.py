@@ -51,5 +51,6 @@ setup(
         },
     extras_require={
             'tests': ['pytest'],
+            'fftw': ['pyfftw'],
         },
     )
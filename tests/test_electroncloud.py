@@ -102,3 +102,298 @@ def test_tricubic_interpolation():
         assert np.allclose(part.px[mask_p], true_px, atol=1.e-13, rtol=1.e-13)
         assert np.allclose(part.py[mask_p], true_py, atol=1.e-13, rtol=1.e-13)
         assert np.allclose(part.ptau[mask_p], true_ptau, atol=1.e-13, rtol=1.e-13)
+
+
+def test_tricubic_coefficient_cache():
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        NN = 11
+        grid = np.linspace(-0.5, 0.5, NN)
+        rng = default_rng(123)
+        phi_taylor = rng.standard_normal(8 * NN**3)
+
+        n_parts = 10000
+        x_test = rng.random(n_parts) * 1.2 - 0.6
+        y_test = rng.random(n_parts) * 1.2 - 0.6
+        zeta_test = rng.random(n_parts) * 1.2 - 0.6
+
+        kicks = {}
+        for cache_range in ['none', None, ((-0.25, 0.25), (-0.15, 0.35), None)]:
+            fieldmap = xf.TriCubicInterpolatedFieldMap(_context=context,
+                    x_grid=grid, y_grid=grid, z_grid=grid,
+                    cache_coefficients=(cache_range != 'none'),
+                    coefficient_cache_range=(None if cache_range == 'none'
+                                             else cache_range))
+            fieldmap._phi_taylor[:] = context.nparray_to_context_array(
+                                                                phi_taylor)
+            fieldmap.update_coefficient_cache()
+            ecloud = xf.ElectronCloud(length=1, fieldmap=fieldmap,
+                                      _buffer=fieldmap._buffer)
+            part = xp.Particles(_context=context, x=x_test, y=y_test,
+                                zeta=zeta_test, p0c=450e9)
+            ecloud.track(part)
+            part.move(_context=xo.ContextCpu())
+            kicks[repr(cache_range)] = (part.px, part.py, part.ptau,
+                                        part.state)
+
+        assert fieldmap.cache_coefficients
+        assert fieldmap._cache_nx == 6 and fieldmap._cache_ny == 6
+        assert fieldmap._cache_nz == NN - 1
+
+        for key in kicks:
+            for vv, vv_ref in zip(kicks[key], kicks["'none'"]):
+                assert np.all(vv == vv_ref)
+
+
+def test_cell_grouped_tracking():
+    for context in xo.context.get_test_contexts():
+        if isinstance(context, xo.ContextPyopencl):
+            continue
+        print(f"Test {context.__class__}")
+
+        NN = 11
+        grid = np.linspace(-0.5, 0.5, NN)
+        rng = default_rng(456)
+        phi_taylor = rng.standard_normal(8 * NN**3)
+
+        n_parts = 10000
+        x_test = rng.random(n_parts) * 1.2 - 0.6
+        y_test = rng.random(n_parts) * 1.2 - 0.6
+        zeta_test = rng.random(n_parts) * 1.2 - 0.6
+
+        kicks = {}
+        # Per-particle evaluation, store for all the cells, store for only
+        # part of the occupied cells
+        for max_grouped_cells in [0, (NN - 1)**3, 50]:
+            fieldmap = xf.TriCubicInterpolatedFieldMap(_context=context,
+                    x_grid=grid, y_grid=grid, z_grid=grid, mirror_x=1,
+                    max_grouped_cells=max_grouped_cells)
+            fieldmap._phi_taylor[:] = context.nparray_to_context_array(
+                                                                phi_taylor)
+            ecloud = xf.ElectronCloud(length=1, fieldmap=fieldmap,
+                                      _buffer=fieldmap._buffer,
+                                      x_shift=0.02, tau_shift=-0.01,
+                                      cell_grouped=(max_grouped_cells > 0))
+            part = xp.Particles(_context=context, x=x_test, y=y_test,
+                                zeta=zeta_test, p0c=450e9)
+            ecloud.track(part)
+            part.move(_context=xo.ContextCpu())
+            kicks[max_grouped_cells] = (part.px, part.py, part.ptau,
+                                        part.state)
+
+            if max_grouped_cells > 0:
+                grouping = ecloud._cell_grouping
+                assert grouping.n_updates == 1
+                # The cell table is cleared after the track
+                cell_slot = context.nparray_from_context_array(
+                                                        fieldmap._cell_slot)
+                assert np.all(cell_slot == -1)
+
+                # The tracking reads the stored coefficients: with the store
+                # zeroed after the update the particles in the stored cells
+                # are not kicked
+                part_zeroed = xp.Particles(_context=context, x=x_test,
+                                    y=y_test, zeta=zeta_test, p0c=450e9)
+                grouping.update(part_zeroed, n_particles=n_parts,
+                                x_shift=ecloud.x_shift, y_shift=ecloud.y_shift,
+                                tau_shift=ecloud.tau_shift)
+                n_stored = min(grouping.n_occupied_cells, max_grouped_cells)
+                assert len(grouping.slot_cells) == n_stored
+                cell_slot = context.nparray_from_context_array(
+                                                        fieldmap._cell_slot)
+                assert np.sum(cell_slot >= 0) == n_stored
+                fieldmap._slot_coefs[:] = 0.
+                super(xf.ElectronCloud, ecloud).track(part_zeroed)
+                grouping.reset()
+                part_zeroed.move(_context=xo.ContextCpu())
+                alive = part_zeroed.state > 0
+                n_not_kicked = np.sum(part_zeroed.px[alive] == 0)
+                if n_stored == grouping.n_occupied_cells:
+                    assert n_not_kicked == np.sum(alive)
+                else:
+                    assert 0 < n_not_kicked < np.sum(alive)
+
+        assert ecloud._cell_grouping.n_occupied_cells > 50
+
+        for key in kicks:
+            for vv, vv_ref in zip(kicks[key], kicks[0]):
+                assert np.all(vv == vv_ref)
+
+
+def test_cell_grouped_shared_fieldmap():
+    for context in xo.context.get_test_contexts():
+        if isinstance(context, xo.ContextPyopencl):
+            continue
+        print(f"Test {context.__class__}")
+
+        NN = 11
+        grid = np.linspace(-0.5, 0.5, NN)
+        rng = default_rng(457)
+        phi_taylor = context.nparray_to_context_array(
+                                    rng.standard_normal(8 * NN**3))
+
+        fieldmap_ref = xf.TriCubicInterpolatedFieldMap(_context=context,
+                x_grid=grid, y_grid=grid, z_grid=grid)
+        fieldmap_ref._phi_taylor[:] = phi_taylor
+        fieldmap = xf.TriCubicInterpolatedFieldMap(_context=context,
+                x_grid=grid, y_grid=grid, z_grid=grid,
+                max_grouped_cells=(NN - 1)**3)
+        fieldmap._phi_taylor[:] = phi_taylor
+
+        # Two grouped elements sharing the map, tracking particles in
+        # different octants, then a plain element and a direct evaluation
+        n_parts = 2000
+        octants = [(rng.random((3, n_parts)) * 0.45 + 0.02) * sign
+                   for sign in [1, -1]]
+        ecloud_1, ecloud_2 = [xf.ElectronCloud(length=1, fieldmap=fieldmap,
+                                               _buffer=fieldmap._buffer,
+                                               cell_grouped=True)
+                              for _ in range(2)]
+        for ecloud, (x, y, zeta) in zip([ecloud_1, ecloud_2], octants):
+            part = xp.Particles(_context=context, x=x, y=y, zeta=zeta,
+                                p0c=450e9)
+            ecloud.track(part)
+        assert np.all(context.nparray_from_context_array(
+                                                fieldmap._cell_slot) == -1)
+
+        x, y, zeta = octants[0]
+        kicks = []
+        for fmap in [fieldmap_ref, fieldmap]:
+            ecloud = xf.ElectronCloud(length=1, fieldmap=fmap,
+                                      _buffer=fmap._buffer)
+            part = xp.Particles(_context=context, x=x, y=y, zeta=zeta,
+                                p0c=450e9)
+            ecloud.track(part)
+            part.move(_context=xo.ContextCpu())
+            kicks.append((part.px, part.py, part.ptau))
+        for vv, vv_ref in zip(kicks[1], kicks[0]):
+            assert np.all(vv == vv_ref)
+
+        values = [[context.nparray_from_context_array(vv)
+                   for vv in fmap.get_values_at_points(
+                        *[context.nparray_to_context_array(cc)
+                          for cc in octants[0]])]
+                  for fmap in [fieldmap_ref, fieldmap]]
+        for vv, vv_ref in zip(values[1], values[0]):
+            assert np.all(vv == vv_ref)
+
+
+def test_tricubic_update_phi():
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        # Quadratic along each axis: the central differences are exact and
+        # the interpolation is exact in the cells not touching the boundary
+        fx = lambda x: 1 + 0.3 * x - 0.7 * x**2
+        fy = lambda y: 0.5 - 0.2 * y + 1.1 * y**2
+        fz = lambda z: -0.4 + 0.9 * z + 0.6 * z**2
+        dfx = lambda x: 0.3 - 1.4 * x
+        dfy = lambda y: -0.2 + 2.2 * y
+        dfz = lambda z: 0.9 + 1.2 * z
+
+        NN = 11
+        grid = np.linspace(-0.5, 0.5, NN)
+        XX, YY, ZZ = np.meshgrid(grid, grid, grid, indexing='ij')
+        phi = fx(XX) * fy(YY) * fz(ZZ)
+
+        fieldmap = xf.TriCubicInterpolatedFieldMap(_context=context,
+                x_grid=grid, y_grid=grid, z_grid=grid,
+                cache_coefficients=True)
+        fieldmap.update_phi(phi)
+
+        phi_taylor = context.nparray_from_context_array(
+                fieldmap._phi_taylor).reshape(NN, NN, NN, 8)
+        assert np.allclose(phi_taylor[..., 0], phi.transpose(2, 1, 0),
+                           atol=0, rtol=1e-15)
+        dd = grid[1] - grid[0]
+        inner = (slice(1, -1),) * 3
+        assert np.allclose(phi_taylor[inner][..., 7],
+                           (dfx(XX) * dfy(YY) * dfz(ZZ)).transpose(
+                                                2, 1, 0)[inner] * dd**3,
+                           atol=1e-14, rtol=0)
+
+        ecloud = xf.ElectronCloud(length=1, fieldmap=fieldmap,
+                                  _buffer=fieldmap._buffer)
+        n_parts = 1000
+        rng = default_rng(789)
+        x_test = rng.uniform(grid[1], grid[-2], n_parts)
+        y_test = rng.uniform(grid[1], grid[-2], n_parts)
+        tau_test = rng.uniform(grid[1], grid[-2], n_parts)
+        beta0 = xp.Particles(p0c=450e9).beta0[0]
+        part = xp.Particles(_context=context, x=x_test, y=y_test,
+                            zeta=beta0 * tau_test, p0c=450e9)
+        ecloud.track(part)
+        part.move(_context=xo.ContextCpu())
+
+        assert np.all(part.state == 1)
+        tau = part.zeta / part.beta0
+        assert np.allclose(part.px, -dfx(part.x) * fy(part.y) * fz(tau),
+                           atol=1e-12, rtol=0)
+        assert np.allclose(part.py, -fx(part.x) * dfy(part.y) * fz(tau),
+                           atol=1e-12, rtol=0)
+        assert np.allclose(part.ptau, -fx(part.x) * fy(part.y) * dfz(tau),
+                           atol=1e-12, rtol=0)
+
+
+def test_tricubic_get_values_at_points():
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        NN = 11
+        grid = np.linspace(-0.5, 0.5, NN)
+        rng = default_rng(321)
+        phi_taylor = rng.standard_normal(8 * NN**3)
+
+        fieldmap = xf.TriCubicInterpolatedFieldMap(_context=context,
+                x_grid=grid, y_grid=grid, z_grid=grid, mirror_y=1)
+        fieldmap._phi_taylor[:] = context.nparray_to_context_array(
+                                                                phi_taylor)
+
+        n_points = 10000
+        x_test = rng.random(n_points) * 1.2 - 0.6
+        y_test = rng.random(n_points) * 1.2 - 0.6
+        tau_test = rng.random(n_points) * 1.2 - 0.6
+
+        # Reference from tracking (unit length, ptau kick through the energy)
+        ecloud = xf.ElectronCloud(length=1, fieldmap=fieldmap,
+                                  _buffer=fieldmap._buffer)
+        beta0 = xp.Particles(p0c=450e9).beta0[0]
+        part = xp.Particles(_context=context, x=x_test, y=y_test,
+                            zeta=beta0 * tau_test, p0c=450e9)
+        ecloud.track(part)
+        part.move(_context=xo.ContextCpu())
+
+        # (the lost particles are moved to the end by the tracking)
+        x_dev = context.nparray_to_context_array(part.x)
+        y_dev = context.nparray_to_context_array(part.y)
+        z_dev = context.nparray_to_context_array(part.zeta / part.beta0)
+        out = context.zeros(4 * n_points, dtype=np.float64)
+        phi, dphi_dx, dphi_dy, dphi_dz = [
+                context.nparray_from_context_array(vv)
+                for vv in fieldmap.get_values_at_points(
+                                    x=x_dev, y=y_dev, z=z_dev, out=out)]
+
+        inside = part.state == 1
+        assert np.sum(inside) > 0 and np.sum(~inside) > 0
+        assert np.all(-dphi_dx[inside] == part.px[inside])
+        assert np.all(-dphi_dy[inside] == part.py[inside])
+        assert np.allclose(-dphi_dz[inside], part.ptau[inside],
+                           atol=1e-14, rtol=1e-12)
+        for vv in [phi, dphi_dx, dphi_dy, dphi_dz]:
+            assert np.all(vv[~inside] == 0)
+
+        # Potential: consistent with the gradient along x
+        hh = 1e-6
+        phi_p, = fieldmap.get_values_at_points(x=x_dev + hh, y=y_dev, z=z_dev,
+                    return_dphi_dx=False, return_dphi_dy=False,
+                    return_dphi_dz=False)
+        phi_m, = fieldmap.get_values_at_points(x=x_dev - hh, y=y_dev, z=z_dev,
+                    return_dphi_dx=False, return_dphi_dy=False,
+                    return_dphi_dz=False)
+        phi_p = context.nparray_from_context_array(phi_p)
+        phi_m = context.nparray_from_context_array(phi_m)
+        deep_inside = (np.abs(part.x) < 0.45) & (np.abs(part.y) < 0.45) & (
+                       np.abs(part.zeta / part.beta0) < 0.45)
+        assert np.allclose((phi_p - phi_m)[deep_inside] / (2 * hh),
+                           dphi_dx[deep_inside], atol=1e-4, rtol=1e-6)
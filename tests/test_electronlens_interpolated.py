@@ -39,7 +39,8 @@ def test_electronlens_interpolated():
         norm_rho = np.sum(rho[:,:])*dx*dy
         rho[:] /= norm_rho
 
-        elens = xf.ElectronLensInterpolated(current=1, length=1, voltage=15e3, 
+        elens = xf.ElectronLensInterpolated(_context=context,
+                                            current=1, length=1, voltage=15e3,
                                             x_grid=x_grid, y_grid=y_grid, rho=rho)
 
         elens_ideal = xt.Elens(current=1, elens_length=1, voltage=15e3, 
@@ -52,7 +53,7 @@ def test_electronlens_interpolated():
         X_init = X_init.flatten()
         Y_init = Y_init.flatten()
 
-        part = xp.Particles(x=X_init[:], y=Y_init[:], 
+        part = xp.Particles(_context=context, x=X_init[:], y=Y_init[:],
                             zeta=[0], p0c=450e9
                            )
 
@@ -62,6 +63,7 @@ def test_electronlens_interpolated():
 
         elens.track(part)
         elens_ideal.track(part_ideal)
+        part.move(_context=xo.ContextCpu())
 
         sort_mask = np.argsort(part.particle_id)
         sort_ideal_mask = np.argsort(part_ideal.particle_id)
@@ -73,3 +75,59 @@ def test_electronlens_interpolated():
                            atol=1.e-8, rtol=1.e-15)
         assert np.all(part.delta == 0.)
         assert np.all(part.ptau == 0.)
+
+
+def test_bicubic_interpolation():
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        # Polynomial of degree 3 in each variable: reproduced exactly
+        scale = 0.05
+        ff = lambda x, y: sum([scale * x**i * y**j
+            for i in range(4) for j in range(4)])
+        dfdx = lambda x, y: sum([i * scale * x**(i-1) * y**j
+            for i in range(1,4) for j in range(4)])
+        dfdy = lambda x, y: sum([j * scale * x**i * y**(j-1)
+            for i in range(4) for j in range(1,4)])
+        dfdxy = lambda x, y: sum([i * j * scale * x**(i-1) * y**(j-1)
+            for i in range(1,4) for j in range(1,4)])
+
+        x_grid = np.linspace(-0.5, 0.5, 21)
+        y_grid = np.linspace(-0.6, 0.6, 31)
+        dx = x_grid[1] - x_grid[0]
+        dy = y_grid[1] - y_grid[0]
+        XX, YY = np.meshgrid(x_grid, y_grid, indexing='ij')
+        phi_taylor = np.stack([ff(XX, YY), dfdx(XX, YY) * dx,
+                               dfdy(XX, YY) * dy, dfdxy(XX, YY) * dx * dy],
+                              axis=-1)
+
+        fieldmap = xf.BiCubicInterpolatedFieldMap(_context=context,
+                x_grid=x_grid, y_grid=y_grid, phi_taylor=phi_taylor)
+
+        n_points = 1000
+        rng = np.random.default_rng(12345)
+        x_test = rng.random(n_points) * 1.2 - 0.6
+        y_test = rng.random(n_points) * 1.4 - 0.7
+        phi, dphi_dx, dphi_dy = [context.nparray_from_context_array(vv)
+            for vv in fieldmap.get_values_at_points(
+                x=context.nparray_to_context_array(x_test),
+                y=context.nparray_to_context_array(y_test))]
+
+        inside = ((x_test >= x_grid[0]) & (x_test < x_grid[-1])
+                  & (y_test >= y_grid[0]) & (y_test < y_grid[-1]))
+        assert np.allclose(phi[inside], ff(x_test, y_test)[inside],
+                           atol=1e-13, rtol=1e-13)
+        assert np.allclose(dphi_dx[inside], dfdx(x_test, y_test)[inside],
+                           atol=1e-12, rtol=1e-12)
+        assert np.allclose(dphi_dy[inside], dfdy(x_test, y_test)[inside],
+                           atol=1e-12, rtol=1e-12)
+        assert np.all(phi[~inside] == 0)
+
+        # Taylor components from phi (central differences, exact for a
+        # quadratic at the inner nodes)
+        fieldmap.update_phi(1 + 0.3 * XX - 0.7 * XX**2 + 0.5 * XX * YY**2)
+        phi_taylor_dev = context.nparray_from_context_array(
+                fieldmap._phi_taylor).reshape(len(y_grid), len(x_grid), 4)
+        assert np.allclose(phi_taylor_dev[1:-1, 1:-1, 3],
+                           (YY * dx * dy).T[1:-1, 1:-1], atol=1e-14, rtol=0)
+        assert np.all(phi_taylor_dev[0, :, 2:] == 0)
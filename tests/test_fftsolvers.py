@@ -0,0 +1,476 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import numpy as np
+import pytest
+
+import xobjects as xo
+import xfields as xf
+from xfields.solvers.fftsolvers import FFTSolver2D, FFTSolver3D, FFTSolver2p5D
+from xfields.solvers.fftsolvers import RFFTSolver3D, RFFTSolver2p5D
+
+
+def test_solver_workspace_reuse():
+    for solver_class in [FFTSolver3D, FFTSolver2p5D]:
+        for context in xo.context.get_test_contexts():
+            print(f"Test {context.__class__}")
+
+            nx, ny, nz = 16, 12, 8
+            solver = solver_class(dx=1e-3, dy=2e-3, dz=3e-3,
+                                  nx=nx, ny=ny, nz=nz, context=context)
+            solver_no_reuse = solver_class(dx=1e-3, dy=2e-3, dz=3e-3,
+                                  nx=nx, ny=ny, nz=nz, context=context,
+                                  reuse_workspace=False)
+            assert solver.n_workspace_allocations == 1
+
+            rng = np.random.default_rng(123)
+            for _ in range(3):
+                rho = context.nparray_to_context_array(
+                        np.asfortranarray(rng.random((nx, ny, nz))))
+                phi = context.nparray_from_context_array(
+                        solver.solve(rho))
+                phi_ref = context.nparray_from_context_array(
+                        solver_no_reuse.solve(rho))
+                assert np.allclose(phi, phi_ref, rtol=1e-12, atol=0)
+
+            assert solver.n_workspace_allocations == 1
+            assert solver_no_reuse.n_workspace_allocations == 4
+
+
+def test_real_transform_solvers():
+    for solver_class, rsolver_class in [(FFTSolver3D, RFFTSolver3D),
+                                        (FFTSolver2p5D, RFFTSolver2p5D)]:
+        for context in xo.context.get_test_contexts():
+            if isinstance(context, xo.ContextPyopencl):
+                continue # real transforms not available
+            print(f"Test {context.__class__}")
+
+            nx, ny, nz = 16, 12, 8
+            solver = solver_class(dx=1e-3, dy=2e-3, dz=3e-3,
+                                  nx=nx, ny=ny, nz=nz, context=context)
+            rsolver = rsolver_class(dx=1e-3, dy=2e-3, dz=3e-3,
+                                  nx=nx, ny=ny, nz=nz, context=context)
+
+            # Only half of the spectrum is stored, as a real array
+            assert rsolver._gint_rep_transf_dev.dtype == np.float64
+            assert rsolver._gint_rep_transf_dev.shape[0] == nx + 1
+
+            rng = np.random.default_rng(123)
+            for _ in range(2):
+                rho = context.nparray_to_context_array(
+                        np.asfortranarray(rng.random((nx, ny, nz))))
+                phi_ref = context.nparray_from_context_array(
+                        solver.solve(rho))
+                phi = context.nparray_from_context_array(
+                        rsolver.solve(rho))
+                assert np.allclose(phi, phi_ref, rtol=1e-10,
+                                   atol=1e-10*np.max(np.abs(phi_ref)))
+
+
+def test_green_function_cache(tmp_path):
+    for solver_class in [FFTSolver3D, FFTSolver2p5D]:
+        for ii, context in enumerate(xo.context.get_test_contexts()):
+            print(f"Test {context.__class__}")
+
+            cache_dir = tmp_path / f'{solver_class.__name__}_{ii}'
+
+            kwargs = dict(dx=1e-3, dy=2e-3, dz=3e-3, nx=16, ny=12, nz=8,
+                          context=context)
+            cache = xf.GreenFunctionCache(max_entries=1, cache_dir=cache_dir)
+            solver = solver_class(green_function_cache=cache, **kwargs)
+            assert cache.n_misses == 1 and cache.n_hits == 0
+
+            solver_cached = solver_class(green_function_cache=cache, **kwargs)
+            assert cache.n_misses == 1 and cache.n_hits == 1
+
+            # Different geometry evicts the first entry
+            solver_other = solver_class(green_function_cache=cache,
+                                        **{**kwargs, 'dx': 2e-3})
+            assert cache.n_misses == 2 and len(cache._entries) == 1
+
+            # A new cache (e.g. in another process) loads from disk
+            cache_new = xf.GreenFunctionCache(cache_dir=cache_dir)
+            solver_from_disk = solver_class(green_function_cache=cache_new,
+                                            **kwargs)
+            assert cache_new.n_misses == 0 and cache_new.n_hits == 1
+
+            rho = context.nparray_to_context_array(np.asfortranarray(
+                    np.random.default_rng(1).random((16, 12, 8))))
+            phi_ref = context.nparray_from_context_array(
+                    solver_class(**kwargs).solve(rho)).copy()
+            for ss in [solver, solver_cached, solver_from_disk]:
+                phi = context.nparray_from_context_array(ss.solve(rho))
+                assert np.allclose(phi, phi_ref, rtol=1e-12, atol=0)
+
+
+def test_chunked_green_function():
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        kwargs = dict(dx=1e-3, dy=2e-3, dz=3e-3, nx=16, ny=12, nz=8,
+                      context=context, keep_gint_rep=True)
+        solver = FFTSolver3D(**kwargs)
+
+        # Force one z plane per slab
+        class FFTSolver3DSmallSlabs(FFTSolver3D):
+            _green_function_slab_bytes = 1
+        solver_slabs = FFTSolver3DSmallSlabs(**kwargs)
+
+        assert not hasattr(FFTSolver3D(**{**kwargs, 'keep_gint_rep': False}),
+                           '_gint_rep')
+        assert np.allclose(solver_slabs._gint_rep, solver._gint_rep,
+                           rtol=1e-14, atol=0)
+        # Symmetry of the replicated Green function
+        gint = solver._gint_rep
+        assert np.allclose(gint[:, :, 1:], gint[:, :, :0:-1],
+                           rtol=1e-14, atol=0)
+
+        rho = context.nparray_to_context_array(np.asfortranarray(
+                np.random.default_rng(2).random((16, 12, 8))))
+        phi = context.nparray_from_context_array(solver.solve(rho)).copy()
+        phi_slabs = context.nparray_from_context_array(
+                solver_slabs.solve(rho))
+        assert np.allclose(phi_slabs, phi, rtol=1e-12, atol=0)
+
+
+def test_solve_batch():
+    for solver_class in [FFTSolver3D, FFTSolver2p5D,
+                         RFFTSolver3D, RFFTSolver2p5D]:
+        for context in xo.context.get_test_contexts():
+            if isinstance(context, xo.ContextPyopencl):
+                continue # batched transforms not available
+            print(f"Test {context.__class__}")
+
+            nx, ny, nz = 16, 12, 8
+            solver = solver_class(dx=1e-3, dy=2e-3, dz=3e-3,
+                                  nx=nx, ny=ny, nz=nz, context=context)
+
+            rng = np.random.default_rng(3)
+            rho_batch = [context.nparray_to_context_array(
+                            np.asfortranarray(rng.random((nx, ny, nz))))
+                         for _ in range(3)]
+            for _ in range(2): # second call reuses the workspace
+                phi_batch = context.nparray_from_context_array(
+                        solver.solve_batch(rho_batch)).copy()
+            assert phi_batch.shape == (3, nx, ny, nz)
+            n_allocations = solver.n_workspace_allocations
+
+            for ii, rho in enumerate(rho_batch):
+                phi = context.nparray_from_context_array(solver.solve(rho))
+                assert np.allclose(phi_batch[ii], phi, rtol=1e-10,
+                                   atol=1e-10*np.max(np.abs(phi)))
+            assert solver.n_workspace_allocations == n_allocations
+
+
+def test_fieldmap_update_from_particles_batch():
+    import xpart as xp
+    for context in xo.context.get_test_contexts():
+        if isinstance(context, xo.ContextPyopencl):
+            continue # batched transforms not available
+        print(f"Test {context.__class__}")
+
+        grid = dict(x_range=(-1e-2, 1e-2), y_range=(-1e-2, 1e-2),
+                    z_range=(-0.5, 0.5), nx=32, ny=32, nz=16)
+        fmap0 = xf.TriLinearInterpolatedFieldMap(_context=context,
+                                    solver='FFTSolver2p5D', **grid)
+        fieldmaps = [fmap0] + [xf.TriLinearInterpolatedFieldMap(
+                                    _context=context, solver=fmap0.solver,
+                                    **grid) for _ in range(2)]
+        fmaps_ref = [xf.TriLinearInterpolatedFieldMap(_context=context,
+                                    solver='FFTSolver2p5D', **grid)
+                     for _ in range(3)]
+
+        rng = np.random.default_rng(4)
+        particles = []
+        for ii in range(3):
+            n_part = 10000
+            particles.append(xp.Particles(_context=context, p0c=26e9,
+                    x=(1 + ii) * 1e-3 * rng.standard_normal(n_part),
+                    y=2e-3 * rng.standard_normal(n_part),
+                    zeta=0.1 * rng.standard_normal(n_part),
+                    weight=1e7))
+
+        xf.TriLinearInterpolatedFieldMap.update_from_particles_batch(
+                fieldmaps, particles)
+        for fmap, fmap_ref, pp in zip(fieldmaps, fmaps_ref, particles):
+            fmap_ref.update_from_particles(particles=pp)
+            for nn in ['rho', 'phi', 'dphi_dx', 'dphi_dy', 'dphi_dz']:
+                val = context.nparray_from_context_array(getattr(fmap, nn))
+                val_ref = context.nparray_from_context_array(
+                                                    getattr(fmap_ref, nn))
+                assert np.allclose(val, val_ref, rtol=1e-10,
+                                   atol=1e-10*np.max(np.abs(val_ref)))
+
+
+def test_solver_2d():
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        nx, ny, nz = 16, 12, 4
+        solver = FFTSolver2D(dx=1e-3, dy=2e-3, nx=nx, ny=ny, context=context)
+        solver_2p5d = FFTSolver2p5D(dx=1e-3, dy=2e-3, dz=3e-3,
+                                    nx=nx, ny=ny, nz=nz, context=context)
+        # Only one plane is stored
+        assert solver._gint_rep_transf_dev.shape == (2*nx, 2*ny)
+
+        rho = np.random.default_rng(5).random((nx, ny))
+        phi_2p5d = context.nparray_from_context_array(solver_2p5d.solve(
+                context.nparray_to_context_array(np.asfortranarray(
+                    np.stack([rho]*nz, axis=2))))).copy()
+        for _ in range(2):
+            phi = context.nparray_from_context_array(solver.solve(
+                    context.nparray_to_context_array(rho)))
+            for iz in range(nz):
+                assert np.allclose(phi, phi_2p5d[:, :, iz], rtol=1e-12,
+                                   atol=1e-12*np.max(np.abs(phi)))
+
+        # Longitudinally uniform field map
+        grid = dict(x_range=(-1e-2, 1e-2), y_range=(-1e-2, 1e-2),
+                    z_range=(-0.5, 0.5), nx=nx, ny=ny, nz=nz)
+        fmap = xf.TriLinearInterpolatedFieldMap(_context=context,
+                                                solver='FFTSolver2D', **grid)
+        fmap_2p5d = xf.TriLinearInterpolatedFieldMap(_context=context,
+                                                solver='FFTSolver2p5D', **grid)
+        rho_3d = context.nparray_to_context_array(np.asfortranarray(
+                    np.stack([rho]*nz, axis=2)))
+        fmap.update_rho(rho_3d)
+        fmap.update_phi_from_rho()
+        fmap_2p5d.update_rho(rho_3d)
+        fmap_2p5d.update_phi_from_rho()
+        for nn in ['phi', 'dphi_dx', 'dphi_dy']:
+            val = context.nparray_from_context_array(getattr(fmap, nn))
+            val_ref = context.nparray_from_context_array(
+                                                getattr(fmap_2p5d, nn))
+            assert np.allclose(val, val_ref, rtol=1e-12,
+                               atol=1e-12*np.max(np.abs(val_ref)))
+
+
+def test_2p5d_solver_empty_slices():
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        nx, ny, nz = 16, 12, 10
+        solver = FFTSolver2p5D(dx=1e-3, dy=2e-3, dz=3e-3,
+                               nx=nx, ny=ny, nz=nz, context=context)
+        solver_2d = FFTSolver2D(dx=1e-3, dy=2e-3, nx=nx, ny=ny,
+                                context=context)
+
+        rng = np.random.default_rng(6)
+        for occupied in [[2, 3, 4, 7], [], [5], list(range(nz)), [0, 9]]:
+            rho = np.zeros((nx, ny, nz), order='F')
+            for iz in occupied:
+                rho[:, :, iz] = rng.random((nx, ny))
+            phi = context.nparray_from_context_array(solver.solve(
+                    context.nparray_to_context_array(rho)))
+            for iz in range(nz):
+                phi_ref = context.nparray_from_context_array(solver_2d.solve(
+                    context.nparray_to_context_array(rho[:, :, iz].copy())))
+                assert np.allclose(phi[:, :, iz], phi_ref, rtol=1e-12,
+                                   atol=1e-12*np.max(np.abs(phi_ref)))
+
+
+def test_spectral_gradients():
+    for context in xo.context.get_test_contexts():
+        if isinstance(context, xo.ContextPyopencl):
+            continue # spectral gradients not available
+        print(f"Test {context.__class__}")
+
+        fmap = xf.TriLinearInterpolatedFieldMap(_context=context,
+                    x_range=(-1e-2, 1e-2), y_range=(-1e-2, 1e-2),
+                    z_range=(-0.5, 0.5), nx=32, ny=24, nz=16,
+                    scale_coordinates_in_solver=(1., 1., 3.))
+
+        x, y, z = np.meshgrid(fmap.x_grid, fmap.y_grid, fmap.z_grid,
+                              indexing='ij')
+        rho = np.asfortranarray(np.exp(-(x/2e-3)**2 - (y/3e-3)**2
+                                       - (z/0.1)**2))
+        fmap.update_rho(context.nparray_to_context_array(rho))
+
+        for solver_name in ['FFTSolver3D', 'FFTSolver2p5D', 'FFTSolver2D',
+                            'RFFTSolver3D', 'RFFTSolver2p5D']:
+            results = []
+            for spectral_gradients in [False, True]:
+                solver = fmap.generate_solver(solver_name, None,
+                                    spectral_gradients=spectral_gradients)
+                fmap.update_phi_from_rho(solver=solver)
+                results.append({nn: context.nparray_from_context_array(
+                                            getattr(fmap, nn)).copy()
+                    for nn in ['phi', 'dphi_dx', 'dphi_dy', 'dphi_dz']})
+
+            for nn, val_ref in results[0].items():
+                val = results[1][nn]
+                # Same result as the central differences on the grid, apart
+                # from the edges where the grid central differences are zero
+                assert np.allclose(val[1:-1, 1:-1, 1:-1],
+                                   val_ref[1:-1, 1:-1, 1:-1], rtol=1e-9,
+                                   atol=1e-9*np.max(np.abs(val_ref)))
+
+            # Spectral derivatives are non-zero at the edges
+            assert np.all(results[1]['dphi_dx'][0, :, 1:-1] != 0)
+
+
+def test_single_precision():
+    for solver_class in [FFTSolver3D, FFTSolver2p5D,
+                         RFFTSolver3D, RFFTSolver2p5D]:
+        for context in xo.context.get_test_contexts():
+            if (isinstance(context, xo.ContextPyopencl)
+                    and solver_class in [RFFTSolver3D, RFFTSolver2p5D]):
+                continue # real transforms not available
+            print(f"Test {context.__class__}")
+
+            kwargs = dict(dx=1e-3, dy=2e-3, dz=3e-3, nx=16, ny=12, nz=8,
+                          context=context)
+            solver = solver_class(**kwargs)
+            solver_single = solver_class(precision='single', **kwargs)
+            assert solver_single._workspace_dev.itemsize * 2 == (
+                        solver._workspace_dev.itemsize)
+            assert solver_single._gint_rep_transf_dev.itemsize * 2 == (
+                        solver._gint_rep_transf_dev.itemsize)
+
+            rho = context.nparray_to_context_array(np.asfortranarray(
+                    np.random.default_rng(7).random((16, 12, 8))))
+            phi = context.nparray_from_context_array(
+                    solver.solve(rho)).copy()
+            phi_single = context.nparray_from_context_array(
+                    solver_single.solve(rho))
+            assert np.allclose(phi_single, phi, rtol=1e-5,
+                               atol=1e-5*np.max(np.abs(phi)))
+
+    # Only the solver runs in single precision
+    fmap = xf.TriLinearInterpolatedFieldMap(x_range=(-1e-2, 1e-2),
+                y_range=(-1e-2, 1e-2), z_range=(-0.5, 0.5), nx=16, ny=12,
+                nz=8, solver='FFTSolver2p5D', precision='single')
+    fmap.update_rho(np.asfortranarray(
+                np.random.default_rng(7).random((16, 12, 8))))
+    fmap.update_phi_from_rho()
+    for nn in ['rho', 'phi', 'dphi_dx', 'dphi_dy', 'dphi_dz']:
+        assert getattr(fmap, nn).dtype == np.float64
+
+
+def test_threaded_fft_backends(tmp_path):
+    from xfields.solvers.fftbackends import pyfftw_available
+
+    fft_backends = ['scipy']
+    if pyfftw_available:
+        fft_backends.append('fftw')
+
+    context = xo.ContextCpu()
+    for fft_backend in fft_backends:
+        for solver_class in [FFTSolver3D, FFTSolver2p5D,
+                             RFFTSolver3D, RFFTSolver2p5D]:
+            print(f"Test {solver_class.__name__} {fft_backend}")
+
+            kwargs = dict(dx=1e-3, dy=2e-3, dz=3e-3, nx=16, ny=12, nz=8,
+                          context=context)
+            solver = solver_class(**kwargs)
+            solver_threaded = solver_class(fft_backend=fft_backend,
+                                           fft_threads=2, **kwargs)
+
+            rng = np.random.default_rng(8)
+            for _ in range(2):
+                rho = np.asfortranarray(rng.random((16, 12, 8)))
+                phi = solver.solve(rho).copy()
+                phi_threaded = solver_threaded.solve(rho)
+                assert np.allclose(phi_threaded, phi, rtol=1e-10,
+                                   atol=1e-10*np.max(np.abs(phi)))
+
+    if pyfftw_available:
+        wisdom_file = tmp_path / 'fftw_wisdom.pkl'
+        assert not xf.solvers.import_fftw_wisdom(wisdom_file)
+        xf.solvers.export_fftw_wisdom(wisdom_file)
+        assert xf.solvers.import_fftw_wisdom(wisdom_file)
+
+
+def test_spectral_filter():
+    for solver_class in [FFTSolver3D, FFTSolver2p5D,
+                         RFFTSolver3D, RFFTSolver2p5D]:
+        for context in xo.context.get_test_contexts():
+            if (isinstance(context, xo.ContextPyopencl)
+                    and solver_class in (RFFTSolver3D, RFFTSolver2p5D)):
+                continue # real transforms not available
+            print(f"Test {context.__class__}")
+
+            nx, ny, nz = 16, 12, 8
+            grid = dict(dx=1e-3, dy=2e-3, dz=3e-3, nx=nx, ny=ny, nz=nz,
+                        context=context)
+            cache = xf.GreenFunctionCache()
+            solver = solver_class(green_function_cache=cache, **grid)
+            solver_gauss = solver_class(green_function_cache=cache,
+                    spectral_filter='gaussian', spectral_filter_width=1.5,
+                    **grid)
+            solver_user = solver_class(spectral_filter=lambda *ff:
+                    np.exp(-2 * (np.pi * 1.5)**2 * sum(f**2 for f in ff)),
+                    **grid)
+            solver_binom = solver_class(spectral_filter='binomial',
+                                        spectral_filter_width=0, **grid)
+
+            rng = np.random.default_rng(123)
+            rho = context.nparray_to_context_array(
+                    np.asfortranarray(rng.random((nx, ny, nz))))
+            phi_ref = context.nparray_from_context_array(
+                    solver.solve(rho)).copy()
+            phi_gauss = context.nparray_from_context_array(
+                    solver_gauss.solve(rho)).copy()
+            phi_user = context.nparray_from_context_array(
+                    solver_user.solve(rho)).copy()
+            phi_binom = context.nparray_from_context_array(
+                    solver_binom.solve(rho)).copy()
+
+            atol = 1e-10 * np.max(np.abs(phi_ref))
+            assert np.allclose(phi_user, phi_gauss, rtol=1e-10, atol=atol)
+            assert np.allclose(phi_binom, phi_ref, rtol=1e-10, atol=atol)
+            assert not np.allclose(phi_gauss, phi_ref, rtol=1e-3)
+
+            # The cached kernel is not modified by the filter
+            assert cache.n_hits == 1
+            phi = context.nparray_from_context_array(solver.solve(rho))
+            assert np.allclose(phi, phi_ref, rtol=1e-14, atol=0)
+
+
+def test_2p5d_solver_compacted_workspaces():
+    for context in xo.context.get_test_contexts():
+        if isinstance(context, xo.ContextPyopencl):
+            continue # slices are not compacted
+        print(f"Test {context.__class__}")
+
+        nx, ny, nz = 16, 12, 10
+        solver = FFTSolver2p5D(dx=1e-3, dy=2e-3, dz=3e-3,
+                               nx=nx, ny=ny, nz=nz, context=context)
+        assert solver.n_workspace_allocations == 1
+
+        rng = np.random.default_rng(7)
+        for _ in range(2):
+            for occupied in [[3], [1, 6, 8], [0, 4, 9]]:
+                rho = np.zeros((nx, ny, nz), order='F')
+                for iz in occupied:
+                    rho[:, :, iz] = rng.random((nx, ny))
+                solver.solve(context.nparray_to_context_array(rho))
+
+        # One workspace for one slice, one for up to four slices
+        assert solver.n_workspace_allocations == 3
+
+
+def test_fftw_backend_workspace():
+    pytest.importorskip('pyfftw')
+
+    context = xo.ContextCpu()
+    kwargs = dict(dx=1e-3, dy=2e-3, dz=3e-3, nx=16, ny=12, nz=8,
+                  context=context)
+    for solver_class in [FFTSolver3D, FFTSolver2p5D]:
+        print(f"Test {solver_class.__name__}")
+
+        with pytest.raises(ValueError):
+            solver_class(fft_backend='fftw', reuse_workspace=False, **kwargs)
+
+        solver = solver_class(**kwargs)
+        solver_fftw = solver_class(fft_backend='fftw', **kwargs)
+        rng = np.random.default_rng(11)
+        for _ in range(2):
+            rho = np.asfortranarray(rng.random((16, 12, 8)))
+            rho[:, :, 3:] = 0 # compacted slices in 2.5D
+            phi = solver.solve(rho).copy()
+            phi_fftw = solver_fftw.solve(rho)
+            assert np.allclose(phi_fftw, phi, rtol=1e-10,
+                               atol=1e-10*np.max(np.abs(phi)))
@@ -0,0 +1,409 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import numpy as np
+import pytest
+from scipy.constants import e as qe
+
+import xobjects as xo
+import xfields as xf
+from xfields.solvers.fftsolvers import FFTSolver2D
+
+
+def test_private_grids_deposition():
+    import xpart as xp
+    for context in xo.context.get_test_contexts():
+        grid = dict(x_range=(-1e-2, 1e-2), y_range=(-1e-2, 1e-2),
+                    z_range=(-0.5, 0.5), nx=32, ny=32, nz=16)
+        if not isinstance(context, xo.ContextCpu):
+            with pytest.raises(ValueError):
+                xf.TriLinearInterpolatedFieldMap(_context=context,
+                                        deposition='private_grids', **grid)
+            continue
+        print(f"Test {context.__class__}")
+
+        fmap_default = xf.TriLinearInterpolatedFieldMap(_context=context,
+                                        deposition='private_grids', **grid)
+        assert fmap_default.n_private_grids == max(context.omp_num_threads, 1)
+
+        fmap = xf.TriLinearInterpolatedFieldMap(_context=context,
+                    deposition='private_grids', n_private_grids=7, **grid)
+
+        rng = np.random.default_rng(5)
+        n_part = 20001
+        particles = xp.Particles(_context=context, p0c=26e9,
+                x=1e-3 * rng.standard_normal(n_part),
+                y=2e-3 * rng.standard_normal(n_part),
+                zeta=0.1 * rng.standard_normal(n_part),
+                weight=1e7)
+
+        fmap.update_from_particles(particles=particles, update_phi=False)
+        rho = context.nparray_from_context_array(fmap.rho).copy()
+        fmap.update_from_particles(particles=particles, update_phi=False)
+        rho_again = context.nparray_from_context_array(fmap.rho).copy()
+        assert np.all(rho == rho_again)
+
+        fmap.deposition = 'atomic'
+        fmap.update_from_particles(particles=particles, update_phi=False)
+        rho_atomic = context.nparray_from_context_array(fmap.rho).copy()
+        assert np.allclose(rho, rho_atomic, rtol=1e-12,
+                           atol=1e-12*np.max(np.abs(rho_atomic)))
+
+        # Arrays path
+        rho_arrays = {}
+        for deposition in ['atomic', 'private_grids']:
+            fmap.deposition = deposition
+            fmap.update_from_particles(x_p=particles.x, y_p=particles.y,
+                                       z_p=particles.zeta,
+                                       ncharges_p=particles.weight,
+                                       q0_coulomb=particles.q0*qe,
+                                       update_phi=False)
+            rho_arrays[deposition] = context.nparray_from_context_array(
+                                                            fmap.rho).copy()
+        assert np.allclose(rho_arrays['private_grids'], rho_arrays['atomic'],
+                           rtol=1e-12,
+                           atol=1e-12*np.max(np.abs(rho_arrays['atomic'])))
+
+
+def test_cell_sorted_deposition():
+    import xpart as xp
+    for context in xo.context.get_test_contexts():
+        if isinstance(context, xo.ContextPyopencl):
+            continue # cell index not available
+        print(f"Test {context.__class__}")
+
+        cell_index = xf.ParticleCellIndex()
+        fmap = xf.TriLinearInterpolatedFieldMap(_context=context,
+                    x_range=(-1e-2, 1e-2), y_range=(-1e-2, 1e-2),
+                    z_range=(-0.5, 0.5), nx=32, ny=32, nz=16,
+                    deposition='cell_sorted', cell_index=cell_index)
+
+        rng = np.random.default_rng(6)
+        n_part = 20000
+        particles = xp.Particles(_context=context, p0c=26e9,
+                x=3e-3 * rng.standard_normal(n_part),
+                y=2e-3 * rng.standard_normal(n_part),
+                zeta=0.2 * rng.standard_normal(n_part),
+                weight=1e7)
+        particles.state[:10] = 0
+
+        for i_turn in range(3):
+            fmap.deposition = 'cell_sorted'
+            fmap.update_from_particles(particles=particles, update_phi=False)
+            rho = context.nparray_from_context_array(fmap.rho).copy()
+
+            fmap.deposition = 'atomic'
+            fmap.update_from_particles(particles=particles, update_phi=False)
+            rho_atomic = context.nparray_from_context_array(fmap.rho).copy()
+            assert np.allclose(rho, rho_atomic, rtol=1e-12,
+                               atol=1e-12*np.max(np.abs(rho_atomic)))
+
+            # Particles move by a fraction of a cell
+            particles.x += 1e-4 * rng.standard_normal(n_part)
+            particles.zeta += 1e-2 * rng.standard_normal(n_part)
+
+        assert cell_index.n_full_sorts == 1
+        assert cell_index.n_incremental_updates == 2
+        cells = context.nparray_from_context_array(cell_index.cell_index)
+        order = context.nparray_from_context_array(
+                                            cell_index.sorted_particles)
+        assert np.all(np.diff(cells[order]) >= 0)
+
+
+def test_deposition_active_particles():
+    import xpart as xp
+    context = xo.ContextCpu() # active particle count available on CPU
+    fmap = xf.TriLinearInterpolatedFieldMap(_context=context,
+                x_range=(-1e-2, 1e-2), y_range=(-1e-2, 1e-2),
+                z_range=(-0.5, 0.5), nx=32, ny=32, nz=16)
+
+    rng = np.random.default_rng(7)
+    n_part = 10000
+    particles = xp.Particles(_context=context, p0c=26e9, _capacity=3*n_part,
+            x=1e-3 * rng.standard_normal(n_part),
+            y=2e-3 * rng.standard_normal(n_part),
+            zeta=0.1 * rng.standard_normal(n_part),
+            weight=1e7)
+    particles.state[::3] = 0
+    particles.reorganize()
+    n_active = particles._num_active_particles
+    assert n_active == n_part - len(particles.state[:n_part:3])
+
+    fmap.update_from_particles(x_p=particles.x[:n_active].copy(),
+                               y_p=particles.y[:n_active].copy(),
+                               z_p=particles.zeta[:n_active].copy(),
+                               ncharges_p=particles.weight[:n_active].copy(),
+                               q0_coulomb=qe, update_phi=False)
+    rho_ref = fmap.rho.copy()
+
+    for deposition in ['atomic', 'private_grids', 'cell_sorted']:
+        fmap.deposition = deposition
+        fmap.update_from_particles(particles=particles, update_phi=False)
+        assert np.allclose(fmap.rho, rho_ref, rtol=1e-7,
+                           atol=1e-7*np.max(np.abs(rho_ref)))
+    assert len(fmap.cell_index.cell_index) == n_active
+
+
+def test_factorized_2p5d():
+    import xpart as xp
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        grid = dict(x_range=(-1e-2, 1e-2), y_range=(-1e-2, 1e-2),
+                    z_range=(-0.5, 0.5), nx=32, ny=32, nz=16)
+        fmap_fact = xf.TriLinearInterpolatedFieldMap(_context=context,
+                            solver='FFTSolver2p5D', factorized_2p5d=True,
+                            **grid)
+        assert isinstance(fmap_fact.solver, FFTSolver2D)
+        fmap_ref = xf.TriLinearInterpolatedFieldMap(_context=context,
+                            solver='FFTSolver2p5D', **grid)
+
+        # Separable charge density: same potential as the 2.5D solver
+        xg, yg, zg = np.meshgrid(fmap_ref.x_grid, fmap_ref.y_grid,
+                                 fmap_ref.z_grid, indexing='ij')
+        rho = (np.exp(-xg**2 / 2e-6 - yg**2 / 8e-6)
+               * np.exp(-zg**2 / 0.02) * 1e-3)
+        for fmap in [fmap_fact, fmap_ref]:
+            fmap.update_rho(context.nparray_to_context_array(rho))
+            fmap.update_phi_from_rho()
+        for nn in ['phi', 'dphi_dx', 'dphi_dy', 'dphi_dz']:
+            val = context.nparray_from_context_array(getattr(fmap_fact, nn))
+            val_ref = context.nparray_from_context_array(
+                                                getattr(fmap_ref, nn))
+            assert np.allclose(val, val_ref, rtol=1e-10,
+                               atol=1e-10*np.max(np.abs(val_ref)))
+
+        # From particles
+        rng = np.random.default_rng(8)
+        n_part = 100000
+        particles = xp.Particles(_context=context, p0c=26e9,
+                x=1e-3 * rng.standard_normal(n_part),
+                y=2e-3 * rng.standard_normal(n_part),
+                zeta=0.1 * rng.standard_normal(n_part),
+                weight=1e7)
+        for fmap in [fmap_fact, fmap_ref]:
+            fmap.update_from_particles(particles=particles)
+        rho = context.nparray_from_context_array(fmap_fact.rho)
+        rho_ref = context.nparray_from_context_array(fmap_ref.rho)
+        assert np.isclose(np.sum(rho), np.sum(rho_ref), rtol=1e-10)
+        for nn in ['phi', 'dphi_dx', 'dphi_dy']:
+            val = context.nparray_from_context_array(getattr(fmap_fact, nn))
+            val_ref = context.nparray_from_context_array(
+                                                getattr(fmap_ref, nn))
+            assert np.allclose(val, val_ref, rtol=0,
+                               atol=5e-2*np.max(np.abs(val_ref)))
+
+        # force=True updates a map declared as not updatable
+        fmap_fact.updatable = False
+        fmap_fact.update_from_particles(particles=particles, force=True)
+        assert np.allclose(
+                context.nparray_from_context_array(fmap_fact.phi),
+                context.nparray_from_context_array(fmap_ref.phi),
+                rtol=0, atol=5e-2*np.max(np.abs(
+                    context.nparray_from_context_array(fmap_ref.phi))))
+
+
+def test_get_values_at_points_out_and_multi():
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        buf = context.new_buffer()
+        grid = dict(x_range=(-1., 1.), y_range=(-2., 2.), z_range=(-3., 3.),
+                    nx=10, ny=12, nz=8)
+        rng = np.random.default_rng(10)
+        fieldmaps = []
+        for _ in range(3):
+            fmap = xf.TriLinearInterpolatedFieldMap(_buffer=buf, **grid)
+            fmap.update_rho(context.nparray_to_context_array(
+                                        rng.random((10, 12, 8))))
+            fmap.update_phi(context.nparray_to_context_array(
+                                        rng.random((10, 12, 8))))
+            fieldmaps.append(fmap)
+
+        n_points = 50
+        x = context.nparray_to_context_array(rng.uniform(-1, 1, n_points))
+        y = context.nparray_to_context_array(rng.uniform(-2, 2, n_points))
+        z = context.nparray_to_context_array(rng.uniform(-3, 3, n_points))
+
+        ref = [[context.nparray_from_context_array(vv)
+                for vv in fmap.get_values_at_points(x, y, z)]
+               for fmap in fieldmaps]
+
+        out = context.zeros(2 * n_points, dtype=np.float64)
+        for _ in range(2):
+            phi, dphi_dz = fieldmaps[1].get_values_at_points(x, y, z,
+                        return_rho=False, return_dphi_dx=False,
+                        return_dphi_dy=False, out=out)
+        assert np.all(context.nparray_from_context_array(phi) == ref[1][1])
+        assert np.all(context.nparray_from_context_array(dphi_dz)
+                      == ref[1][4])
+        assert np.all(context.nparray_from_context_array(out)[:n_points]
+                      == ref[1][1])
+
+        values = xf.TriLinearInterpolatedFieldMap.get_values_at_points_multi(
+                                                        fieldmaps, x, y, z)
+        assert len(values) == 3
+        for vals, vals_ref in zip(values, ref):
+            assert len(vals) == 5
+            for vv, vv_ref in zip(vals, vals_ref):
+                assert np.all(context.nparray_from_context_array(vv)
+                              == vv_ref)
+
+        # The cache of the offset tables is bounded
+        for ii in range(2 * fieldmaps[0]._max_offsets_tables):
+            selection = [bool(ii & (1 << jj)) for jj in range(5)]
+            xf.TriLinearInterpolatedFieldMap.get_values_at_points_multi(
+                    fieldmaps, x, y, z, *selection)
+        assert (len(fieldmaps[0]._offsets_of_maps_to_interp_multi)
+                == fieldmaps[0]._max_offsets_tables)
+
+
+def test_interleaved_gradients():
+    import xpart as xp
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        grid = dict(x_range=(-1e-2, 1e-2), y_range=(-1e-2, 1e-2),
+                    z_range=(-0.5, 0.5), nx=32, ny=32, nz=16)
+        buf = context.new_buffer()
+        fmap = xf.TriLinearInterpolatedFieldMap(_buffer=buf,
+                            solver='FFTSolver2p5D', **grid)
+        fmap_il = xf.TriLinearInterpolatedFieldMap(_buffer=buf,
+                            solver=fmap.solver, gradient_layout='interleaved',
+                            **grid)
+        assert fmap_il.gradient_layout == 'interleaved'
+        assert len(fmap._dphi_interleaved) == 0
+
+        rng = np.random.default_rng(11)
+        n_part = 10000
+        particles = xp.Particles(_context=context, p0c=26e9,
+                x=1e-3 * rng.standard_normal(n_part),
+                y=2e-3 * rng.standard_normal(n_part),
+                zeta=0.1 * rng.standard_normal(n_part),
+                weight=1e7)
+        particles_il = particles.copy()
+
+        sc = xf.SpaceCharge3D(_buffer=buf, length=1., fieldmap=fmap,
+                              update_on_track=True)
+        sc_il = xf.SpaceCharge3D(_buffer=buf, length=1., fieldmap=fmap_il,
+                                 update_on_track=True)
+        sc.track(particles)
+        sc_il.track(particles_il)
+
+        dphi_il = context.nparray_from_context_array(fmap_il.dphi_interleaved)
+        for ii, nn in enumerate(['dphi_dx', 'dphi_dy', 'dphi_dz']):
+            assert np.all(dphi_il[ii] ==
+                    context.nparray_from_context_array(getattr(fmap_il, nn)))
+        for nn in ['px', 'py']:
+            val = context.nparray_from_context_array(getattr(particles, nn))
+            val_il = context.nparray_from_context_array(
+                                                getattr(particles_il, nn))
+            assert np.allclose(val_il, val, rtol=1e-14,
+                               atol=1e-14*np.max(np.abs(val)))
+            assert np.max(np.abs(val)) > 0
+
+
+def test_tsc_shape_function():
+    import xpart as xp
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        fmap = xf.TriLinearInterpolatedFieldMap(_context=context,
+                    x_range=(-1e-2, 1e-2), y_range=(-1e-2, 1e-2),
+                    z_range=(-0.5, 0.5), nx=32, ny=32, nz=16,
+                    solver='FFTSolver2p5D', shape_function='tsc')
+        assert fmap.shape_function == 'tsc'
+
+        rng = np.random.default_rng(12)
+        n_part = 20000
+        particles = xp.Particles(_context=context, p0c=26e9,
+                x=1e-3 * rng.standard_normal(n_part),
+                y=2e-3 * rng.standard_normal(n_part),
+                zeta=0.1 * rng.standard_normal(n_part),
+                weight=1e7)
+
+        fmap.update_from_particles(particles=particles, update_phi=False)
+        rho = context.nparray_from_context_array(fmap.rho).copy()
+        assert np.isclose(np.sum(rho) * fmap.dx * fmap.dy * fmap.dz,
+                          n_part * 1e7 * qe, rtol=1e-6)
+
+        fmap.deposition = 'private_grids'
+        fmap.update_from_particles(particles=particles, update_phi=False)
+        rho_pg = context.nparray_from_context_array(fmap.rho)
+        assert np.allclose(rho_pg, rho, rtol=1e-12,
+                           atol=1e-12*np.max(np.abs(rho)))
+
+        # Linear functions are interpolated exactly
+        xg, yg, zg = np.meshgrid(fmap.x_grid, fmap.y_grid, fmap.z_grid,
+                                 indexing='ij')
+        fmap.update_phi(context.nparray_to_context_array(
+                                        1 + 100*xg - 200*yg + 3*zg))
+        xx = np.array([1e-3, -2.5e-3, 7e-3])
+        yy = np.array([2e-3, 0., -4e-3])
+        zz = np.array([0.1, -0.2, 0.3])
+        phi, = fmap.get_values_at_points(
+                context.nparray_to_context_array(xx),
+                context.nparray_to_context_array(yy),
+                context.nparray_to_context_array(zz),
+                return_rho=False, return_dphi_dx=False,
+                return_dphi_dy=False, return_dphi_dz=False)
+        assert np.allclose(context.nparray_from_context_array(phi),
+                           1 + 100*xx - 200*yy + 3*zz, rtol=1e-12, atol=0)
+
+
+def test_grid_stats():
+    import xpart as xp
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        sc = xf.SpaceCharge3D(_context=context, length=1.,
+                    x_range=(-1e-2, 1e-2), y_range=(-1e-2, 1e-2),
+                    z_range=(-0.5, 0.5), nx=32, ny=32, nz=16,
+                    solver='FFTSolver2p5D', record_grid_stats=True)
+        fmap = sc.fieldmap
+
+        rng = np.random.default_rng(5)
+        n_part = 20000
+        x = 4e-3 * rng.standard_normal(n_part)
+        y = 2e-3 * rng.standard_normal(n_part)
+        z = 0.1 * rng.standard_normal(n_part)
+        state = np.ones(n_part, dtype=np.int64)
+        state[:10] = 0
+        particles = xp.Particles(_context=context, p0c=26e9,
+                x=x, y=y, zeta=z, weight=1e7, state=state)
+        sc.track(particles)
+
+        alive = state > 0
+        jx = np.floor((x - fmap.x_grid[0]) / fmap.dx)
+        iy = np.floor((y - fmap.y_grid[0]) / fmap.dy)
+        kz = np.floor((z - fmap.z_grid[0]) / fmap.dz)
+        on_grid = ((jx >= 0) & (jx < fmap.nx - 1) & (iy >= 0)
+                   & (iy < fmap.ny - 1) & (kz >= 0) & (kz < fmap.nz - 1))
+        n_out = np.sum(alive & ~on_grid)
+        assert n_out > 0
+
+        stats = fmap.deposition_stats
+        assert stats['n_particles'] == n_part - 10
+        assert stats['n_out_of_grid'] == n_out
+        rho = context.nparray_from_context_array(fmap.rho)
+        assert np.isclose(stats['charge_deposited'],
+                          np.sum(rho) * fmap.dx * fmap.dy * fmap.dz,
+                          rtol=1e-10)
+        assert np.isclose(stats['charge_deposited'] + stats['charge_dropped'],
+                          (n_part - 10) * 1e7 * qe, rtol=1e-6)
+        assert np.allclose(stats['bounding_box'],
+                           [(np.min(x[alive]), np.max(x[alive])),
+                            (np.min(y[alive]), np.max(y[alive])),
+                            (np.min(z[alive]), np.max(z[alive]))],
+                           rtol=0, atol=0)
+        assert fmap.interpolation_stats['n_out_of_grid'] == n_out
+        assert 'charge_dropped' not in fmap.interpolation_stats
+
+        fmap.get_values_at_points(
+                x=context.nparray_to_context_array(np.array([0., 1., 0.])),
+                y=context.nparray_to_context_array(np.zeros(3)),
+                z=context.nparray_to_context_array(np.zeros(3)))
+        assert fmap.interpolation_stats['n_particles'] == 3
+        assert fmap.interpolation_stats['n_out_of_grid'] == 1
@@ -11,6 +11,7 @@ from scipy.constants import c as clight
 import xobjects as xo
 import xtrack as xt
 import xpart as xp
+import xfields as xf
 
 import ducktrack as dtk
 
@@ -236,3 +237,43 @@ def test_spacecharge_pic():
                     p2np(particles.py[:n_probes])[mask_inside_grid],
                     p_dtk.py[mask_inside_grid],
                     atol=3e-2*np.max(np.abs(p_dtk.py[mask_inside_grid])))
+
+
+def test_spacecharge_timings():
+    import xpart as xp
+    for context in xo.context.get_test_contexts():
+        print(f"Test {context.__class__}")
+
+        sc = xf.SpaceCharge3D(_context=context, length=1., update_on_track=True,
+                              x_range=(-1e-2, 1e-2), y_range=(-1e-2, 1e-2),
+                              z_range=(-0.5, 0.5), nx=32, ny=32, nz=16,
+                              solver='FFTSolver2p5D', record_timings=True)
+
+        rng = np.random.default_rng(9)
+        n_part = 10000
+        particles = xp.Particles(_context=context, p0c=26e9,
+                x=1e-3 * rng.standard_normal(n_part),
+                y=2e-3 * rng.standard_normal(n_part),
+                zeta=0.1 * rng.standard_normal(n_part),
+                weight=1e7)
+        particles_ref = particles.copy()
+
+        for _ in range(2):
+            sc.track(particles)
+        assert sc.timings['n_calls'] == 2
+        for stage in ['deposit', 'solve', 'gradients', 'kick']:
+            assert sc.timings[stage] > 0
+
+        sc.reset_timings()
+        assert len(sc.timings) == 0
+
+        # Same kicks without timings
+        sc.record_timings = False
+        for _ in range(2):
+            sc.track(particles_ref)
+        assert len(sc.timings) == 0
+        for nn in ['px', 'py']:
+            assert np.all(context.nparray_from_context_array(
+                                getattr(particles, nn))
+                          == context.nparray_from_context_array(
+                                getattr(particles_ref, nn)))
@@ -8,9 +8,12 @@ from .longitudinal_profiles import LongitudinalProfileQGaussian
 
 from .fieldmaps import TriLinearInterpolatedFieldMap
 from .fieldmaps import TriCubicInterpolatedFieldMap
+from .fieldmaps import BiCubicInterpolatedFieldMap
 from .fieldmaps import BiGaussianFieldMap, mean_and_std
+from .fieldmaps import ParticleCellIndex
 
 from .solvers.fftsolvers import FFTSolver3D
+from .solvers import GreenFunctionCache
 
 from .beam_elements.spacecharge import SpaceCharge3D, SpaceChargeBiGaussian
 from .beam_elements.beambeam2d import BeamBeamBiGaussian2D
@@ -4,7 +4,8 @@
 # ########################################### #
 
 from ..fieldmaps import TriCubicInterpolatedFieldMap
-from ..general import _pkg_root
+from ..fieldmaps.tricubicinterpolated import _CellGroupedCoefficients
+from ..general import _pkg_root, _get_num_particles_to_process
 
 import xobjects as xo
 import xtrack as xt
@@ -42,6 +43,17 @@ class ElectronCloud(xt.BeamElement):
             particles is applied. The default is ``True``.
         fieldmap (xfields.TriCubicInterpolatedFieldMap): Field map of the 
             electron cloud forces.
+        cell_grouped (bool): If ``True``, at each call of ``track`` the
+            particles are grouped by the cell of the field map in which they
+            are located and the coefficients of the interpolating polynomial
+            are computed once per occupied cell and shared by all the
+            particles in the cell, instead of once per particle. It requires
+            a field map created with ``max_grouped_cells`` > 0. The grouping
+            costs an extra pass over the particles and over the occupied
+            cells at each call, so it pays off only when the cells hold
+            many particles each (on CPU, from about ten particles per
+            occupied cell); with about one particle per cell it is slower.
+            The default is ``False``.
     Returns:
         (ElectronCloud): An electron cloud beam element.
     """
@@ -77,6 +89,7 @@ class ElectronCloud(xt.BeamElement):
                  length=None,
                  apply_z_kick=True,
                  fieldmap=None,
+                 cell_grouped=False,
                  ):
 
         # To be implemented if false
@@ -103,3 +116,24 @@ class ElectronCloud(xt.BeamElement):
                  dipolar_ptau_kick=dipolar_ptau_kick,
                  length=length,
                  fieldmap=fieldmap)
+
+        self.cell_grouped = cell_grouped
+        if self.cell_grouped:
+            self._cell_grouping = _CellGroupedCoefficients(fieldmap)
+
+    def track(self, particles, increment_at_element=False):
+
+        if not getattr(self, 'cell_grouped', False):
+            super().track(particles, increment_at_element=increment_at_element)
+            return
+
+        # The cell table of the field map can be shared with other elements:
+        # it is cleared as soon as the kick is applied
+        self._cell_grouping.update(particles,
+                n_particles=_get_num_particles_to_process(particles),
+                x_shift=self.x_shift, y_shift=self.y_shift,
+                tau_shift=self.tau_shift)
+        try:
+            super().track(particles, increment_at_element=increment_at_element)
+        finally:
+            self._cell_grouping.reset()
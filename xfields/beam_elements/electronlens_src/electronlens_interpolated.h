@@ -12,7 +12,7 @@ void ElectronLensInterpolated_track_local_particle(ElectronLensInterpolatedData
     const double length = ElectronLensInterpolatedData_get_length(el);
     const double current = ElectronLensInterpolatedData_get_current(el);
     const double voltage = ElectronLensInterpolatedData_get_voltage(el);
-    TriCubicInterpolatedFieldMapData fmap = ElectronLensInterpolatedData_getp_fieldmap(el);
+    BiCubicInterpolatedFieldMapData fmap = ElectronLensInterpolatedData_getp_fieldmap(el);
 
     // # Electron properties
     // total electron energy
@@ -31,11 +31,10 @@ void ElectronLensInterpolated_track_local_particle(ElectronLensInterpolatedData
 
         double dphi_dx=0;
         double dphi_dy=0;
-        double dphi_dtau=0;
         
-        if( TriCubicInterpolatedFieldMap_interpolate_grad(fmap, 
-            x, y, 0.,
-            &dphi_dx, &dphi_dy, &dphi_dtau)
+        if( BiCubicInterpolatedFieldMap_interpolate_grad(fmap, 
+            x, y,
+            &dphi_dx, &dphi_dy)
           ){
               LocalParticle_set_state(part, -11); // Stop tracking particle if it escapes the interpolation grid.
           }
@@ -9,7 +9,7 @@ from xfields import BiGaussianFieldMap, mean_and_std
 from xfields import TriLinearInterpolatedFieldMap
 from ..longitudinal_profiles import LongitudinalProfileQGaussian
 from ..fieldmaps import BiGaussianFieldMap
-from ..general import _pkg_root
+from ..general import _pkg_root, _start_timer, _record_time
 
 import xobjects as xo
 import xtrack as xt
@@ -61,12 +61,65 @@ class SpaceCharge3D(xt.BeamElement):
             Volts. If not provided the ``phi`` is calculated from ``rho``
             using the Poisson solver (if available).
         solver (str or solver object): Defines the Poisson solver to be used
-            to compute phi from rho. Accepted values are ``FFTSolver3D`` and
-            ``FFTSolver2p5D``. A Xfields solver object can also be provided.
+            to compute phi from rho. Accepted values are ``FFTSolver3D``,
+            ``FFTSolver2p5D``, ``RFFTSolver3D``, ``RFFTSolver2p5D`` and
+            ``FFTSolver2D`` (longitudinally uniform beams, see
+            ``TriLinearInterpolatedFieldMap``). A Xfields solver object can
+            also be provided.
             In case ``update_on_track``is ``False`` and ``phi`` is provided
             by the user, this argument can be omitted.
         gamma0 (float): Relativistic gamma factor of the beam. This is required
-            only if the solver is ``FFTSolver3D``.
+            only if the solver is ``FFTSolver3D`` or ``RFFTSolver3D``.
+        green_function_cache (GreenFunctionCache): If provided, the
+            transformed Green function of the solver is taken from this
+            cache when available (see ``GreenFunctionCache``).
+        spectral_gradients (bool): If ``True``, the derivatives of phi are
+            computed by the solver in Fourier space (see
+            ``TriLinearInterpolatedFieldMap``). The default is ``False``.
+        precision (str): Floating point precision of the FFT Poisson
+            solver only, either ``'double'`` (default) or ``'single'``. The
+            field map and the tracking kernels stay in double precision
+            (see ``TriLinearInterpolatedFieldMap``).
+        fft_backend (str): FFT implementation used by the Poisson solver
+            (see ``TriLinearInterpolatedFieldMap``).
+        fft_threads (int): Number of threads used by the CPU FFT backends
+            (see ``TriLinearInterpolatedFieldMap``).
+        spectral_filter (str or callable): Smoothing filter folded into the
+            transformed Green function of the solver, ``'gaussian'``,
+            ``'binomial'`` or a user-defined function (see
+            ``FFTSolver3D``). The default is ``None`` (no filter).
+        spectral_filter_width (float): Width of the spectral filter (see
+            ``FFTSolver3D``). The default is 1.
+        deposition (str): Charge deposition strategy, ``'atomic'``
+            (default), ``'private_grids'`` or ``'cell_sorted'`` (see
+            ``TriLinearInterpolatedFieldMap``).
+        n_private_grids (int): Number of private grids used by the
+            ``'private_grids'`` deposition (CPU contexts only). If ``None``
+            (default), the number of threads of the context is used (see
+            ``TriLinearInterpolatedFieldMap``).
+        cell_index (ParticleCellIndex): Particle index used by the
+            ``'cell_sorted'`` deposition. If ``None`` a new index is
+            created.
+        factorized_2p5d (bool): If ``True`` the charge density is factorized
+            in a transverse distribution and a line density, and the
+            potential is obtained from a single 2D solve (see
+            ``TriLinearInterpolatedFieldMap``).
+        gradient_layout (str): ``'separate'`` (default) or
+            ``'interleaved'``. In the latter case the kick gathers the
+            field components from a node-interleaved array (see
+            ``TriLinearInterpolatedFieldMap``).
+        shape_function (str): ``'cic'`` (default) or ``'tsc'`` (see
+            ``TriLinearInterpolatedFieldMap``).
+        record_grid_stats (bool): If ``True`` the field map records at each
+            interaction the charge deposited and dropped, the number of
+            particles out of grid and their bounding box (see
+            ``TriLinearInterpolatedFieldMap``). The default is ``False``.
+        record_timings (bool): If ``True`` the time spent at each
+            interaction in the deposition, in the Poisson solver, in the
+            computation of the gradients and in the kick is accumulated in
+            the ``timings`` dictionary (in seconds, ``'n_calls'`` counting
+            the interactions). The context is synchronized between the
+            stages. The default is ``False``.
     Returns:
         (SpaceCharge3D): A space-charge 3D beam element.
     """
@@ -89,7 +142,8 @@ class SpaceCharge3D(xt.BeamElement):
                 update_on_track=self.update_on_track,
                 length=self.length,
                 apply_z_kick=self.apply_z_kick,
-                fieldmap=self.fieldmap)
+                fieldmap=self.fieldmap,
+                record_timings=getattr(self, 'record_timings', False))
 
     def __init__(self,
                  _context=None,
@@ -106,13 +160,30 @@ class SpaceCharge3D(xt.BeamElement):
                  rho=None, phi=None,
                  solver=None,
                  gamma0=None,
-                 fftplan=None):
+                 fftplan=None,
+                 green_function_cache=None,
+                 spectral_gradients=False,
+                 precision='double',
+                 fft_backend=None,
+                 fft_threads=None,
+                 spectral_filter=None,
+                 spectral_filter_width=1.,
+                 deposition='atomic',
+                 n_private_grids=None,
+                 cell_index=None,
+                 factorized_2p5d=False,
+                 gradient_layout='separate',
+                 shape_function='cic',
+                 record_grid_stats=False,
+                 record_timings=False):
 
         self.update_on_track = update_on_track
         self.apply_z_kick = apply_z_kick
+        self.record_timings = record_timings
+        self.timings = {}
 
-        if solver=='FFTSolver3D':
-            assert gamma0 is not None, ('To use FFTSolver3D '
+        if solver in ('FFTSolver3D', 'RFFTSolver3D'):
+            assert gamma0 is not None, (f'To use {solver} '
                                         'gamma0 must be provided')
 
         if gamma0 is not None:
@@ -149,7 +220,21 @@ class SpaceCharge3D(xt.BeamElement):
                         solver=solver,
                         scale_coordinates_in_solver=scale_coordinates_in_solver,
                         updatable=update_on_track,
-                        fftplan=fftplan)
+                        fftplan=fftplan,
+                        green_function_cache=green_function_cache,
+                        spectral_gradients=spectral_gradients,
+                        precision=precision,
+                        fft_backend=fft_backend,
+                        fft_threads=fft_threads,
+                        spectral_filter=spectral_filter,
+                        spectral_filter_width=spectral_filter_width,
+                        deposition=deposition,
+                        n_private_grids=n_private_grids,
+                        cell_index=cell_index,
+                        factorized_2p5d=factorized_2p5d,
+                        gradient_layout=gradient_layout,
+                        shape_function=shape_function,
+                        record_grid_stats=record_grid_stats)
 
         self.xoinitialize(
                  _buffer=_buffer,
@@ -174,12 +259,45 @@ class SpaceCharge3D(xt.BeamElement):
             particles (Particles Object): Particles to be tracked.
         """
 
+        # Elements rebuilt from an xobject have no timing settings
+        if not getattr(self, 'record_timings', False):
+            if self.update_on_track:
+                self.fieldmap.update_from_particles(
+                    particles=particles)
+            # call C tracking kernel
+            super().track(particles)
+            self._record_interpolation_stats(particles)
+            return
+
+        timings = self.timings
+        context = self._buffer.context
         if self.update_on_track:
             self.fieldmap.update_from_particles(
-                particles=particles)
-
-        # call C tracking kernel
+                particles=particles, timings=timings)
+        t0 = _start_timer(timings, context)
         super().track(particles)
+        _record_time(timings, 'kick', context, t0)
+        timings['n_calls'] = timings.get('n_calls', 0) + 1
+        self._record_interpolation_stats(particles)
+
+    def _record_interpolation_stats(self, particles):
+
+        fieldmap = self.fieldmap
+        if not getattr(fieldmap, 'record_grid_stats', False):
+            return
+        if self.update_on_track:
+            # The kick is applied to the particles that were just deposited
+            fieldmap.interpolation_stats = {
+                kk: vv for kk, vv in fieldmap.deposition_stats.items()
+                if kk not in ('charge_deposited', 'charge_dropped')}
+        else:
+            fieldmap.record_interpolation_stats(particles=particles)
+
+    def reset_timings(self):
+        """
+        Clears the timings recorded when ``record_timings`` is ``True``.
+        """
+        self.timings.clear()
 
 
 
@@ -16,6 +16,12 @@ void SpaceCharge3D_track_local_particle(
     /*gpuglmem*/ double* dphi_dx_map = SpaceCharge3DData_getp1_fieldmap_dphi_dx(el, 0);
     /*gpuglmem*/ double* dphi_dy_map = SpaceCharge3DData_getp1_fieldmap_dphi_dy(el, 0);
     TriLinearInterpolatedFieldMapData fmap = SpaceCharge3DData_getp_fieldmap(el);
+    const int64_t interleaved = 
+            TriLinearInterpolatedFieldMapData_get_interleaved_gradients(fmap);
+    const int64_t shape_order = 
+            TriLinearInterpolatedFieldMapData_get_shape_order(fmap);
+    /*gpuglmem*/ double* dphi_map = 
+            TriLinearInterpolatedFieldMapData_getp1_dphi_interleaved(fmap, 0);
 
     //start_per_particle_block (part0->part)
 	double const x = LocalParticle_get_x(part);
@@ -28,13 +34,36 @@ void SpaceCharge3D_track_local_particle(
 	double const beta0 = LocalParticle_get_beta0(part);
 	double const gamma0 = LocalParticle_get_gamma0(part);
 
-	const IndicesAndWeights iw = 
-	    TriLinearInterpolatedFieldMap_compute_indeces_and_weights(fmap, x, y, z);
-
-   	const double dphi_dx = 
-	    TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar(dphi_dx_map, iw);
-   	const double dphi_dy = 
-	    TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar(dphi_dy_map, iw);
+	double dphi_dx, dphi_dy;
+	if (shape_order == 2){
+	    const TSCIndicesAndWeights iw = 
+	        TriLinearInterpolatedFieldMap_compute_tsc_indeces_and_weights(
+	                                                        fmap, x, y, z);
+   	    dphi_dx = 
+	        TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar_tsc(dphi_dx_map, iw);
+   	    dphi_dy = 
+	        TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar_tsc(dphi_dy_map, iw);
+	}
+	else if (interleaved){
+	    const IndicesAndWeights iw = 
+	        TriLinearInterpolatedFieldMap_compute_indeces_and_weights(
+	                                                        fmap, x, y, z);
+	    // single gather of the two components
+	    double dphi[2];
+	    TriLinearInterpolatedFieldMap_interpolate_3d_map_interleaved(
+	                                                dphi_map, iw, 2, dphi);
+	    dphi_dx = dphi[0];
+	    dphi_dy = dphi[1];
+	}
+	else{
+	    const IndicesAndWeights iw = 
+	        TriLinearInterpolatedFieldMap_compute_indeces_and_weights(
+	                                                        fmap, x, y, z);
+   	    dphi_dx = 
+	        TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar(dphi_dx_map, iw);
+   	    dphi_dy = 
+	        TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar(dphi_dy_map, iw);
+	}
 
         const double charge_mass_ratio = 
 		             chi*QELEM*q0/(mass0*QELEM/(C_LIGHT*C_LIGHT));
@@ -11,7 +11,8 @@ import xtrack as xt
 
 
 def get_electroncloud_fieldmap_from_h5(
-        filename, tau_max=None, buffer=None, ecloud_name="e-cloud"):
+        filename, tau_max=None, buffer=None, ecloud_name="e-cloud",
+        cache_coefficients=False, coefficient_cache_range=None):
     assert buffer is not None
     import h5py
     ff = h5py.File(filename, "r")
@@ -52,7 +53,9 @@ def get_electroncloud_fieldmap_from_h5(
     memory_estimate = (ix2 - ix1) * (iy2 - iy1) * (iz2 - iz1) * 8 * 8 * 1.e-9
     print(f"Creating fieldmap... (Memory estimate = {memory_estimate:.2f} GB)")
     fieldmap = xf.TriCubicInterpolatedFieldMap(x_grid=x_grid, y_grid=y_grid, z_grid=z_grid,
-                                               mirror_x=mirror2D, mirror_y=mirror2D, mirror_z=0, _buffer=buffer)
+                                               mirror_x=mirror2D, mirror_y=mirror2D, mirror_z=0, _buffer=buffer,
+                                               cache_coefficients=cache_coefficients,
+                                               coefficient_cache_range=coefficient_cache_range)
     print(f"Reading {ecloud_name}: ")
     kk = 0.
     scale = [1., fieldmap.dx, fieldmap.dy, fieldmap.dz,
@@ -89,6 +92,9 @@ def get_electroncloud_fieldmap_from_h5(
     #                 fieldmap._phi_taylor[index] = phi_slice[ix, iy, ll] * scale[ll]
     ##########################################################################
 
+    # The cached coefficients are computed from the loaded phi_taylor
+    fieldmap.update_coefficient_cache()
+
     return fieldmap
 
 
@@ -147,18 +153,20 @@ def config_electronclouds(line, twiss=None, ecloud_info=None, shift_to_closed_or
 
 def electroncloud_dipolar_kicks_of_fieldmap(fieldmap=None, p0c=None):
 
-    assert p0c is not None
+    # The kicks are evaluated directly on the field map, p0c is not used and
+    # is kept only for backward compatibility
     assert fieldmap is not None
 
-    part = xp.Particles(p0c=p0c)
-    ecloud = xf.ElectronCloud(
-        length=1,
-        fieldmap=fieldmap,
-        _buffer=fieldmap._buffer)
-    ecloud.track(part)
-    px = part.px[0]
-    py = part.py[0]
-    ptau = part.ptau[0]
+    # Kicks of a unit-length element on the reference particle
+    context = fieldmap._buffer.context
+    zero = context.zeros(1, dtype=np.float64)
+    dphi_dx, dphi_dy, dphi_dz = [
+            context.nparray_from_context_array(vv)[0]
+            for vv in fieldmap.get_values_at_points(
+                        x=zero, y=zero, z=zero, return_phi=False)]
+    px = -dphi_dx
+    py = -dphi_dy
+    ptau = -dphi_dz
     return [px, py, ptau]
 
 
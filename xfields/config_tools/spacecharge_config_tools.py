@@ -114,6 +114,9 @@ class PICCollection:
                  n_lims_y,
                  solver='FFTSolver2p5D',
                  apply_z_kick=False,
+                 green_function_cache=None,
+                 spectral_filter=None,
+                 spectral_filter_width=1.,
                  _context=None,
                  _buffer=None,
                      ):
@@ -128,6 +131,9 @@ class PICCollection:
         self.z_range = z_range
         self.solver = solver
         self.apply_z_kick = apply_z_kick
+        self.green_function_cache = green_function_cache
+        self.spectral_filter = spectral_filter
+        self.spectral_filter_width = spectral_filter_width
 
         self.x_lims = np.linspace(x_lim_min, x_lim_max, n_lims_x)
         self.y_lims = np.linspace(y_lim_min, y_lim_max, n_lims_y)
@@ -160,7 +166,10 @@ class PICCollection:
                 z_range=self.z_range,
                 nx=self.nx_grid, ny=self.ny_grid, nz=self.nz_grid,
                 solver=self.solver,
-                fftplan=self._fftplan)
+                fftplan=self._fftplan,
+                green_function_cache=self.green_function_cache,
+                spectral_filter=self.spectral_filter,
+                spectral_filter_width=self.spectral_filter_width)
             new_pic._buffer.grow(10*1024**2) # Add 10 MB for sc copies
             if self._fftplan is None:
                 self._fftplan = new_pic.fieldmap.solver.fftplan
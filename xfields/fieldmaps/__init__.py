@@ -5,4 +5,6 @@
 
 from .interpolated import TriLinearInterpolatedFieldMap
 from .tricubicinterpolated import TriCubicInterpolatedFieldMap
+from .bicubicinterpolated import BiCubicInterpolatedFieldMap
+from .cell_index import ParticleCellIndex
 from .bigaussian import BiGaussianFieldMap, mean_and_std
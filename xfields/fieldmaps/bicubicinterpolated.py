@@ -0,0 +1,297 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import numpy as np
+
+import xobjects as xo
+
+from .interpolated import _configure_grid
+from ..general import _pkg_root
+
+_BiCubicInterpolatedFieldMap_kernels = {
+    'BiCubicInterpolatedFieldMap_phi_taylor_from_phi': xo.Kernel(
+        args=[
+            xo.Arg(xo.ThisClass, pointer=False, name='fmap'),
+            xo.Arg(xo.Int64,   pointer=False, name='n_nodes'),
+            xo.Arg(xo.Float64, pointer=True,  name='phi'),
+            ],
+        n_threads='n_nodes'
+        ),
+    'BiCubicInterpolatedFieldMap_interpolate_vector': xo.Kernel(
+        args=[
+            xo.Arg(xo.ThisClass, pointer=False, name='fmap'),
+            xo.Arg(xo.Int64,   pointer=False, name='n_points'),
+            xo.Arg(xo.Float64, pointer=True,  name='x'),
+            xo.Arg(xo.Float64, pointer=True,  name='y'),
+            xo.Arg(xo.Int64,   pointer=False, name='return_phi'),
+            xo.Arg(xo.Int64,   pointer=False, name='return_dphi_dx'),
+            xo.Arg(xo.Int64,   pointer=False, name='return_dphi_dy'),
+            xo.Arg(xo.Float64, pointer=True,  name='out'),
+            ],
+        n_threads='n_points'
+        ),
+    }
+
+
+class BiCubicInterpolatedFieldMap(xo.HybridClass):
+
+    """
+    Builds a bicubic interpolator for a 2D (transverse) field map, for
+    fields that do not depend on the longitudinal coordinate.
+
+    Args:
+        context (xobjects context): identifies the :doc:`context <contexts>`
+            on which the computation is executed.
+        x_range (tuple): Horizontal extent (in meters) of the
+            computing grid.
+        y_range (tuple): Vertical extent (in meters) of the
+            computing grid.
+        nx (int): Number of cells in the horizontal direction.
+        ny (int): Number of cells in the vertical direction.
+        dx (float): Horizontal cell size in meters. It can be
+            provided alternatively to ``nx``.
+        dy (float): Vertical cell size in meters. It can be
+            provided alternatively to ``ny``.
+        x_grid (np.ndarray): Equispaced array with the horizontal grid points
+            (cell centers).
+            It can be provided alternatively to ``x_range``, ``dx``/``nx``.
+        y_grid (np.ndarray): Equispaced array with the vertical grid points
+            (cell centers).
+            It can be provided alternatively to ``y_range``, ``dy``/``ny``.
+        mirror_x (int): if equal to 1, the map is mirrored along the x axis
+            around x = 0.
+        mirror_y (int): if equal to 1, the map is mirrored along the y axis
+            around y = 0.
+        phi_taylor (np.ndarray): Normalized scalar potential and its
+            derivatives at the grid points. Should be of dimension
+            (nx, ny, 4). For the last index: 0 -> phi, 1 -> dphi/dx,
+            2 -> dphi/dy, 3 -> d^2phi/dxdy. The derivatives are normalized
+            in the sense that they should be multiplied with the grid's step
+            size, e.g. (d^2phi/dxdy)* (Δx*Δy). Units are Volts. If not
+            provided, phi_taylor will be calculated from phi.
+        phi (np.ndarray): electric potential at the grid points in Volts,
+            with shape (nx, ny).
+        updatable (bool): If ``True`` the field map can be updated after
+            creation. Default is ``True``.
+    Returns:
+        (BiCubicInterpolatedFieldMap): Interpolator object.
+    """
+
+    _xofields = {
+        'x_min': xo.Float64,
+        'y_min': xo.Float64,
+        'nx': xo.Int64,
+        'ny': xo.Int64,
+        'mirror_x': xo.Int64,
+        'mirror_y': xo.Int64,
+        'dx': xo.Float64,
+        'dy': xo.Float64,
+        'phi_taylor': xo.Float64[:],
+    }
+
+    # I add undescores in front of the names so that I can define custom
+    # properties
+    _rename = {nn: '_'+nn for nn in _xofields}
+
+    _extra_c_sources = [
+        _pkg_root.joinpath('headers/constants.h'),
+        _pkg_root.joinpath('fieldmaps/interpolated_src/bicubic_interpolators.h'),
+        ]
+
+    _kernels = _BiCubicInterpolatedFieldMap_kernels
+
+
+    def __init__(self,
+                 _context=None,
+                 _buffer=None,
+                 _offset=None,
+                 _xobject=None,
+                 x_range=None, y_range=None,
+                 nx=None, ny=None,
+                 dx=None, dy=None,
+                 x_grid=None, y_grid=None,
+                 mirror_x=0, mirror_y=0,
+                 phi=None,
+                 phi_taylor=None,
+                 updatable=True,
+                 ):
+
+        if _xobject is not None:
+            self.xoinitialize(_xobject=_xobject, _context=_context,
+                             _buffer=_buffer, _offset=_offset)
+            return
+
+        self.updatable = updatable
+
+        self._x_grid = _configure_grid('x', x_grid, dx, x_range, nx)
+        self._y_grid = _configure_grid('y', y_grid, dy, y_range, ny)
+
+        self.xoinitialize(
+                 _context=_context,
+                 _buffer=_buffer,
+                 _offset=_offset,
+                 x_min = self._x_grid[0],
+                 y_min = self._y_grid[0],
+                 nx = self.nx,
+                 ny = self.ny,
+                 dx = self.dx,
+                 dy = self.dy,
+                 mirror_x = mirror_x,
+                 mirror_y = mirror_y,
+                 phi_taylor = self.nx*self.ny*4,
+                 )
+
+        self.compile_kernels(only_if_needed=True)
+
+        if phi_taylor is not None:
+            phi_taylor = np.asarray(phi_taylor)
+            assert phi_taylor.shape == (self.nx, self.ny, 4)
+            self._phi_taylor[:] = self._buffer.context.nparray_to_context_array(
+                    np.ascontiguousarray(phi_taylor.transpose(1, 0, 2)).ravel())
+        elif phi is not None:
+            self.update_phi(phi, force=True)
+
+    def _assert_updatable(self):
+        assert self.updatable, 'This FieldMap is not updatable!'
+
+    def get_values_at_points(self,
+            x, y,
+            return_phi=True,
+            return_dphi_dx=True,
+            return_dphi_dy=True,
+            out=None):
+
+        """
+        Returns the field potential and its derivatives at the points
+        specified by x, y in a single kernel launch. The output can be
+        customized (see below). Zeros are returned for points outside the
+        grid.
+
+        Args:
+            x (float64 array): Horizontal coordinates at which the field is evaluated.
+            y (float64 array): Vertical coordinates at which the field is evaluated.
+            return_phi (bool): If ``True``, the potential at the given points is returned.
+            return_dphi_dx (bool): If ``True``, the horizontal derivative of the potential
+                at the given points is returned.
+            return_dphi_dy: If ``True``, the vertical derivative of the potential
+                at the given points is returned.
+            out (float64 array): Array of the context with
+                ``n_quantities * len(x)`` elements in which the result is
+                written, to avoid allocating it at each call. The returned
+                arrays are views of it.
+        Returns:
+            (tuple of float64 array): The required quantities at the provided points.
+        """
+
+        assert len(x) == len(y)
+
+        context = self._buffer.context
+        n_points = len(x)
+        selection = (return_phi, return_dphi_dx, return_dphi_dy)
+        n_quantities = sum(bool(ss) for ss in selection)
+
+        if out is None:
+            buffer_out = context.zeros(
+                    shape=(n_quantities * n_points,), dtype=np.float64)
+        else:
+            assert out.dtype == np.float64
+            assert out.size == n_quantities * n_points, (
+                f'out must have {n_quantities * n_points} elements')
+            buffer_out = out.reshape(-1)
+
+        if n_quantities > 0 and n_points > 0:
+            context.kernels.BiCubicInterpolatedFieldMap_interpolate_vector(
+                    fmap=self._xobject,
+                    n_points=n_points,
+                    x=x, y=y,
+                    return_phi=int(bool(return_phi)),
+                    return_dphi_dx=int(bool(return_dphi_dx)),
+                    return_dphi_dy=int(bool(return_dphi_dy)),
+                    out=buffer_out)
+
+        # Split buffer
+        particles_quantities = [buffer_out[ii*n_points:(ii+1)*n_points]
+                                        for ii in range(n_quantities)]
+
+        return particles_quantities
+
+    def update_phi(self, phi, reset=True, force=False):
+
+        """
+        Updates the potential on the grid. The Taylor components stored in
+        ``phi_taylor`` are computed from it on the device in a single pass
+        (derivatives from central differences, set to zero on the boundary
+        lines of the grid).
+
+        Args:
+            phi (float64 array): Potential at the grid points, with shape
+                (nx, ny). It can be a numpy array or an array of the
+                context.
+            reset (bool): If ``True`` the stored potential is overwritten
+                with the provided one. If ``False`` the provided potential
+                is added to the stored one. The default is ``True``.
+            force (bool): If ``True`` the potential is updated even if the
+                map is declared as not updateable. The default is ``False``.
+        """
+
+        if not force:
+            self._assert_updatable()
+
+        if not reset:
+            raise ValueError('Not implemented!')
+
+        assert tuple(phi.shape) == (self.nx, self.ny)
+
+        context = self._buffer.context
+
+        phi = phi.ravel(order='F')
+        if isinstance(phi, np.ndarray):
+            phi = context.nparray_to_context_array(
+                                    np.ascontiguousarray(phi, dtype=np.float64))
+
+        context.kernels.BiCubicInterpolatedFieldMap_phi_taylor_from_phi(
+                fmap=self._xobject, n_nodes=len(phi), phi=phi)
+
+    @property
+    def x_grid(self):
+        """
+        Array with the horizontal grid points (cell centers).
+        """
+        return self._x_grid
+
+    @property
+    def y_grid(self):
+        """
+        Array with the vertical grid points (cell centers).
+        """
+        return self._y_grid
+
+    @property
+    def nx(self):
+        """
+        Number of cells in the horizontal direction.
+        """
+        return len(self.x_grid)
+
+    @property
+    def ny(self):
+        """
+        Number of cells in the vertical direction.
+        """
+        return len(self.y_grid)
+
+    @property
+    def dx(self):
+        """
+        Horizontal cell size in meters.
+        """
+        return self.x_grid[1] - self.x_grid[0]
+
+    @property
+    def dy(self):
+        """
+        Vertical cell size in meters.
+        """
+        return self.y_grid[1] - self.y_grid[0]
@@ -0,0 +1,87 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import xobjects as xo
+
+from ..general import _get_num_particles_to_process
+
+
+class ParticleCellIndex:
+
+    '''
+    Index of the particles sorted by the grid cell in which they are
+    located, used by the ``'cell_sorted'`` charge deposition of
+    ``TriLinearInterpolatedFieldMap``. The index is built with a counting
+    sort the first time and is then updated incrementally: at each update
+    the particles are re-sorted starting from the previous ordering, which
+    is almost sorted as the particles move by a small fraction of a cell
+    between consecutive updates. Each update recomputes the cells and
+    re-sorts the particles, also when neither the particles nor the grid
+    have changed.
+
+    Returns:
+        (ParticleCellIndex): Index object.
+    '''
+
+    def __init__(self):
+        self.cell_index = None
+        self.sorted_particles = None
+        self.cell_start = None
+        self.n_full_sorts = 0
+        self.n_incremental_updates = 0
+
+    def update(self, fieldmap, particles):
+
+        '''
+        Computes the cell of each particle on the grid of the given field
+        map and updates the ordering.
+
+        Args:
+            fieldmap (TriLinearInterpolatedFieldMap): Field map defining the
+                grid.
+            particles (xtrack.Particles): Particles to be binned.
+        '''
+
+        context = fieldmap._buffer.context
+        if isinstance(context, xo.ContextPyopencl):
+            raise NotImplementedError(
+                'The cell index is not available on pyopencl contexts')
+        nplike = context.nplike_lib
+
+        n_particles = _get_num_particles_to_process(particles)
+        n_cells = fieldmap.nx * fieldmap.ny * fieldmap.nz
+
+        if self.cell_index is None or len(self.cell_index) != n_particles:
+            self.cell_index = context.zeros(n_particles, dtype=nplike.int64)
+            self.sorted_particles = None
+
+        context.kernels.p2m_cell_index_xparticles(
+                nparticles=n_particles,
+                particles=particles,
+                x0=fieldmap.x_grid[0], y0=fieldmap.y_grid[0],
+                z0=fieldmap.z_grid[0],
+                dx=fieldmap.dx, dy=fieldmap.dy, dz=fieldmap.dz,
+                nx=fieldmap.nx, ny=fieldmap.ny, nz=fieldmap.nz,
+                cell_index=self.cell_index)
+
+        # Counting (cells outside the grid and lost particles are binned
+        # in the last bin, which is not used by the deposition)
+        counts = nplike.bincount(self.cell_index, minlength=n_cells + 1)
+        if self.cell_start is None or len(self.cell_start) != n_cells + 1:
+            self.cell_start = context.zeros(n_cells + 1, dtype=nplike.int64)
+        self.cell_start[1:] = nplike.cumsum(counts[:n_cells])
+
+        if self.sorted_particles is None:
+            self.sorted_particles = nplike.argsort(self.cell_index,
+                                                   kind='stable')
+            self.n_full_sorts += 1
+        else:
+            # The stable sort is adaptive, hence it takes close to linear
+            # time on the almost sorted keys
+            keys = self.cell_index[self.sorted_particles]
+            if not bool(nplike.all(keys[1:] >= keys[:-1])):
+                self.sorted_particles = self.sorted_particles[
+                                        nplike.argsort(keys, kind='stable')]
+            self.n_incremental_updates += 1
@@ -3,14 +3,19 @@
 # Copyright (c) CERN, 2021.                   #
 # ########################################### #
 
+from collections import OrderedDict
+
 import numpy as np
 
 import xobjects as xo
 import xpart as xp
 import xtrack as xt
 
-from ..solvers.fftsolvers import FFTSolver3D, FFTSolver2p5D
-from ..general import _pkg_root
+from ..solvers.fftsolvers import FFTSolver2D, FFTSolver3D, FFTSolver2p5D
+from ..solvers.fftsolvers import RFFTSolver3D, RFFTSolver2p5D
+from .cell_index import ParticleCellIndex
+from ..general import _pkg_root, _get_num_particles_to_process
+from ..general import _start_timer, _record_time
 
 _TriLinearInterpolatedFielmap_kernels = {
     'central_diff': xo.Kernel(
@@ -26,6 +31,37 @@ _TriLinearInterpolatedFielmap_kernels = {
             ],
         n_threads='nelem'
         ),
+    'central_diff_3d': xo.Kernel(
+        args=[
+            xo.Arg(xo.Int64,   pointer=False, name='nelem'),
+            xo.Arg(xo.Int32,   pointer=False, name='nx'),
+            xo.Arg(xo.Int32,   pointer=False, name='ny'),
+            xo.Arg(xo.Int32,   pointer=False, name='nz'),
+            xo.Arg(xo.Float64, pointer=False, name='factor_x'),
+            xo.Arg(xo.Float64, pointer=False, name='factor_y'),
+            xo.Arg(xo.Float64, pointer=False, name='factor_z'),
+            xo.Arg(xo.Int32,   pointer=False, name='compute_x'),
+            xo.Arg(xo.Int32,   pointer=False, name='compute_y'),
+            xo.Arg(xo.Int32,   pointer=False, name='compute_z'),
+            xo.Arg(xo.Int8,    pointer=True,  name='buffer'),
+            xo.Arg(xo.Int64,   pointer=False, name='phi_offset'),
+            xo.Arg(xo.Int64,   pointer=False, name='dphi_dx_offset'),
+            xo.Arg(xo.Int64,   pointer=False, name='dphi_dy_offset'),
+            xo.Arg(xo.Int64,   pointer=False, name='dphi_dz_offset'),
+            ],
+        n_threads='nelem'
+        ),
+    'interleave_gradients': xo.Kernel(
+        args=[
+            xo.Arg(xo.Int64,   pointer=False, name='nelem'),
+            xo.Arg(xo.Int8,    pointer=True,  name='buffer'),
+            xo.Arg(xo.Int64,   pointer=False, name='dphi_dx_offset'),
+            xo.Arg(xo.Int64,   pointer=False, name='dphi_dy_offset'),
+            xo.Arg(xo.Int64,   pointer=False, name='dphi_dz_offset'),
+            xo.Arg(xo.Int64,   pointer=False, name='interleaved_offset'),
+            ],
+        n_threads='nelem'
+        ),
     'p2m_rectmesh3d_xparticles': xo.Kernel(
         args=[
             xo.Arg(xo.Int32,   pointer=False, name='nparticles'),
@@ -44,6 +80,24 @@ _TriLinearInterpolatedFielmap_kernels = {
             ],
         n_threads='nparticles'
         ),
+    'p2m_rectmesh3d_xparticles_tsc': xo.Kernel(
+        args=[
+            xo.Arg(xo.Int32,   pointer=False, name='nparticles'),
+            xo.Arg(xp.Particles, pointer=False, name='particles'),
+            xo.Arg(xo.Float64, pointer=False, name='x0'),
+            xo.Arg(xo.Float64, pointer=False, name='y0'),
+            xo.Arg(xo.Float64, pointer=False, name='z0'),
+            xo.Arg(xo.Float64, pointer=False, name='dx'),
+            xo.Arg(xo.Float64, pointer=False, name='dy'),
+            xo.Arg(xo.Float64, pointer=False, name='dz'),
+            xo.Arg(xo.Int32,   pointer=False, name='nx'),
+            xo.Arg(xo.Int32,   pointer=False, name='ny'),
+            xo.Arg(xo.Int32,   pointer=False, name='nz'),
+            xo.Arg(xo.Int8,    pointer=True,  name='grid1d_buffer'),
+            xo.Arg(xo.Int64,   pointer=False, name='grid1d_offset'),
+            ],
+        n_threads='nparticles'
+        ),
     'p2m_rectmesh3d': xo.Kernel(
         args=[
             xo.Arg(xo.Int32,   pointer=False, name='nparticles'),
@@ -66,6 +120,199 @@ _TriLinearInterpolatedFielmap_kernels = {
             ],
         n_threads='nparticles'
         ),
+    'p2m_rectmesh3d_tsc': xo.Kernel(
+        args=[
+            xo.Arg(xo.Int32,   pointer=False, name='nparticles'),
+            xo.Arg(xo.Float64, pointer=True, name='x'),
+            xo.Arg(xo.Float64, pointer=True, name='y'),
+            xo.Arg(xo.Float64, pointer=True, name='z'),
+            xo.Arg(xo.Float64, pointer=True, name='part_weights'),
+            xo.Arg(xo.Int64,   pointer=True, name='part_state'),
+            xo.Arg(xo.Float64, pointer=False, name='x0'),
+            xo.Arg(xo.Float64, pointer=False, name='y0'),
+            xo.Arg(xo.Float64, pointer=False, name='z0'),
+            xo.Arg(xo.Float64, pointer=False, name='dx'),
+            xo.Arg(xo.Float64, pointer=False, name='dy'),
+            xo.Arg(xo.Float64, pointer=False, name='dz'),
+            xo.Arg(xo.Int32,   pointer=False, name='nx'),
+            xo.Arg(xo.Int32,   pointer=False, name='ny'),
+            xo.Arg(xo.Int32,   pointer=False, name='nz'),
+            xo.Arg(xo.Int8,    pointer=True,  name='grid1d_buffer'),
+            xo.Arg(xo.Int64,   pointer=False, name='grid1d_offset'),
+            ],
+        n_threads='nparticles'
+        ),
+    'p2m_rectmesh3d_xparticles_private_grids': xo.Kernel(
+        args=[
+            xo.Arg(xo.Int32,   pointer=False, name='nparticles'),
+            xo.Arg(xp.Particles, pointer=False, name='particles'),
+            xo.Arg(xo.Float64, pointer=False, name='x0'),
+            xo.Arg(xo.Float64, pointer=False, name='y0'),
+            xo.Arg(xo.Float64, pointer=False, name='z0'),
+            xo.Arg(xo.Float64, pointer=False, name='dx'),
+            xo.Arg(xo.Float64, pointer=False, name='dy'),
+            xo.Arg(xo.Float64, pointer=False, name='dz'),
+            xo.Arg(xo.Int32,   pointer=False, name='nx'),
+            xo.Arg(xo.Int32,   pointer=False, name='ny'),
+            xo.Arg(xo.Int32,   pointer=False, name='nz'),
+            xo.Arg(xo.Int32,   pointer=False, name='shape_order'),
+            xo.Arg(xo.Int32,   pointer=False, name='n_grids'),
+            xo.Arg(xo.Float64, pointer=True,  name='grids'),
+            ],
+        n_threads='n_grids'
+        ),
+    'p2m_rectmesh3d_private_grids': xo.Kernel(
+        args=[
+            xo.Arg(xo.Int32,   pointer=False, name='nparticles'),
+            xo.Arg(xo.Float64, pointer=True, name='x'),
+            xo.Arg(xo.Float64, pointer=True, name='y'),
+            xo.Arg(xo.Float64, pointer=True, name='z'),
+            xo.Arg(xo.Float64, pointer=True, name='part_weights'),
+            xo.Arg(xo.Int64,   pointer=True, name='part_state'),
+            xo.Arg(xo.Float64, pointer=False, name='x0'),
+            xo.Arg(xo.Float64, pointer=False, name='y0'),
+            xo.Arg(xo.Float64, pointer=False, name='z0'),
+            xo.Arg(xo.Float64, pointer=False, name='dx'),
+            xo.Arg(xo.Float64, pointer=False, name='dy'),
+            xo.Arg(xo.Float64, pointer=False, name='dz'),
+            xo.Arg(xo.Int32,   pointer=False, name='nx'),
+            xo.Arg(xo.Int32,   pointer=False, name='ny'),
+            xo.Arg(xo.Int32,   pointer=False, name='nz'),
+            xo.Arg(xo.Int32,   pointer=False, name='shape_order'),
+            xo.Arg(xo.Int32,   pointer=False, name='n_grids'),
+            xo.Arg(xo.Float64, pointer=True,  name='grids'),
+            ],
+        n_threads='n_grids'
+        ),
+    'p2m_cell_index_xparticles': xo.Kernel(
+        args=[
+            xo.Arg(xo.Int32,   pointer=False, name='nparticles'),
+            xo.Arg(xp.Particles, pointer=False, name='particles'),
+            xo.Arg(xo.Float64, pointer=False, name='x0'),
+            xo.Arg(xo.Float64, pointer=False, name='y0'),
+            xo.Arg(xo.Float64, pointer=False, name='z0'),
+            xo.Arg(xo.Float64, pointer=False, name='dx'),
+            xo.Arg(xo.Float64, pointer=False, name='dy'),
+            xo.Arg(xo.Float64, pointer=False, name='dz'),
+            xo.Arg(xo.Int32,   pointer=False, name='nx'),
+            xo.Arg(xo.Int32,   pointer=False, name='ny'),
+            xo.Arg(xo.Int32,   pointer=False, name='nz'),
+            xo.Arg(xo.Int64,   pointer=True,  name='cell_index'),
+            ],
+        n_threads='nparticles'
+        ),
+    'p2m_rectmesh3d_xparticles_cell_sorted': xo.Kernel(
+        args=[
+            xo.Arg(xo.Int64,   pointer=False, name='n_nodes'),
+            xo.Arg(xp.Particles, pointer=False, name='particles'),
+            xo.Arg(xo.Int64,   pointer=True,  name='sorted_particles'),
+            xo.Arg(xo.Int64,   pointer=True,  name='cell_start'),
+            xo.Arg(xo.Float64, pointer=False, name='x0'),
+            xo.Arg(xo.Float64, pointer=False, name='y0'),
+            xo.Arg(xo.Float64, pointer=False, name='z0'),
+            xo.Arg(xo.Float64, pointer=False, name='dx'),
+            xo.Arg(xo.Float64, pointer=False, name='dy'),
+            xo.Arg(xo.Float64, pointer=False, name='dz'),
+            xo.Arg(xo.Int32,   pointer=False, name='nx'),
+            xo.Arg(xo.Int32,   pointer=False, name='ny'),
+            xo.Arg(xo.Int32,   pointer=False, name='nz'),
+            xo.Arg(xo.Int8,    pointer=True,  name='grid1d_buffer'),
+            xo.Arg(xo.Int64,   pointer=False, name='grid1d_offset'),
+            ],
+        n_threads='n_nodes'
+        ),
+    'p2m_rectmesh2p5d_xparticles': xo.Kernel(
+        args=[
+            xo.Arg(xo.Int32,   pointer=False, name='nparticles'),
+            xo.Arg(xp.Particles, pointer=False, name='particles'),
+            xo.Arg(xo.Float64, pointer=False, name='x0'),
+            xo.Arg(xo.Float64, pointer=False, name='y0'),
+            xo.Arg(xo.Float64, pointer=False, name='z0'),
+            xo.Arg(xo.Float64, pointer=False, name='dx'),
+            xo.Arg(xo.Float64, pointer=False, name='dy'),
+            xo.Arg(xo.Float64, pointer=False, name='dz'),
+            xo.Arg(xo.Int32,   pointer=False, name='nx'),
+            xo.Arg(xo.Int32,   pointer=False, name='ny'),
+            xo.Arg(xo.Int32,   pointer=False, name='nz'),
+            xo.Arg(xo.Float64, pointer=True,  name='grid2d'),
+            xo.Arg(xo.Float64, pointer=True,  name='line_density'),
+            ],
+        n_threads='nparticles'
+        ),
+    'p2m_rectmesh2p5d': xo.Kernel(
+        args=[
+            xo.Arg(xo.Int32,   pointer=False, name='nparticles'),
+            xo.Arg(xo.Float64, pointer=True, name='x'),
+            xo.Arg(xo.Float64, pointer=True, name='y'),
+            xo.Arg(xo.Float64, pointer=True, name='z'),
+            xo.Arg(xo.Float64, pointer=True, name='part_weights'),
+            xo.Arg(xo.Int64,   pointer=True, name='part_state'),
+            xo.Arg(xo.Float64, pointer=False, name='x0'),
+            xo.Arg(xo.Float64, pointer=False, name='y0'),
+            xo.Arg(xo.Float64, pointer=False, name='z0'),
+            xo.Arg(xo.Float64, pointer=False, name='dx'),
+            xo.Arg(xo.Float64, pointer=False, name='dy'),
+            xo.Arg(xo.Float64, pointer=False, name='dz'),
+            xo.Arg(xo.Int32,   pointer=False, name='nx'),
+            xo.Arg(xo.Int32,   pointer=False, name='ny'),
+            xo.Arg(xo.Int32,   pointer=False, name='nz'),
+            xo.Arg(xo.Float64, pointer=True,  name='grid2d'),
+            xo.Arg(xo.Float64, pointer=True,  name='line_density'),
+            ],
+        n_threads='nparticles'
+        ),
+    'reduce_private_grids': xo.Kernel(
+        args=[
+            xo.Arg(xo.Int64,   pointer=False, name='n_cells'),
+            xo.Arg(xo.Int32,   pointer=False, name='n_grids'),
+            xo.Arg(xo.Float64, pointer=True,  name='grids'),
+            xo.Arg(xo.Int8,    pointer=True,  name='grid1d_buffer'),
+            xo.Arg(xo.Int64,   pointer=False, name='grid1d_offset'),
+            ],
+        n_threads='n_cells'
+        ),
+    'p2m_grid_stats_xparticles': xo.Kernel(
+        args=[
+            xo.Arg(xo.Int32,   pointer=False, name='nparticles'),
+            xo.Arg(xp.Particles, pointer=False, name='particles'),
+            xo.Arg(xo.Float64, pointer=False, name='x0'),
+            xo.Arg(xo.Float64, pointer=False, name='y0'),
+            xo.Arg(xo.Float64, pointer=False, name='z0'),
+            xo.Arg(xo.Float64, pointer=False, name='dx'),
+            xo.Arg(xo.Float64, pointer=False, name='dy'),
+            xo.Arg(xo.Float64, pointer=False, name='dz'),
+            xo.Arg(xo.Int32,   pointer=False, name='nx'),
+            xo.Arg(xo.Int32,   pointer=False, name='ny'),
+            xo.Arg(xo.Int32,   pointer=False, name='nz'),
+            xo.Arg(xo.Int32,   pointer=False, name='shape_order'),
+            xo.Arg(xo.Int32,   pointer=False, name='n_chunks'),
+            xo.Arg(xo.Float64, pointer=True,  name='stats'),
+            ],
+        n_threads='n_chunks'
+        ),
+    'p2m_grid_stats': xo.Kernel(
+        args=[
+            xo.Arg(xo.Int32,   pointer=False, name='nparticles'),
+            xo.Arg(xo.Float64, pointer=True, name='x'),
+            xo.Arg(xo.Float64, pointer=True, name='y'),
+            xo.Arg(xo.Float64, pointer=True, name='z'),
+            xo.Arg(xo.Float64, pointer=True, name='part_weights'),
+            xo.Arg(xo.Int64,   pointer=True, name='part_state'),
+            xo.Arg(xo.Float64, pointer=False, name='x0'),
+            xo.Arg(xo.Float64, pointer=False, name='y0'),
+            xo.Arg(xo.Float64, pointer=False, name='z0'),
+            xo.Arg(xo.Float64, pointer=False, name='dx'),
+            xo.Arg(xo.Float64, pointer=False, name='dy'),
+            xo.Arg(xo.Float64, pointer=False, name='dz'),
+            xo.Arg(xo.Int32,   pointer=False, name='nx'),
+            xo.Arg(xo.Int32,   pointer=False, name='ny'),
+            xo.Arg(xo.Int32,   pointer=False, name='nz'),
+            xo.Arg(xo.Int32,   pointer=False, name='shape_order'),
+            xo.Arg(xo.Int32,   pointer=False, name='n_chunks'),
+            xo.Arg(xo.Float64, pointer=True,  name='stats'),
+            ],
+        n_threads='n_chunks'
+        ),
     'TriLinearInterpolatedFieldMap_interpolate_3d_map_vector': xo.Kernel(
         args=[
             xo.Arg(xo.ThisClass, pointer=False, name='fmap'),
@@ -83,6 +330,9 @@ _TriLinearInterpolatedFielmap_kernels = {
     }
 
 
+_shape_orders = {'cic': 1, 'tsc': 2}
+
+
 class TriLinearInterpolatedFieldMap(xo.HybridClass):
 
     """
@@ -122,8 +372,12 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
             Volts. If not provided the ``phi`` is calculated from ``rho``
             using the Poisson solver (if available).
         solver (str or solver object): Defines the Poisson solver to be used
-            to compute phi from rho. Accepted values are ``FFTSolver3D`` and
-            ``FFTSolver2p5D``. A Xfields solver object can also be provided.
+            to compute phi from rho. Accepted values are ``FFTSolver3D``,
+            ``FFTSolver2p5D``, ``RFFTSolver3D``, ``RFFTSolver2p5D`` and
+            ``FFTSolver2D``. A Xfields solver object can also be provided.
+            With ``FFTSolver2D`` the map is taken as longitudinally uniform:
+            phi is computed from the charge density averaged over z and is
+            the same on all z planes.
             In case ``update_on_track``is ``False`` and ``phi`` is provided
             by the user, this argument can be omitted.
         scale_coordinates_in_solver (tuple): Three coefficients used to rescale
@@ -131,6 +385,94 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
             (1.,1.,1.).
         updatable (bool): If ``True`` the field map can be updated after
             creation. Default is ``True``.
+        green_function_cache (GreenFunctionCache): If provided, the
+            transformed Green function of the solver is taken from this
+            cache when available (see ``GreenFunctionCache``).
+        spectral_gradients (bool): If ``True``, the derivatives of phi are
+            computed by the solver in Fourier space (exact central
+            differences, also at the grid edges) instead of being computed
+            from phi on the grid. Available on CPU and cupy contexts. The
+            default is ``False``.
+        precision (str): Floating point precision of the FFT Poisson
+            solver only, either ``'double'`` (default) or ``'single'``. The
+            field map itself (rho, phi and its derivatives) and the
+            deposition and interpolation kernels always work in double
+            precision: the potential computed in single precision is
+            converted to double when stored in the map. The map arrays are
+            members of the xobjects struct read by the C kernels of the
+            beam elements (e.g. ``SpaceCharge3D``, ``ElectronCloud``), whose
+            layout is fixed to Float64, and keeping rho in double precision
+            lets the deposition accumulate the charge without rounding.
+            The saving comes from the solver workspace, which dominates the
+            memory traffic and is halved in single precision.
+        fft_backend (str): FFT implementation used by the solver. If
+            ``None`` (default) the one of the context is used. On CPU
+            contexts ``'scipy'`` and ``'fftw'`` provide multi-threaded
+            transforms (see ``FFTSolver3D``).
+        fft_threads (int): Number of threads used by the CPU FFT backends.
+            If ``None`` (default), the ``omp_num_threads`` of the context is
+            used.
+        spectral_filter (str or callable): Smoothing filter folded into the
+            transformed Green function of the solver (``'gaussian'``,
+            ``'binomial'`` or a user-defined function, see
+            ``FFTSolver3D``). It reduces the noise of the potential without
+            any cost per solve. The default is ``None`` (no filter).
+        spectral_filter_width (float): Width of the spectral filter (rms
+            length in cells for ``'gaussian'``, number of passes for
+            ``'binomial'``). The default is 1.
+        deposition (str): Charge deposition strategy. With ``'atomic'``
+            (default) all threads deposit on ``rho`` using atomic additions.
+            With ``'private_grids'`` the particles are split in
+            ``n_private_grids`` chunks, each deposited without atomics on its
+            own grid, and the grids are then summed cell by cell. This
+            avoids the contention on the densely populated cells and gives
+            a charge density that does not depend on the number of threads.
+            With ``'cell_sorted'`` the particles are sorted by cell (see
+            ``ParticleCellIndex``) and each grid node gathers the charge of
+            the particles in the surrounding cells, without atomics and
+            with sequential accesses to the grid. This strategy applies to
+            the deposition from particles objects, the deposition from
+            coordinate arrays being done with atomics.
+        n_private_grids (int): Number of private grids used by the
+            ``'private_grids'`` deposition, which is available only on CPU
+            contexts. Each grid takes nx*ny*nz doubles, allocated at the
+            first deposition. It should be at least the number of threads.
+            If ``None`` (default), ``context.omp_num_threads`` is used (at
+            least one); a fixed value gives a charge density that does not
+            depend on the number of threads of the context.
+        cell_index (ParticleCellIndex): Index used by the ``'cell_sorted'``
+            deposition. If ``None`` a new index is created.
+        factorized_2p5d (bool): If ``True`` the charge density is taken as
+            the product of a transverse distribution and of a line density,
+            which are deposited on a 2D and on a 1D grid respectively. The
+            potential is then obtained with a single 2D solve, scaled by
+            the line density on each z plane. It can be used with the
+            ``FFTSolver2p5D`` and ``RFFTSolver2p5D`` solvers, which are
+            replaced by an ``FFTSolver2D``. The ``deposition`` argument is
+            ignored. The default is ``False``.
+        gradient_layout (str): With ``'separate'`` (default) the derivatives
+            of phi are stored only in the ``dphi_dx``, ``dphi_dy`` and
+            ``dphi_dz`` arrays. With ``'interleaved'`` they are also stored
+            node by node in ``dphi_interleaved``, which is used by the
+            tracking kernels so that each interpolation stencil gathers all
+            the components from the same cache lines.
+        shape_function (str): Shape function used for the charge deposition
+            and for the interpolation. With ``'cic'`` (cloud in cell,
+            default) each particle is assigned to the 8 nodes of its cell
+            with linear weights. With ``'tsc'`` (triangular shaped cloud)
+            it is assigned to the 27 nodes around the nearest node with
+            quadratic weights, which gives smoother fields and a lower
+            noise for the same number of macroparticles. With ``'tsc'``
+            the values are zero where the 3x3x3 stencil is not fully on the
+            grid. ``'tsc'`` can be used with the ``'atomic'`` and
+            ``'private_grids'`` depositions, without factorized 2.5D mode.
+        record_grid_stats (bool): If ``True``, at each update from
+            particles the statistics returned by ``get_grid_stats`` are
+            stored in ``deposition_stats``, and the ones of the points at
+            which the map is evaluated (by ``get_values_at_points`` or by
+            the space-charge kick) in ``interpolation_stats``. This requires
+            an additional pass on the particle coordinates. The default is
+            ``False``.
     Returns:
         (TriLinearInterpolatedFieldMap): Interpolator object.
     """
@@ -145,11 +487,14 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
         'dx': xo.Float64,
         'dy': xo.Float64,
         'dz': xo.Float64,
+        'interleaved_gradients': xo.Int64,
+        'shape_order': xo.Int64,
         'rho': xo.Float64[:],
         'phi': xo.Float64[:],
         'dphi_dx': xo.Float64[:],
         'dphi_dy': xo.Float64[:],
         'dphi_dz': xo.Float64[:],
+        'dphi_interleaved': xo.Float64[:],
     }
 
     # I add undescores in front of the names so that I can define custom
@@ -167,6 +512,9 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
 
     _kernels = _TriLinearInterpolatedFielmap_kernels
 
+    # Number of chunks (and of threads) used to compute the grid statistics
+    _n_grid_stats_chunks = 64
+
     def __init__(self,
                  _context=None,
                  _buffer=None,
@@ -180,9 +528,27 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
                  solver=None,
                  scale_coordinates_in_solver=(1.,1.,1.),
                  updatable=True,
-                 fftplan=None
+                 fftplan=None,
+                 green_function_cache=None,
+                 spectral_gradients=False,
+                 precision='double',
+                 fft_backend=None,
+                 fft_threads=None,
+                 spectral_filter=None,
+                 spectral_filter_width=1.,
+                 deposition='atomic',
+                 n_private_grids=None,
+                 cell_index=None,
+                 factorized_2p5d=False,
+                 gradient_layout='separate',
+                 shape_function='cic',
+                 record_grid_stats=False
                  ):
 
+        # Tables of offsets of the maps to be interpolated, on the device
+        self._offsets_of_maps_to_interp = OrderedDict()
+        self._offsets_of_maps_to_interp_multi = OrderedDict()
+
         if _xobject is not None:
             self.xoinitialize(_xobject=_xobject, _context=_context,
                              _buffer=_buffer, _offset=_offset)
@@ -191,10 +557,36 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
         self.updatable = updatable
         self.scale_coordinates_in_solver = scale_coordinates_in_solver
 
+        if deposition not in ('atomic', 'private_grids', 'cell_sorted'):
+            raise ValueError(f'Deposition {deposition} not recognized')
+        self.deposition = deposition
+        self._private_grids = None
+        if cell_index is None and deposition == 'cell_sorted':
+            cell_index = ParticleCellIndex()
+        self.cell_index = cell_index
+        self.factorized_2p5d = factorized_2p5d
+        self.record_grid_stats = record_grid_stats
+        self.deposition_stats = {}
+        self.interpolation_stats = {}
+        self._rho_2d = None
+        self._line_density = None
+
         self._x_grid = _configure_grid('x', x_grid, dx, x_range, nx)
         self._y_grid = _configure_grid('y', y_grid, dy, y_range, ny)
         self._z_grid = _configure_grid('z', z_grid, dz, z_range, nz)
 
+        if gradient_layout not in ('separate', 'interleaved'):
+            raise ValueError(f'Gradient layout {gradient_layout} not recognized')
+        interleaved = gradient_layout == 'interleaved'
+
+        if shape_function not in _shape_orders:
+            raise ValueError(f'Shape function {shape_function} not recognized')
+        if shape_function != 'cic' and (factorized_2p5d
+                or deposition not in ('atomic', 'private_grids')):
+            raise ValueError(f'Shape function {shape_function} is available '
+                             'only for the atomic and private_grids '
+                             'depositions')
+
         nelem = self.nx*self.ny*self.nz
         self.xoinitialize(
                  _context=_context,
@@ -209,16 +601,43 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
                  dx = self.dx,
                  dy = self.dy,
                  dz = self.dz,
+                 interleaved_gradients = int(interleaved),
+                 shape_order = _shape_orders[shape_function],
                  rho = nelem,
                  phi = nelem,
                  dphi_dx = nelem,
                  dphi_dy = nelem,
-                 dphi_dz = nelem)
+                 dphi_dz = nelem,
+                 dphi_interleaved = 3 * nelem if interleaved else 0)
 
         self.compile_kernels(only_if_needed=True)
 
+        context = self._buffer.context
+        if deposition == 'private_grids':
+            self._check_private_grids_context()
+        if n_private_grids is None:
+            n_private_grids = max(getattr(context, 'omp_num_threads', 1), 1)
+        self.n_private_grids = n_private_grids
+
+        if factorized_2p5d:
+            if isinstance(solver, str):
+                if solver not in ('FFTSolver2p5D', 'RFFTSolver2p5D'):
+                    raise ValueError(
+                        f'The factorized 2.5D mode cannot be used with {solver}')
+                solver = 'FFTSolver2D'
+            elif solver is not None and not isinstance(solver, FFTSolver2D):
+                raise ValueError(
+                    'The factorized 2.5D mode needs an FFTSolver2D object')
+
         if isinstance(solver, str):
-            self.solver = self.generate_solver(solver, fftplan)
+            self.solver = self.generate_solver(solver, fftplan,
+                            green_function_cache=green_function_cache,
+                            spectral_gradients=spectral_gradients,
+                            precision=precision,
+                            fft_backend=fft_backend,
+                            fft_threads=fft_threads,
+                            spectral_filter=spectral_filter,
+                            spectral_filter_width=spectral_filter_width)
         else:
             #TODO: consistency check to be added
             self.solver = solver
@@ -244,7 +663,8 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
             return_phi=True,
             return_dphi_dx=True,
             return_dphi_dy=True,
-            return_dphi_dz=True):
+            return_dphi_dz=True,
+            out=None):
 
         """
         Returns the charge density, the field potential and its derivatives
@@ -264,58 +684,168 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
                 at the given points is returned.
             return_dphi_dz: If ``True``, the longitudinal derivative of the potential
                 at the given points is returned.
+            out (float64 array): Array of the context with
+                ``n_quantities * len(x)`` elements in which the result is
+                written, to avoid allocating it at each call. The returned
+                arrays are views of it.
         Returns:
             (tuple of float64 array): The required quantities at the provided points.
         """
 
         assert len(x) == len(y) == len(z)
 
-        pos_in_buffer_of_maps_to_interp = []
-        if return_rho:
-            pos_in_buffer_of_maps_to_interp.append(
-                    self._xobject.rho._offset + self._xobject.rho._data_offset)
-        if return_phi:
-            pos_in_buffer_of_maps_to_interp.append(
-                    self._xobject.phi._offset + self._xobject.phi._data_offset)
-        if return_dphi_dx:
-            pos_in_buffer_of_maps_to_interp.append(
-                    self._xobject.dphi_dx._offset + self._xobject.dphi_dx._data_offset)
-        if return_dphi_dy:
-            pos_in_buffer_of_maps_to_interp.append(
-                    self._xobject.dphi_dy._offset + self._xobject.dphi_dy._data_offset)
-        if return_dphi_dz:
-            pos_in_buffer_of_maps_to_interp.append(
-                    self._xobject.dphi_dz._offset + self._xobject.dphi_dz._data_offset)
+        if getattr(self, 'record_grid_stats', False):
+            self.record_interpolation_stats(x_p=x, y_p=y, z_p=z)
 
-        context = self._buffer.context
+        selection = (return_rho, return_phi, return_dphi_dx, return_dphi_dy,
+                     return_dphi_dz)
+        offsets = self._get_offsets_of_maps_to_interp(selection)
+
+        return self._interpolate_maps(self, x, y, z, offsets, out=out)
+
+    def _get_offsets_of_maps_to_interp(self, selection):
+
+        # The table on the device is built once per selection (and position
+        # of the map, which changes only if the map is moved)
+        key = (selection, id(self._buffer), self._xobject._offset)
+        return self._get_offsets_table('_offsets_of_maps_to_interp', key,
+                lambda: [self._get_offset_in_buffer(nn)
+                         for nn, selected in zip(
+                            ['rho', 'phi', 'dphi_dx', 'dphi_dy', 'dphi_dz'],
+                            selection) if selected])
+
+    _max_offsets_tables = 16
+
+    def _get_offsets_table(self, cache_name, key, get_offsets):
+
+        # Least recently used tables are dropped beyond _max_offsets_tables.
+        # Maps rebuilt from an xobject get the cache at the first call.
+        cache = getattr(self, cache_name, None)
+        if cache is None:
+            cache = OrderedDict()
+            setattr(self, cache_name, cache)
+        if key in cache:
+            cache.move_to_end(key)
+        else:
+            cache[key] = self._buffer.context.nparray_to_context_array(
+                                np.array(get_offsets(), dtype=np.int64))
+            if len(cache) > self._max_offsets_tables:
+                cache.popitem(last=False)
+        return cache[key]
+
+    def _get_offset_in_buffer(self, name):
+        xarr = getattr(self._xobject, name)
+        return xarr._offset + xarr._data_offset
+
+    @staticmethod
+    def _interpolate_maps(fmap, x, y, z, offsets, out=None):
+
+        context = fmap._buffer.context
+        n_points = len(x)
+        nmaps_to_interp = len(offsets)
+
+        if out is None:
+            buffer_out = context.zeros(
+                    shape=(nmaps_to_interp * n_points,), dtype=np.float64)
+        else:
+            assert out.dtype == np.float64
+            assert out.size == nmaps_to_interp * n_points, (
+                f'out must have {nmaps_to_interp * n_points} elements')
+            buffer_out = out.reshape(-1)
 
-        pos_in_buffer_of_maps_to_interp = context.nparray_to_context_array(
-                        np.array(pos_in_buffer_of_maps_to_interp, dtype=np.int64))
-        nmaps_to_interp = len(pos_in_buffer_of_maps_to_interp)
-        buffer_out = context.zeros(
-                shape=(nmaps_to_interp * len(x),), dtype=np.float64)
         if nmaps_to_interp > 0:
             context.kernels.TriLinearInterpolatedFieldMap_interpolate_3d_map_vector(
-                    fmap=self._xobject,
-                    n_points=len(x),
+                    fmap=fmap._xobject,
+                    n_points=n_points,
                     x=x, y=y, z=z,
                     n_quantities=nmaps_to_interp,
-                    buffer_mesh_quantities=self._buffer.buffer,
-                    offsets_mesh_quantities=pos_in_buffer_of_maps_to_interp,
+                    buffer_mesh_quantities=fmap._buffer.buffer,
+                    offsets_mesh_quantities=offsets,
                     particles_quantities=buffer_out)
 
         # Split buffer 
-        particles_quantities = [buffer_out[ii*len(x):(ii+1)*len(x)]
+        particles_quantities = [buffer_out[ii*n_points:(ii+1)*n_points]
                                         for ii in range(nmaps_to_interp)]
 
         return particles_quantities
 
+    @classmethod
+    def get_values_at_points_multi(cls, fieldmaps,
+            x, y, z,
+            return_rho=True,
+            return_phi=True,
+            return_dphi_dx=True,
+            return_dphi_dy=True,
+            return_dphi_dz=True,
+            out=None):
+
+        """
+        Evaluates several field maps at the same points with a single
+        kernel launch (see ``get_values_at_points``). The maps need to have
+        the same grid and to be allocated in the same buffer.
+
+        Args:
+            fieldmaps (list of TriLinearInterpolatedFieldMap): Field maps to
+                be evaluated.
+            x (float64 array): Horizontal coordinates at which the fields
+                are evaluated.
+            y (float64 array): Vertical coordinates at which the fields are
+                evaluated.
+            z (float64 array): Longitudinal coordinates at which the fields
+                are evaluated.
+            return_rho, return_phi, return_dphi_dx, return_dphi_dy,
+            return_dphi_dz (bool): Quantities to be returned (see
+                ``get_values_at_points``).
+            out (float64 array): Array of the context with
+                ``len(fieldmaps) * n_quantities * len(x)`` elements in which
+                the result is written.
+        Returns:
+            (list): For each field map, the list of the required quantities
+            at the provided points.
+        """
+
+        assert len(x) == len(y) == len(z)
+        if len(fieldmaps) == 0:
+            return []
+
+        fmap0 = fieldmaps[0]
+        for fmap in fieldmaps[1:]:
+            assert fmap._buffer is fmap0._buffer, (
+                'Field maps must be allocated in the same buffer')
+            assert (fmap.nx == fmap0.nx and fmap.ny == fmap0.ny
+                    and fmap.nz == fmap0.nz), 'Grids must have the same size'
+            assert np.allclose(
+                [fmap.x_grid[0], fmap.y_grid[0], fmap.z_grid[0],
+                 fmap.dx, fmap.dy, fmap.dz],
+                [fmap0.x_grid[0], fmap0.y_grid[0], fmap0.z_grid[0],
+                 fmap0.dx, fmap0.dy, fmap0.dz], rtol=1e-12, atol=0), (
+                    'Grids must be the same')
+
+        selection = (return_rho, return_phi, return_dphi_dx, return_dphi_dy,
+                     return_dphi_dz)
+        offsets = tuple(offset for fmap in fieldmaps
+                        for offset, selected in zip(
+                            [fmap._get_offset_in_buffer(nn) for nn in
+                             ['rho', 'phi', 'dphi_dx', 'dphi_dy', 'dphi_dz']],
+                            selection) if selected)
+
+        # Table on the device cached on the first map, keyed by the offsets
+        offsets_dev = fmap0._get_offsets_table(
+                '_offsets_of_maps_to_interp_multi', offsets, lambda: offsets)
+
+        values = cls._interpolate_maps(fmap0, x, y, z, offsets_dev, out=out)
+
+        n_quantities = sum(selection)
+        return [values[ii*n_quantities:(ii+1)*n_quantities]
+                for ii in range(len(fieldmaps))]
+
     #@profile
     def update_from_particles(self,
                         particles=None,
                         x_p=None, y_p=None, z_p=None,
                         ncharges_p=None, state_p=None, q0_coulomb=None,
-                        reset=True, update_phi=True, solver=None, force=False):
+                        reset=True, update_phi=True, solver=None, force=False,
+                        timings=None):
 
         """
         Updates the charge density at the grid using a given set of particles,
@@ -341,15 +871,34 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
                 attached to the fieldmap is used (if any). The default is ``None``.
             force (bool): If ``True`` the potential is updated even if the
                 map is declared as not updateable. The default is ``False``.
+            timings (dict): If provided, the time spent in the deposition
+                (``'deposit'``), in the Poisson solver (``'solve'``) and in
+                the computation of the gradients (``'gradients'``) is added
+                to the corresponding entries, in seconds. The context is
+                synchronized between the stages.
         """
 
         if not force:
             self._assert_updatable()
 
-        if reset:
-            self.rho[:,:,:] = 0.
+        if getattr(self, 'record_grid_stats', False):
+            self.deposition_stats = self.get_grid_stats(particles=particles,
+                    x_p=x_p, y_p=y_p, z_p=z_p, ncharges_p=ncharges_p,
+                    state_p=state_p, q0_coulomb=q0_coulomb)
+
+        if self._is_factorized():
+            self._update_from_particles_factorized(particles=particles,
+                    x_p=x_p, y_p=y_p, z_p=z_p, ncharges_p=ncharges_p,
+                    state_p=state_p, q0_coulomb=q0_coulomb, reset=reset,
+                    update_phi=update_phi, solver=solver, force=force,
+                    timings=timings)
+            return
 
         context = self._buffer.context
+        t0 = _start_timer(timings, context)
+
+        if reset:
+            self._rho[:] = 0.
 
         if particles is None:
             assert (len(x_p) == len(y_p) == len(z_p) == len(ncharges_p))
@@ -358,7 +907,33 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
             else:
                 assert len(state_p) == len(x_p)
 
-            context.kernels.p2m_rectmesh3d(
+            if self._use_private_grids():
+                context.kernels.p2m_rectmesh3d_private_grids(
+                    nparticles=len(x_p),
+                    x=x_p, y=y_p, z=z_p,
+                    part_weights=q0_coulomb*ncharges_p,
+                    part_state=state_p,
+                    x0=self.x_grid[0], y0=self.y_grid[0], z0=self.z_grid[0],
+                    dx=self.dx, dy=self.dy, dz=self.dz,
+                    nx=self.nx, ny=self.ny, nz=self.nz,
+                    shape_order=self.shape_order,
+                    n_grids=self.n_private_grids,
+                    grids=self._get_private_grids())
+                self._reduce_private_grids()
+            elif self.shape_order == 2:
+                context.kernels.p2m_rectmesh3d_tsc(
+                    nparticles=len(x_p),
+                    x=x_p, y=y_p, z=z_p,
+                    part_weights=q0_coulomb*ncharges_p,
+                    part_state=state_p,
+                    x0=self.x_grid[0], y0=self.y_grid[0], z0=self.z_grid[0],
+                    dx=self.dx, dy=self.dy, dz=self.dz,
+                    nx=self.nx, ny=self.ny, nz=self.nz,
+                    grid1d_buffer=self._xobject.rho._buffer.buffer,
+                    grid1d_offset=self._xobject.rho._offset
+                                 +self._xobject.rho._data_offset)
+            else:
+                context.kernels.p2m_rectmesh3d(
                     nparticles=len(x_p),
                     x=x_p, y=y_p, z=z_p,
                     part_weights=q0_coulomb*ncharges_p,
@@ -372,8 +947,35 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
         else:
             assert (x_p is None and y_p is None and z_p is None
                     and ncharges_p is None and state_p is None)
-            context.kernels.p2m_rectmesh3d_xparticles(
-                    nparticles=particles._capacity,
+            if self._use_private_grids():
+                context.kernels.p2m_rectmesh3d_xparticles_private_grids(
+                    nparticles=_get_num_particles_to_process(particles),
+                    particles=particles,
+                    x0=self.x_grid[0], y0=self.y_grid[0], z0=self.z_grid[0],
+                    dx=self.dx, dy=self.dy, dz=self.dz,
+                    nx=self.nx, ny=self.ny, nz=self.nz,
+                    shape_order=self.shape_order,
+                    n_grids=self.n_private_grids,
+                    grids=self._get_private_grids())
+                self._reduce_private_grids()
+            elif self._get_deposition() == 'cell_sorted':
+                if self.cell_index is None:
+                    self.cell_index = ParticleCellIndex()
+                self.cell_index.update(self, particles)
+                context.kernels.p2m_rectmesh3d_xparticles_cell_sorted(
+                    n_nodes=self.nx * self.ny * self.nz,
+                    particles=particles,
+                    sorted_particles=self.cell_index.sorted_particles,
+                    cell_start=self.cell_index.cell_start,
+                    x0=self.x_grid[0], y0=self.y_grid[0], z0=self.z_grid[0],
+                    dx=self.dx, dy=self.dy, dz=self.dz,
+                    nx=self.nx, ny=self.ny, nz=self.nz,
+                    grid1d_buffer=self._xobject.rho._buffer.buffer,
+                    grid1d_offset=self._xobject.rho._offset
+                                 +self._xobject.rho._data_offset)
+            elif self.shape_order == 2:
+                context.kernels.p2m_rectmesh3d_xparticles_tsc(
+                    nparticles=_get_num_particles_to_process(particles),
                     particles=particles,
                     x0=self.x_grid[0], y0=self.y_grid[0], z0=self.z_grid[0],
                     dx=self.dx, dy=self.dy, dz=self.dz,
@@ -381,9 +983,315 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
                     grid1d_buffer=self._xobject.rho._buffer.buffer,
                     grid1d_offset=self._xobject.rho._offset
                                  +self._xobject.rho._data_offset)
+            else:
+                context.kernels.p2m_rectmesh3d_xparticles(
+                    nparticles=_get_num_particles_to_process(particles),
+                    particles=particles,
+                    x0=self.x_grid[0], y0=self.y_grid[0], z0=self.z_grid[0],
+                    dx=self.dx, dy=self.dy, dz=self.dz,
+                    nx=self.nx, ny=self.ny, nz=self.nz,
+                    grid1d_buffer=self._xobject.rho._buffer.buffer,
+                    grid1d_offset=self._xobject.rho._offset
+                                 +self._xobject.rho._data_offset)
+
+        _record_time(timings, 'deposit', context, t0)
 
         if update_phi:
-            self.update_phi_from_rho(solver=solver)
+            self.update_phi_from_rho(solver=solver, timings=timings)
+
+    def get_grid_stats(self, particles=None, x_p=None, y_p=None, z_p=None,
+                       ncharges_p=None, state_p=None, q0_coulomb=None):
+
+        """
+        Computes the grid statistics of a set of particles, which can be
+        provided by a particles object or by individual arrays. A particle
+        is out of grid if the stencil of the shape function is not fully on
+        the grid, in which case its charge is not deposited and it gets no
+        field from the map. Lost particles are ignored.
+
+        Args:
+            particles (xtrack.Particles): xtrack particle object.
+            x_p (float64 array): Horizontal coordinates of the macroparticles.
+            y_p (float64 array): Vertical coordinates of the macroparticles.
+            z_p (float64 array): Longitudinal coordinates of the macroparticles.
+            ncharges_p (float64 array): Number of reference charges in the
+                macroparticles. If ``None``, the charge entries are not
+                computed.
+            state_p (int64, array): particle state (>0 active, lost otherwise)
+            q0_coulomb (float64): Reference charge in Coulomb.
+        Returns:
+            (dict): Dictionary with the number of active particles
+            (``'n_particles'``), the number of particles out of grid
+            (``'n_out_of_grid'``), the charge on the grid and out of it in
+            Coulomb (``'charge_deposited'`` and ``'charge_dropped'``) and
+            the bounding box of the active particles
+            (``'bounding_box'``, ``((x_min, x_max), (y_min, y_max),
+            (z_min, z_max))``, ``None`` if there are no active particles).
+        """
+
+        context = self._buffer.context
+        n_chunks = self._n_grid_stats_chunks
+        stats = context.zeros(n_chunks * 10, dtype=np.float64)
+
+        if particles is None:
+            assert len(x_p) == len(y_p) == len(z_p)
+            if state_p is None:
+                state_p = context.zeros(shape=x_p.shape, dtype=np.int64) + 1
+            if ncharges_p is None:
+                part_weights = context.zeros(shape=x_p.shape,
+                                             dtype=np.float64) + 1
+            else:
+                part_weights = q0_coulomb * ncharges_p
+            context.kernels.p2m_grid_stats(
+                    nparticles=len(x_p),
+                    x=x_p, y=y_p, z=z_p,
+                    part_weights=part_weights,
+                    part_state=state_p,
+                    x0=self.x_grid[0], y0=self.y_grid[0], z0=self.z_grid[0],
+                    dx=self.dx, dy=self.dy, dz=self.dz,
+                    nx=self.nx, ny=self.ny, nz=self.nz,
+                    shape_order=self.shape_order,
+                    n_chunks=n_chunks,
+                    stats=stats)
+        else:
+            context.kernels.p2m_grid_stats_xparticles(
+                    nparticles=_get_num_particles_to_process(particles),
+                    particles=particles,
+                    x0=self.x_grid[0], y0=self.y_grid[0], z0=self.z_grid[0],
+                    dx=self.dx, dy=self.dy, dz=self.dz,
+                    nx=self.nx, ny=self.ny, nz=self.nz,
+                    shape_order=self.shape_order,
+                    n_chunks=n_chunks,
+                    stats=stats)
+
+        stats = context.nparray_from_context_array(stats).reshape(n_chunks, 10)
+        n_on, n_out, q_on, q_out = stats[:, :4].sum(axis=0)
+        out = {'n_particles': int(n_on + n_out),
+               'n_out_of_grid': int(n_out)}
+        if particles is not None or ncharges_p is not None:
+            out['charge_deposited'] = q_on
+            out['charge_dropped'] = q_out
+        if n_on + n_out > 0:
+            out['bounding_box'] = tuple(
+                    (np.min(stats[:, ii]), np.max(stats[:, ii+1]))
+                    for ii in (4, 6, 8))
+        else:
+            out['bounding_box'] = None
+        return out
+
+    def record_interpolation_stats(self, particles=None,
+                                   x_p=None, y_p=None, z_p=None):
+
+        """
+        Stores in ``interpolation_stats`` the number of points (or active
+        particles), the number of them that are out of grid and their
+        bounding box (see ``get_grid_stats``).
+
+        Args:
+            particles (xtrack.Particles): xtrack particle object.
+            x_p (float64 array): Horizontal coordinates of the points.
+            y_p (float64 array): Vertical coordinates of the points.
+            z_p (float64 array): Longitudinal coordinates of the points.
+        """
+
+        stats = self.get_grid_stats(particles=particles,
+                                    x_p=x_p, y_p=y_p, z_p=z_p)
+        stats.pop('charge_deposited', None)
+        stats.pop('charge_dropped', None)
+        self.interpolation_stats = stats
+
+    def _is_factorized(self):
+        return getattr(self, 'factorized_2p5d', False)
+
+    def _update_from_particles_factorized(self, particles, x_p, y_p, z_p,
+                        ncharges_p, state_p, q0_coulomb, reset, update_phi,
+                        solver, force=False, timings=None):
+
+        context = self._buffer.context
+        t0 = _start_timer(timings, context)
+
+        if self._rho_2d is None:
+            self._rho_2d = context.zeros((self.nx, self.ny), dtype=np.float64,
+                                         order='F')
+            self._line_density = context.zeros(self.nz, dtype=np.float64)
+        if reset:
+            self._rho_2d[:, :] = 0.
+            self._line_density[:] = 0.
+
+        if particles is None:
+            assert (len(x_p) == len(y_p) == len(z_p) == len(ncharges_p))
+            if state_p is None:
+                state_p = context.zeros(shape=x_p.shape, dtype=np.int64) + 1
+            else:
+                assert len(state_p) == len(x_p)
+            context.kernels.p2m_rectmesh2p5d(
+                    nparticles=len(x_p),
+                    x=x_p, y=y_p, z=z_p,
+                    part_weights=q0_coulomb*ncharges_p,
+                    part_state=state_p,
+                    x0=self.x_grid[0], y0=self.y_grid[0], z0=self.z_grid[0],
+                    dx=self.dx, dy=self.dy, dz=self.dz,
+                    nx=self.nx, ny=self.ny, nz=self.nz,
+                    grid2d=self._rho_2d,
+                    line_density=self._line_density)
+        else:
+            assert (x_p is None and y_p is None and z_p is None
+                    and ncharges_p is None and state_p is None)
+            context.kernels.p2m_rectmesh2p5d_xparticles(
+                    nparticles=_get_num_particles_to_process(particles),
+                    particles=particles,
+                    x0=self.x_grid[0], y0=self.y_grid[0], z0=self.z_grid[0],
+                    dx=self.dx, dy=self.dy, dz=self.dz,
+                    nx=self.nx, ny=self.ny, nz=self.nz,
+                    grid2d=self._rho_2d,
+                    line_density=self._line_density)
+
+        # Normalized transverse distribution (1/m^2). The line density stays
+        # on the device, only the total charge is read back.
+        line_density = self._line_density
+        rho_perp = self._normalize_transverse_distribution(self._rho_2d,
+                                                           line_density)
+
+        self.rho[:, :, :] = rho_perp[:, :, None] * line_density[None, None, :]
+
+        _record_time(timings, 'deposit', context, t0)
+
+        if update_phi:
+            self._update_phi_factorized(rho_perp, line_density, solver=solver,
+                                        force=force, timings=timings)
+
+    def _normalize_transverse_distribution(self, rho_2d, line_density):
+        total_charge = float(line_density.sum()) * self.dz
+        if total_charge != 0:
+            return rho_2d * (1. / total_charge)
+        return rho_2d * 0.
+
+    def _update_phi_factorized(self, rho_perp, line_density, solver=None,
+                               force=False, timings=None):
+
+        if not force:
+            self._assert_updatable()
+        context = self._buffer.context
+
+        if solver is None:
+            if hasattr(self, 'solver'):
+                solver = self.solver
+            else:
+                raise ValueError('I have no solver to compute phi!')
+
+        t0 = _start_timer(timings, context)
+        if getattr(solver, 'spectral_gradients', False):
+            phi_2d, gradients_2d = solver.solve_with_gradients(rho_perp)
+        else:
+            phi_2d = solver.solve(rho_perp)
+            gradients_2d = [None, None]
+        t0 = _record_time(timings, 'solve', context, t0)
+
+        # The 2.5D potential on each z plane is the 2D potential of the
+        # normalized transverse distribution times the line density
+        line_density = line_density[None, None, :]
+        phi = phi_2d[:, :, None] * line_density
+        gradients = [None if grad_2d is None
+                     else grad_2d[:, :, None] * line_density
+                     for grad_2d in gradients_2d]
+
+        # The longitudinal derivative is computed from phi
+        self.update_phi(phi, force=True, dphi_dx=gradients[0],
+                        dphi_dy=gradients[1])
+        _record_time(timings, 'gradients', context, t0)
+
+    def _get_deposition(self):
+        # Maps rebuilt from an xobject have no deposition settings
+        return getattr(self, 'deposition', 'atomic')
+
+    def _check_private_grids_context(self):
+        if not isinstance(self._buffer.context, xo.ContextCpu):
+            raise ValueError('The private_grids deposition is available only '
+                             'on CPU contexts')
+
+    def _use_private_grids(self):
+        if self._get_deposition() != 'private_grids':
+            return False
+        self._check_private_grids_context()
+        return True
+
+    def _get_private_grids(self):
+        nelem = self.nx * self.ny * self.nz
+        if (getattr(self, '_private_grids', None) is None
+                or len(self._private_grids) != self.n_private_grids * nelem):
+            # Allocated once, zeroed by the deposition kernels
+            self._private_grids = self._buffer.context.zeros(
+                                self.n_private_grids * nelem, dtype=np.float64)
+        return self._private_grids
+
+    def _reduce_private_grids(self):
+        self._buffer.context.kernels.reduce_private_grids(
+                    n_cells=self.nx * self.ny * self.nz,
+                    n_grids=self.n_private_grids,
+                    grids=self._private_grids,
+                    grid1d_buffer=self._xobject.rho._buffer.buffer,
+                    grid1d_offset=self._xobject.rho._offset
+                                 +self._xobject.rho._data_offset)
+
+    @classmethod
+    def update_from_particles_batch(cls, fieldmaps, particles,
+                                    solver=None, force=False):
+
+        """
+        Updates a set of field maps defined on the same grid (e.g. one per
+        bunch of a bunch train) from the corresponding particles objects.
+        The charge densities are deposited on each map and the potentials
+        are computed with a single batched solve (see
+        ``FFTSolver3D.solve_batch``).
+
+        Args:
+            fieldmaps (list of TriLinearInterpolatedFieldMap): Field maps to
+                be updated. They need to have the same grid.
+            particles (list of xtrack.Particles): Particles objects, one per
+                field map.
+            solver (Solver object): solver object to be used to solve
+                Poisson's equation. If ``None`` is provided the solver
+                attached to the first fieldmap is used. The default is
+                ``None``.
+            force (bool): If ``True`` the maps are updated even if they are
+                declared as not updateable. The default is ``False``.
+        """
+
+        assert len(fieldmaps) == len(particles)
+        if len(fieldmaps) == 0:
+            return
+
+        fmap0 = fieldmaps[0]
+        for fmap in fieldmaps[1:]:
+            assert (fmap.nx == fmap0.nx and fmap.ny == fmap0.ny
+                    and fmap.nz == fmap0.nz), 'Grids must have the same size'
+            assert np.allclose([fmap.dx, fmap.dy, fmap.dz],
+                               [fmap0.dx, fmap0.dy, fmap0.dz],
+                               rtol=1e-12, atol=0), (
+                                    'Grids must have the same spacing')
+
+        if solver is None:
+            if hasattr(fmap0, 'solver'):
+                solver = fmap0.solver
+            else:
+                raise ValueError('I have no solver to compute phi!')
+
+        if fmap0._is_factorized():
+            # A single 2D solve per map is already needed
+            for fmap, pp in zip(fieldmaps, particles):
+                fmap.update_from_particles(particles=pp, solver=solver,
+                                           force=force)
+            return
+
+        for fmap, pp in zip(fieldmaps, particles):
+            fmap.update_from_particles(particles=pp, update_phi=False,
+                                       force=force)
+
+        phi_batch = solver.solve_batch(
+                    [fmap._get_rho_for_solver(solver) for fmap in fieldmaps])
+
+        for ii, fmap in enumerate(fieldmaps):
+            fmap._update_phi_from_solution(phi_batch[ii], solver)
 
     def update_rho(self, rho, reset=True, force=False):
         """
@@ -407,7 +1315,8 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
             raise ValueError('Not implemented!')
 
     #@profile
-    def update_phi(self, phi, reset=True, force=False):
+    def update_phi(self, phi, reset=True, force=False,
+                   dphi_dx=None, dphi_dy=None, dphi_dz=None):
 
         """
         Updates the potential on the grid. The stored derivatives are also
@@ -420,6 +1329,15 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
                 is added to the stored one. The default is ``True``.
             force (bool): If ``True`` the potential is updated even if the
                 map is declared as not updateable. The default is ``False``.
+            dphi_dx (float64 array): Horizontal derivative of the potential
+                at the grid points. If not provided it is computed from phi
+                by central differences.
+            dphi_dy (float64 array): Vertical derivative of the potential
+                at the grid points. If not provided it is computed from phi
+                by central differences.
+            dphi_dz (float64 array): Longitudinal derivative of the potential
+                at the grid points. If not provided it is computed from phi
+                by central differences.
         """
 
         if not force:
@@ -432,43 +1350,51 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
 
         context = self._buffer.context
 
-        # Compute gradient
-        context.kernels.central_diff(
-                nelem = self.phi.size,
-                row_size = self.nx,
-                stride_in_dbl = self.phi.strides[0]/8,
-                factor = 1/(2*self.dx),
-                matrix_buffer = self._xobject.phi._buffer.buffer,
-                matrix_offset = (self._xobject.phi._offset
-                               + self._xobject.phi._data_offset),
-                res_buffer = self._xobject.dphi_dx._buffer.buffer,
-                res_offset = (self._xobject.dphi_dx._offset
-                            + self._xobject.dphi_dx._data_offset))
-        context.kernels.central_diff(
-                nelem = self.phi.size,
-                row_size = self.ny,
-                stride_in_dbl = self.phi.strides[1]/8,
-                factor = 1/(2*self.dy),
-                matrix_buffer = self._xobject.phi._buffer.buffer,
-                matrix_offset = (self._xobject.phi._offset
-                               + self._xobject.phi._data_offset),
-                res_buffer = self._xobject.dphi_dy._buffer.buffer,
-                res_offset = (self._xobject.dphi_dy._offset
-                            + self._xobject.dphi_dy._data_offset))
-        context.kernels.central_diff(
-                nelem = self.phi.size,
-                row_size = self.nz,
-                stride_in_dbl = self.phi.strides[2]/8,
-                factor = 1/(2*self.dz),
-                matrix_buffer = self._xobject.phi._buffer.buffer,
-                matrix_offset = (self._xobject.phi._offset
-                               + self._xobject.phi._data_offset),
-                res_buffer = self._xobject.dphi_dz._buffer.buffer,
-                res_offset = (self._xobject.dphi_dz._offset
-                            + self._xobject.dphi_dz._data_offset))
+        # Copy the provided gradient components
+        compute = []
+        for nn, dphi in [('dphi_dx', dphi_dx), ('dphi_dy', dphi_dy),
+                         ('dphi_dz', dphi_dz)]:
+            if dphi is not None:
+                getattr(self, nn).T[:,:,:] = dphi.T
+            compute.append(int(dphi is None))
+
+        # Compute the other ones (single kernel launch)
+        if any(compute):
+            xobj = self._xobject
+            offsets = {nn: getattr(xobj, nn)._offset
+                           + getattr(xobj, nn)._data_offset
+                       for nn in ['phi', 'dphi_dx', 'dphi_dy', 'dphi_dz']}
+            context.kernels.central_diff_3d(
+                    nelem=self.nx * self.ny * self.nz,
+                    nx=self.nx, ny=self.ny, nz=self.nz,
+                    factor_x=1/(2*self.dx),
+                    factor_y=1/(2*self.dy),
+                    factor_z=1/(2*self.dz),
+                    compute_x=compute[0],
+                    compute_y=compute[1],
+                    compute_z=compute[2],
+                    buffer=xobj.phi._buffer.buffer,
+                    phi_offset=offsets['phi'],
+                    dphi_dx_offset=offsets['dphi_dx'],
+                    dphi_dy_offset=offsets['dphi_dy'],
+                    dphi_dz_offset=offsets['dphi_dz'])
+
+        if self._interleaved_gradients:
+            self._update_interleaved_gradients()
+
+    def _update_interleaved_gradients(self):
+        xobj = self._xobject
+        self._buffer.context.kernels.interleave_gradients(
+                nelem=self.nx * self.ny * self.nz,
+                buffer=xobj.dphi_dx._buffer.buffer,
+                dphi_dx_offset=self._get_offset_in_buffer('dphi_dx'),
+                dphi_dy_offset=self._get_offset_in_buffer('dphi_dy'),
+                dphi_dz_offset=self._get_offset_in_buffer('dphi_dz'),
+                interleaved_offset=self._get_offset_in_buffer(
+                                                        'dphi_interleaved'))
 
     #@profile
-    def update_phi_from_rho(self, solver=None):
+    def update_phi_from_rho(self, solver=None, timings=None):
 
         """
         Updates the potential on the grid (phi) from the charge density on the
@@ -479,6 +1405,9 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
             solver (Solver object): solver object to be used to solve Poisson's
                 equation. If ``None`` is provided the solver attached to the fieldmap
                 is used (if any). The default is ``None``.
+            timings (dict): If provided, the time spent in the solver
+                (``'solve'``) and in the computation of the gradients
+                (``'gradients'``) is added to the corresponding entries.
         """
 
         self._assert_updatable()
@@ -489,42 +1418,124 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
             else:
                 raise ValueError('I have no solver to compute phi!')
 
-        new_phi = solver.solve(self.rho)
-        self.update_phi(new_phi)
+        if self._is_factorized():
+            # Transverse distribution and line density from rho (on the
+            # device)
+            rho = self.rho
+            line_density = rho.sum(axis=(0, 1)) * (self.dx * self.dy)
+            rho_perp = self._normalize_transverse_distribution(
+                                    rho.sum(axis=2) * self.dz, line_density)
+            self._update_phi_factorized(rho_perp, line_density, solver=solver,
+                                        force=True, timings=timings)
+            return
 
-    def generate_solver(self, solver, fftplan):
+        context = self._buffer.context
+        t0 = _start_timer(timings, context)
+        rho = self._get_rho_for_solver(solver)
+        if getattr(solver, 'spectral_gradients', False):
+            new_phi, gradients = solver.solve_with_gradients(rho)
+        else:
+            new_phi = solver.solve(rho)
+            gradients = None
+        t0 = _record_time(timings, 'solve', context, t0)
+        self._update_phi_from_solution(new_phi, solver, gradients)
+        _record_time(timings, 'gradients', context, t0)
+
+    def _get_rho_for_solver(self, solver):
+
+        if not isinstance(solver, FFTSolver2D):
+            return self.rho
+
+        # The map is taken as longitudinally uniform: the transverse charge
+        # density is the average over the z planes
+        return self.rho.mean(axis=2)
+
+    def _update_phi_from_solution(self, new_phi, solver, gradients=None):
+
+        if gradients is None:
+            gradients = []
+        gradients = list(gradients) + [None] * (3 - len(gradients))
+
+        # The gradients from the solver are computed with the solver grid
+        # spacing (see scale_coordinates_in_solver)
+        for ii, (dd_solver, dd) in enumerate(zip(
+                    (solver.dx, solver.dy, solver.dz),
+                    (self.dx, self.dy, self.dz))):
+            if gradients[ii] is not None and dd_solver != dd:
+                gradients[ii] = gradients[ii] * (dd_solver / dd)
+
+        if isinstance(solver, FFTSolver2D):
+            # Same potential on all z planes (broadcast by update_phi)
+            new_phi = new_phi[:, :, None]
+            for ii in range(2):
+                if gradients[ii] is not None:
+                    gradients[ii] = gradients[ii][:, :, None]
+
+        self.update_phi(new_phi, dphi_dx=gradients[0], dphi_dy=gradients[1],
+                        dphi_dz=gradients[2])
+
+    def generate_solver(self, solver, fftplan, green_function_cache=None,
+                        spectral_gradients=False, precision='double',
+                        fft_backend=None, fft_threads=None,
+                        spectral_filter=None, spectral_filter_width=1.):
 
         """
         Generates a Poisson solver associated to the defined grid.
 
         Args:
             solver (str): Defines the Poisson solver to be used
-            to compute phi from rho. Accepted values are ``FFTSolver3D`` and
-            ``FFTSolver2p5D``.
+                to compute phi from rho. Accepted values are ``FFTSolver3D``,
+                ``FFTSolver2p5D``, ``RFFTSolver3D``, ``RFFTSolver2p5D`` and
+                ``FFTSolver2D``.
+            fftplan (FFT plan object): FFT plan to be used by the solver
+                (not used by the ``RFFTSolver`` solvers).
+            green_function_cache (GreenFunctionCache): Cache from which the
+                transformed Green function of the solver is taken, if
+                available.
+            spectral_gradients (bool): If ``True``, the solver computes the
+                derivatives of phi in Fourier space.
+            precision (str): Floating point precision of the FFT solver
+                (``'double'`` or ``'single'``). The field map arrays stay
+                in double precision.
+            fft_backend (str): FFT implementation used by the solver
+                (``None``, ``'scipy'`` or ``'fftw'``).
+            fft_threads (int): Number of threads used by the CPU FFT
+                backends.
+            spectral_filter (str or callable): Smoothing filter folded into
+                the transformed Green function (see ``FFTSolver3D``).
+            spectral_filter_width (float): Width of the spectral filter.
         Returns:
             (Solver): Solver object associated to the defined grid.
         """
 
+        solver_classes = {
+            'FFTSolver2D': FFTSolver2D,
+            'FFTSolver3D': FFTSolver3D,
+            'FFTSolver2p5D': FFTSolver2p5D,
+            'RFFTSolver3D': RFFTSolver3D,
+            'RFFTSolver2p5D': RFFTSolver2p5D,
+            }
+        if solver not in solver_classes:
+            raise ValueError(f'solver name {solver} not recognized')
+
         scale_dx, scale_dy, scale_dz = self.scale_coordinates_in_solver
 
-        if solver == 'FFTSolver3D':
-            solver = FFTSolver3D(
-                    dx=self.dx*scale_dx,
-                    dy=self.dy*scale_dy,
-                    dz=self.dz*scale_dz,
-                    nx=self.nx, ny=self.ny, nz=self.nz,
-                    context=self._buffer.context,
-                    fftplan=fftplan)
-        elif solver == 'FFTSolver2p5D':
-            solver = FFTSolver2p5D(
-                    dx=self.dx*scale_dx,
-                    dy=self.dy*scale_dy,
-                    dz=self.dz*scale_dz,
-                    nx=self.nx, ny=self.ny, nz=self.nz,
-                    context=self._buffer.context,
-                    fftplan=fftplan)
-        else:
-            raise ValueError(f'solver name {solver} not recognized')
+        kwargs = dict(dx=self.dx*scale_dx, dy=self.dy*scale_dy,
+                      nx=self.nx, ny=self.ny,
+                      context=self._buffer.context,
+                      green_function_cache=green_function_cache,
+                      spectral_gradients=spectral_gradients,
+                      precision=precision,
+                      fft_backend=fft_backend,
+                      fft_threads=fft_threads,
+                      spectral_filter=spectral_filter,
+                      spectral_filter_width=spectral_filter_width)
+        if solver != 'FFTSolver2D':
+            kwargs.update(dz=self.dz*scale_dz, nz=self.nz)
+        if not solver.startswith('RFFT'):
+            kwargs['fftplan'] = fftplan
+
+        solver = solver_classes[solver](**kwargs)
 
         return solver
 
@@ -620,6 +1631,37 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
         return self._dphi_dz.reshape(
                 (self.nx, self.ny, self.nz), order='F')
 
+    @property
+    def shape_order(self):
+        """
+        Order of the shape function (1 for ``'cic'``, 2 for ``'tsc'``).
+        """
+        return self._shape_order
+
+    @property
+    def shape_function(self):
+        """
+        Shape function used for deposition and interpolation.
+        """
+        return {vv: kk for kk, vv in _shape_orders.items()}[self.shape_order]
+
+    @property
+    def gradient_layout(self):
+        """
+        Storage layout of the derivatives of phi (``'separate'`` or
+        ``'interleaved'``).
+        """
+        return 'interleaved' if self._interleaved_gradients else 'separate'
+
+    @property
+    def dphi_interleaved(self):
+        """
+        Derivatives of phi stored node by node (only for the
+        ``'interleaved'`` layout). The first index selects the component.
+        """
+        return self._dphi_interleaved.reshape(
+                (3, self.nx, self.ny, self.nz), order='F')
+
 
 
 def _configure_grid(vname, v_grid, dv, v_range, nv):
@@ -0,0 +1,230 @@
+// copyright ################################# //
+// This file is part of the Xfields Package.   //
+// Copyright (c) CERN, 2021.                   //
+// ########################################### //
+
+#ifndef XFIELDS_BICUBIC_INTERPOLATORS_H
+#define XFIELDS_BICUBIC_INTERPOLATORS_H
+
+// Coefficients of the interpolating polynomial of the cell (ix, iy),
+// sum_ij coefs[i + 4 * j] * xn^i * yn^j, from the values of phi and of its
+// normalized derivatives at the four corners of the cell
+/*gpufun*/
+void BiCubicInterpolatedFieldMap_construct_coefficients(
+	BiCubicInterpolatedFieldMapData fmap,
+	   const int64_t ix, const int64_t iy,
+       double* coefs){
+
+    /*gpuglmem*/ double* phi_taylor = BiCubicInterpolatedFieldMapData_getp1_phi_taylor(fmap, 0);
+    const int64_t nx = BiCubicInterpolatedFieldMapData_get_nx(fmap);
+
+    const int64_t i00 = 4 * (ix + nx * iy);
+    const int64_t i10 = i00 + 4;
+    const int64_t i01 = i00 + 4 * nx;
+    const int64_t i11 = i01 + 4;
+
+    // Corner values: rows (phi at x = 0, phi at x = 1, dphi_dx at x = 0,
+    // dphi_dx at x = 1), columns the same in y
+    double ff[4][4];
+    ff[0][0] = phi_taylor[i00    ]; ff[0][1] = phi_taylor[i01    ];
+    ff[0][2] = phi_taylor[i00 + 2]; ff[0][3] = phi_taylor[i01 + 2];
+    ff[1][0] = phi_taylor[i10    ]; ff[1][1] = phi_taylor[i11    ];
+    ff[1][2] = phi_taylor[i10 + 2]; ff[1][3] = phi_taylor[i11 + 2];
+    ff[2][0] = phi_taylor[i00 + 1]; ff[2][1] = phi_taylor[i01 + 1];
+    ff[2][2] = phi_taylor[i00 + 3]; ff[2][3] = phi_taylor[i01 + 3];
+    ff[3][0] = phi_taylor[i10 + 1]; ff[3][1] = phi_taylor[i11 + 1];
+    ff[3][2] = phi_taylor[i10 + 3]; ff[3][3] = phi_taylor[i11 + 3];
+
+    // coefs = M ff M^T (cubic Hermite basis)
+    const double mm[4][4] = {{ 1.,  0.,  0.,  0.},
+                             { 0.,  0.,  1.,  0.},
+                             {-3.,  3., -2., -1.},
+                             { 2., -2.,  1.,  1.}};
+    double gg[4][4];
+    for (int i = 0; i < 4; i++){
+        for (int k = 0; k < 4; k++){
+            gg[i][k] = 0.;
+            for (int l = 0; l < 4; l++){
+                gg[i][k] += mm[i][l] * ff[l][k];
+            }
+        }
+    }
+    for (int i = 0; i < 4; i++){
+        for (int j = 0; j < 4; j++){
+            double cc = 0.;
+            for (int k = 0; k < 4; k++){
+                cc += gg[i][k] * mm[j][k];
+            }
+            coefs[i + 4 * j] = cc;
+        }
+    }
+}
+
+// Adds the potential (if compute_phi is non-zero) and its gradient at
+// (x, y) to the output values. Returns 1 (leaving the outputs untouched)
+// if the point is outside the grid.
+/*gpufun*/
+int BiCubicInterpolatedFieldMap_interpolate(
+	BiCubicInterpolatedFieldMapData fmap,
+	   const double x, const double y,
+	   const int compute_phi, double* phi,
+	   double* dphi_dx, double* dphi_dy){
+
+    double const x_min = BiCubicInterpolatedFieldMapData_get_x_min(fmap);
+    double const y_min = BiCubicInterpolatedFieldMapData_get_y_min(fmap);
+
+    double const inv_dx = 1. / BiCubicInterpolatedFieldMapData_get_dx(fmap);
+    double const inv_dy = 1. / BiCubicInterpolatedFieldMapData_get_dy(fmap);
+
+    double const fx = ( x - x_min ) * inv_dx; // distance in normalized grid
+    double const fy = ( y - y_min ) * inv_dy;
+
+    int64_t mirror_x = BiCubicInterpolatedFieldMapData_get_mirror_x(fmap);
+    int64_t mirror_y = BiCubicInterpolatedFieldMapData_get_mirror_y(fmap);
+
+    double const sign_x = (mirror_x == 1 && fx < 0.0 ) ?  -1. : 1.;
+    double const sign_y = (mirror_y == 1 && fy < 0.0 ) ?  -1. : 1.;
+
+    double const sfx = sign_x * fx;
+    double const sfy = sign_y * fy;
+
+    double const ixf = floor(sfx); // lower left corner of the cell
+    double const iyf = floor(sfy);
+
+    int64_t const ix = (int64_t) ixf;
+    int64_t const iy = (int64_t) iyf;
+
+    double const xn = sfx - ixf; // position in the cell
+    double const yn = sfy - iyf;
+
+    int indices_are_inside_box = ( ix >= 0 ) && ( ix <= ( BiCubicInterpolatedFieldMapData_get_nx(fmap) - 2 ) )
+                              && ( iy >= 0 ) && ( iy <= ( BiCubicInterpolatedFieldMapData_get_ny(fmap) - 2 ) );
+
+    if(!indices_are_inside_box){
+        return 1;
+    }
+
+    double coefs[16];
+    BiCubicInterpolatedFieldMap_construct_coefficients(fmap, ix, iy, coefs);
+
+    double x_power[4], y_power[4];
+    x_power[0] = 1;
+    y_power[0] = 1;
+    x_power[1] = xn;
+    y_power[1] = yn;
+    x_power[2] = xn * xn;
+    y_power[2] = yn * yn;
+    x_power[3] = x_power[2] * xn;
+    y_power[3] = y_power[2] * yn;
+
+    if (compute_phi){
+        for( int i = 0; i < 4; i++ ){
+            for( int j = 0; j < 4; j++ ){
+                *phi += ( coefs[i + 4 * j] * x_power[i] ) * y_power[j];
+            }
+        }
+    }
+
+    double gx = 0.;
+    for( int i = 1; i < 4; i++ ){
+        for( int j = 0; j < 4; j++ ){
+            gx += i * ( ( coefs[i + 4 * j] * x_power[i-1] ) * y_power[j] );
+        }
+    }
+    *dphi_dx += gx * sign_x * inv_dx;
+
+    double gy = 0.;
+    for( int i = 0; i < 4; i++ ){
+        for( int j = 1; j < 4; j++ ){
+            gy += j * ( ( coefs[i + 4 * j] * x_power[i] ) * y_power[j-1] );
+        }
+    }
+    *dphi_dy += gy * sign_y * inv_dy;
+
+    return 0;
+}
+
+/*gpufun*/
+int BiCubicInterpolatedFieldMap_interpolate_grad(
+	BiCubicInterpolatedFieldMapData fmap,
+	   const double x, const double y,
+	   double* dphi_dx, double* dphi_dy){
+
+    double phi = 0.;
+    return BiCubicInterpolatedFieldMap_interpolate(fmap, x, y,
+            0, &phi, dphi_dx, dphi_dy);
+}
+
+// Fills phi_taylor from the potential phi (F-ordered, nx * ny nodes) in a
+// single pass (one thread per node), with normalized central differences
+// set to zero on the boundary lines of the differentiated axes (as for
+// TriCubicInterpolatedFieldMap_phi_taylor_from_phi).
+/*gpukern*/
+void BiCubicInterpolatedFieldMap_phi_taylor_from_phi(
+	BiCubicInterpolatedFieldMapData fmap,
+	   const int64_t n_nodes,
+	   /*gpuglmem*/ const double* phi){
+
+    const int64_t nx = BiCubicInterpolatedFieldMapData_get_nx(fmap);
+    const int64_t ny = BiCubicInterpolatedFieldMapData_get_ny(fmap);
+    /*gpuglmem*/ double* phi_taylor = BiCubicInterpolatedFieldMapData_getp1_phi_taylor(fmap, 0);
+
+    const int64_t sy = nx;
+
+    #pragma omp parallel for //only_for_context cpu_openmp
+    for (int64_t ii=0; ii<n_nodes; ii++){ //vectorize_over ii n_nodes
+        const int64_t ix = ii % nx;
+        const int64_t iy = ii / sy;
+
+        const int inner_x = (ix > 0) && (ix < nx - 1);
+        const int inner_y = (iy > 0) && (iy < ny - 1);
+
+        /*gpuglmem*/ double* out = phi_taylor + 4 * ii;
+
+        out[0] = phi[ii];
+        out[1] = inner_x ? 0.5 * (phi[ii + 1] - phi[ii - 1]) : 0.;
+        out[2] = inner_y ? 0.5 * (phi[ii + sy] - phi[ii - sy]) : 0.;
+        out[3] = (inner_x && inner_y) ?
+                   0.25 * ( (phi[ii + 1 + sy] - phi[ii + 1 - sy])
+                          - (phi[ii - 1 + sy] - phi[ii - 1 - sy]) ) : 0.;
+    }//end_vectorize
+}
+
+// Evaluates the selected quantities (phi, dphi_dx, dphi_dy, in this order)
+// at n_points points (one thread per point), one block of n_points values
+// per selected quantity; zeros are returned for the points outside the grid.
+/*gpukern*/
+void BiCubicInterpolatedFieldMap_interpolate_vector(
+	BiCubicInterpolatedFieldMapData fmap,
+	   const int64_t n_points,
+	   /*gpuglmem*/ const double* x,
+	   /*gpuglmem*/ const double* y,
+	   const int64_t return_phi,
+	   const int64_t return_dphi_dx,
+	   const int64_t return_dphi_dy,
+	   /*gpuglmem*/ double* out){
+
+    #pragma omp parallel for //only_for_context cpu_openmp
+    for (int64_t ip=0; ip<n_points; ip++){ //vectorize_over ip n_points
+        double phi = 0.;
+        double dphi_dx = 0.;
+        double dphi_dy = 0.;
+        BiCubicInterpolatedFieldMap_interpolate(fmap, x[ip], y[ip],
+                (int) return_phi, &phi, &dphi_dx, &dphi_dy);
+
+        int64_t iq = 0;
+        if (return_phi){
+            out[iq * n_points + ip] = phi;
+            iq++;
+        }
+        if (return_dphi_dx){
+            out[iq * n_points + ip] = dphi_dx;
+            iq++;
+        }
+        if (return_dphi_dy){
+            out[iq * n_points + ip] = dphi_dy;
+        }
+    }//end_vectorize
+}
+
+#endif
@@ -36,4 +36,101 @@ void central_diff(
 
 }
 
+// Central differences along the three axes of an F-ordered 3D array in a
+// single launch (zero on the first and last plane of each axis, as in
+// central_diff). The components with a zero flag are not written.
+/*gpukern*/
+void central_diff_3d(
+	      const int64_t nelem,
+	      const int     nx,
+	      const int     ny,
+	      const int     nz,
+	      const double  factor_x,
+	      const double  factor_y,
+	      const double  factor_z,
+	      const int     compute_x,
+	      const int     compute_y,
+	      const int     compute_z,
+/*gpuglmem*/        int8_t* buffer,
+              const int64_t phi_offset,
+              const int64_t dphi_dx_offset,
+              const int64_t dphi_dy_offset,
+              const int64_t dphi_dz_offset
+              ){
+
+   /*gpuglmem*/ const double* phi = 
+	           (/*gpuglmem*/ double*) (buffer + phi_offset); 
+   /*gpuglmem*/       double* dphi_dx = 
+	           (/*gpuglmem*/ double*) (buffer + dphi_dx_offset); 
+   /*gpuglmem*/       double* dphi_dy = 
+	           (/*gpuglmem*/ double*) (buffer + dphi_dy_offset); 
+   /*gpuglmem*/       double* dphi_dz = 
+	           (/*gpuglmem*/ double*) (buffer + dphi_dz_offset); 
+
+   const int64_t sy = nx;
+   const int64_t sz = ((int64_t) nx) * ny;
+
+   #pragma omp parallel for //only_for_context cpu_openmp 
+   for(int64_t ii=0; ii<nelem; ii++){//vectorize_over ii nelem
+      const int ix = ii % nx;
+      const int iy = (ii / sy) % ny;
+      const int iz = ii / sz;
+      if (compute_x){
+         if (ix==0 || ix==nx-1){
+            dphi_dx[ii] = 0;
+         }
+         else{
+            dphi_dx[ii] = factor_x * (phi[ii+1] - phi[ii-1]);
+         }
+      }
+      if (compute_y){
+         if (iy==0 || iy==ny-1){
+            dphi_dy[ii] = 0;
+         }
+         else{
+            dphi_dy[ii] = factor_y * (phi[ii+sy] - phi[ii-sy]);
+         }
+      }
+      if (compute_z){
+         if (iz==0 || iz==nz-1){
+            dphi_dz[ii] = 0;
+         }
+         else{
+            dphi_dz[ii] = factor_z * (phi[ii+sz] - phi[ii-sz]);
+         }
+      }
+   }//end_vectorize 
+
+}
+
+// Copies the three gradient components in a node-interleaved array
+// (dphi_dx, dphi_dy, dphi_dz of each node next to each other)
+/*gpukern*/
+void interleave_gradients(
+	      const int64_t nelem,
+/*gpuglmem*/        int8_t* buffer,
+              const int64_t dphi_dx_offset,
+              const int64_t dphi_dy_offset,
+              const int64_t dphi_dz_offset,
+              const int64_t interleaved_offset
+              ){
+
+   /*gpuglmem*/ const double* dphi_dx = 
+	           (/*gpuglmem*/ double*) (buffer + dphi_dx_offset); 
+   /*gpuglmem*/ const double* dphi_dy = 
+	           (/*gpuglmem*/ double*) (buffer + dphi_dy_offset); 
+   /*gpuglmem*/ const double* dphi_dz = 
+	           (/*gpuglmem*/ double*) (buffer + dphi_dz_offset); 
+   /*gpuglmem*/       double* interleaved = 
+	           (/*gpuglmem*/ double*) (buffer + interleaved_offset); 
+
+   #pragma omp parallel for //only_for_context cpu_openmp 
+   for(int64_t ii=0; ii<nelem; ii++){//vectorize_over ii nelem
+      interleaved[3*ii]     = dphi_dx[ii];
+      interleaved[3*ii + 1] = dphi_dy[ii];
+      interleaved[3*ii + 2] = dphi_dz[ii];
+   }//end_vectorize 
+
+}
+
 #endif
@@ -12,7 +12,7 @@
 
 
 
-/*gpufun*/ void p2m_rectmesh3d_one_particle(
+/*gpufun*/ void p2m_rectmesh3d_one_particle_to_grid(
         // INPUTS:
         const double x, 
 	const double y, 
@@ -25,6 +25,8 @@
         const double dx, const double dy, const double dz,
           // mesh dimension (number of cells)
         const int nx, const int ny, const int nz,
+          // if 0 the grid is private to the thread (no atomics needed)
+        const int use_atomics,
         // OUTPUTS:
         /*gpuglmem*/ double *grid1d
 ) {
@@ -54,19 +56,55 @@
     if (jx >= 0 && jx < nx - 1 && ix >= 0 && ix < ny - 1
         	    && kx >= 0 && kx < nz - 1)
     {
-        atomicAdd(&grid1d[jx   + ix*nx     + kx*nx*ny],     wijk);
-        atomicAdd(&grid1d[jx+1 + ix*nx     + kx*nx*ny],     wij1k);
-        atomicAdd(&grid1d[jx   + (ix+1)*nx + kx*nx*ny],     wi1jk);
-        atomicAdd(&grid1d[jx+1 + (ix+1)*nx + kx*nx*ny],     wi1j1k);
-        atomicAdd(&grid1d[jx   + ix*nx     + (kx+1)*nx*ny], wijk1);
-        atomicAdd(&grid1d[jx+1 + ix*nx     + (kx+1)*nx*ny], wij1k1);
-        atomicAdd(&grid1d[jx   + (ix+1)*nx + (kx+1)*nx*ny], wi1jk1);
-        atomicAdd(&grid1d[jx+1 + (ix+1)*nx + (kx+1)*nx*ny], wi1j1k1);
+        if (use_atomics){
+            atomicAdd(&grid1d[jx   + ix*nx     + kx*nx*ny],     wijk);
+            atomicAdd(&grid1d[jx+1 + ix*nx     + kx*nx*ny],     wij1k);
+            atomicAdd(&grid1d[jx   + (ix+1)*nx + kx*nx*ny],     wi1jk);
+            atomicAdd(&grid1d[jx+1 + (ix+1)*nx + kx*nx*ny],     wi1j1k);
+            atomicAdd(&grid1d[jx   + ix*nx     + (kx+1)*nx*ny], wijk1);
+            atomicAdd(&grid1d[jx+1 + ix*nx     + (kx+1)*nx*ny], wij1k1);
+            atomicAdd(&grid1d[jx   + (ix+1)*nx + (kx+1)*nx*ny], wi1jk1);
+            atomicAdd(&grid1d[jx+1 + (ix+1)*nx + (kx+1)*nx*ny], wi1j1k1);
+        }
+        else{
+            grid1d[jx   + ix*nx     + kx*nx*ny]     += wijk;
+            grid1d[jx+1 + ix*nx     + kx*nx*ny]     += wij1k;
+            grid1d[jx   + (ix+1)*nx + kx*nx*ny]     += wi1jk;
+            grid1d[jx+1 + (ix+1)*nx + kx*nx*ny]     += wi1j1k;
+            grid1d[jx   + ix*nx     + (kx+1)*nx*ny] += wijk1;
+            grid1d[jx+1 + ix*nx     + (kx+1)*nx*ny] += wij1k1;
+            grid1d[jx   + (ix+1)*nx + (kx+1)*nx*ny] += wi1jk1;
+            grid1d[jx+1 + (ix+1)*nx + (kx+1)*nx*ny] += wi1j1k1;
+        }
     }
 
 }
 
 
+/*gpufun*/ void p2m_rectmesh3d_one_particle(
+        // INPUTS:
+        const double x, 
+	const double y, 
+	const double z,
+	  // particle weight
+	const double pwei,
+          // mesh origin
+        const double x0, const double y0, const double z0,
+          // mesh distances per cell
+        const double dx, const double dy, const double dz,
+          // mesh dimension (number of cells)
+        const int nx, const int ny, const int nz,
+        // OUTPUTS:
+        /*gpuglmem*/ double *grid1d
+) {
+
+    p2m_rectmesh3d_one_particle_to_grid(x, y, z, pwei,
+                                        x0, y0, z0, dx, dy, dz, nx, ny, nz,
+                                        1, grid1d);
+
+}
+
+
 /*gpukern*/ void p2m_rectmesh3d(
         // INPUTS:
           // length of x, y, z arrays
@@ -143,4 +181,680 @@
     }//end_vectorize
 
 }
+
+// Triangular-shaped-cloud (TSC) deposition: each particle is spread over
+// the 3x3x3 nodes around the nearest node with quadratic weights.
+
+/*gpufun*/ void p2m_tsc_weights(const double u, int* i_center, double* w){
+    // u is the position in units of the grid spacing from the first node
+    const int ic = floor(u + 0.5);
+    const double d = u - ic;
+    *i_center = ic;
+    w[0] = 0.5 * (0.5 - d) * (0.5 - d);
+    w[1] = 0.75 - d * d;
+    w[2] = 0.5 * (0.5 + d) * (0.5 + d);
+}
+
+/*gpufun*/ void p2m_rectmesh3d_one_particle_tsc_to_grid(
+        // INPUTS:
+        const double x, 
+	const double y, 
+	const double z,
+	  // particle weight
+	const double pwei,
+          // mesh origin
+        const double x0, const double y0, const double z0,
+          // mesh distances per cell
+        const double dx, const double dy, const double dz,
+          // mesh dimension (number of cells)
+        const int nx, const int ny, const int nz,
+          // if 0 the grid is private to the thread (no atomics needed)
+        const int use_atomics,
+        // OUTPUTS:
+        /*gpuglmem*/ double *grid1d
+) {
+
+    int jx, ix, kx;
+    double wx[3], wy[3], wz[3];
+    p2m_tsc_weights((x - x0) / dx, &jx, wx);
+    p2m_tsc_weights((y - y0) / dy, &ix, wy);
+    p2m_tsc_weights((z - z0) / dz, &kx, wz);
+
+    // The full stencil needs to be on the grid
+    if (jx >= 1 && jx < nx - 1 && ix >= 1 && ix < ny - 1
+        	    && kx >= 1 && kx < nz - 1)
+    {
+        const double wtot = pwei / (dx*dy*dz);
+        for (int kk=0; kk<3; kk++){
+            for (int ii=0; ii<3; ii++){
+                const double wyz = wtot * wy[ii] * wz[kk];
+                const int64_t offset = (jx - 1) + ((int64_t) (ix - 1 + ii))*nx
+                                   + ((int64_t) (kx - 1 + kk))*nx*ny;
+                for (int jj=0; jj<3; jj++){
+                    if (use_atomics){
+                        atomicAdd(&grid1d[offset + jj], wyz * wx[jj]);
+                    }
+                    else{
+                        grid1d[offset + jj] += wyz * wx[jj];
+                    }
+                }
+            }
+        }
+    }
+
+}
+
+/*gpufun*/ void p2m_rectmesh3d_one_particle_shape_to_grid(
+        const double x, const double y, const double z,
+	const double pwei,
+        const double x0, const double y0, const double z0,
+        const double dx, const double dy, const double dz,
+        const int nx, const int ny, const int nz,
+          // 1: cloud in cell, 2: triangular shaped cloud
+        const int shape_order,
+        const int use_atomics,
+        /*gpuglmem*/ double *grid1d
+) {
+    if (shape_order == 2){
+        p2m_rectmesh3d_one_particle_tsc_to_grid(x, y, z, pwei,
+                                        x0, y0, z0, dx, dy, dz, nx, ny, nz,
+                                        use_atomics, grid1d);
+    }
+    else{
+        p2m_rectmesh3d_one_particle_to_grid(x, y, z, pwei,
+                                        x0, y0, z0, dx, dy, dz, nx, ny, nz,
+                                        use_atomics, grid1d);
+    }
+}
+
+/*gpukern*/ void p2m_rectmesh3d_tsc(
+        // INPUTS:
+          // length of x, y, z arrays
+        const int nparticles,
+          // particle positions
+        /*gpuglmem*/ const double* x, 
+	/*gpuglmem*/ const double* y, 
+	/*gpuglmem*/ const double* z,
+	  // particle weights and stat flags
+	/*gpuglmem*/ const double* part_weights,
+	/*gpuglmem*/ const int64_t* part_state,
+          // mesh origin
+        const double x0, const double y0, const double z0,
+          // mesh distances per cell
+        const double dx, const double dy, const double dz,
+          // mesh dimension (number of cells)
+        const int nx, const int ny, const int nz,
+        // OUTPUTS:
+        /*gpuglmem*/ int8_t*  grid1d_buffer,
+	             int64_t  grid1d_offset){
+
+    /*gpuglmem*/ double* grid1d = 
+    	(/*gpuglmem*/ double*)(grid1d_buffer + grid1d_offset);
+
+    #pragma omp parallel for //only_for_context cpu_openmp 
+    for (int pidx=0; pidx<nparticles; pidx++){ //vectorize_over pidx nparticles
+        if (part_state[pidx] > 0){
+            p2m_rectmesh3d_one_particle_tsc_to_grid(
+                                x[pidx], y[pidx], z[pidx], part_weights[pidx],
+                                x0, y0, z0, dx, dy, dz, nx, ny, nz,
+                                1, grid1d);
+        }
+    }//end_vectorize
+}
+
+/*gpukern*/ void p2m_rectmesh3d_xparticles_tsc(
+        // INPUTS:
+          // length of x, y, z arrays
+        const int nparticles,
+	ParticlesData particles,
+          // mesh origin
+        const double x0, const double y0, const double z0,
+          // mesh distances per cell
+        const double dx, const double dy, const double dz,
+          // mesh dimension (number of cells)
+        const int nx, const int ny, const int nz,
+        // OUTPUTS:
+        /*gpuglmem*/ int8_t*  grid1d_buffer,
+	             int64_t  grid1d_offset){
+
+    /*gpuglmem*/ const double* x = ParticlesData_getp1_x(particles, 0); 
+    /*gpuglmem*/ const double* y = ParticlesData_getp1_y(particles, 0); 
+    /*gpuglmem*/ const double* z = ParticlesData_getp1_zeta(particles, 0);
+    /*gpuglmem*/ const double* part_weights = ParticlesData_getp1_weight(
+    		                                             particles, 0);
+    /*gpuglmem*/ const int64_t* part_state = ParticlesData_getp1_state(
+    		                                             particles, 0);
+    // TODO I am forgetting about charge_ratio and mass_ratio
+    const double q0_coulomb = QELEM * ParticlesData_get_q0(particles);
+
+    /*gpuglmem*/ double* grid1d = 
+    	(/*gpuglmem*/ double*)(grid1d_buffer + grid1d_offset);
+
+    #pragma omp parallel for //only_for_context cpu_openmp 
+    for (int pidx=0; pidx<nparticles; pidx++){ //vectorize_over pidx nparticles
+        if (part_state[pidx] > 0){
+            p2m_rectmesh3d_one_particle_tsc_to_grid(
+                                x[pidx], y[pidx], z[pidx],
+                                part_weights[pidx] * q0_coulomb,
+                                x0, y0, z0, dx, dy, dz, nx, ny, nz,
+                                1, grid1d);
+        }
+    }//end_vectorize
+}
+
+// Atomic-free deposition: the particles are split in n_grids contiguous
+// chunks, each deposited by one thread on its own private grid. The
+// private grids are then summed in a fixed order (reduce_private_grids),
+// hence the result does not depend on the number of threads.
+
+/*gpukern*/ void p2m_rectmesh3d_private_grids(
+        // INPUTS:
+          // length of x, y, z arrays
+        const int nparticles,
+          // particle positions
+        /*gpuglmem*/ const double* x, 
+	/*gpuglmem*/ const double* y, 
+	/*gpuglmem*/ const double* z,
+	  // particle weights and stat flags
+	/*gpuglmem*/ const double* part_weights,
+	/*gpuglmem*/ const int64_t* part_state,
+          // mesh origin
+        const double x0, const double y0, const double z0,
+          // mesh distances per cell
+        const double dx, const double dy, const double dz,
+          // mesh dimension (number of cells)
+        const int nx, const int ny, const int nz,
+          // 1: cloud in cell, 2: triangular shaped cloud
+        const int shape_order,
+          // number of private grids
+        const int n_grids,
+        // OUTPUTS:
+        /*gpuglmem*/ double* grids){
+
+    const int64_t n_cells = ((int64_t) nx) * ny * nz;
+    const int chunk_size = (nparticles + n_grids - 1) / n_grids;
+
+    #pragma omp parallel for //only_for_context cpu_openmp 
+    for (int igrid=0; igrid<n_grids; igrid++){ //vectorize_over igrid n_grids
+
+        /*gpuglmem*/ double* grid1d = grids + igrid * n_cells;
+        for (int64_t ii=0; ii<n_cells; ii++){
+            grid1d[ii] = 0.;
+        }
+
+        const int pstart = igrid * chunk_size;
+        const int pend = (pstart + chunk_size < nparticles) ?
+                                        pstart + chunk_size : nparticles;
+        for (int pidx=pstart; pidx<pend; pidx++){
+            if (part_state[pidx] > 0){
+                double pwei = part_weights[pidx];
+
+                p2m_rectmesh3d_one_particle_shape_to_grid(
+                                    x[pidx], y[pidx], z[pidx], pwei,
+                                    x0, y0, z0, dx, dy, dz, nx, ny, nz,
+                                    shape_order, 0, grid1d);
+            }
+        }
+    }//end_vectorize
+}
+
+/*gpukern*/ void p2m_rectmesh3d_xparticles_private_grids(
+        // INPUTS:
+          // length of x, y, z arrays
+        const int nparticles,
+	ParticlesData particles,
+          // mesh origin
+        const double x0, const double y0, const double z0,
+          // mesh distances per cell
+        const double dx, const double dy, const double dz,
+          // mesh dimension (number of cells)
+        const int nx, const int ny, const int nz,
+          // 1: cloud in cell, 2: triangular shaped cloud
+        const int shape_order,
+          // number of private grids
+        const int n_grids,
+        // OUTPUTS:
+        /*gpuglmem*/ double* grids){
+
+    /*gpuglmem*/ const double* x = ParticlesData_getp1_x(particles, 0); 
+    /*gpuglmem*/ const double* y = ParticlesData_getp1_y(particles, 0); 
+    /*gpuglmem*/ const double* z = ParticlesData_getp1_zeta(particles, 0);
+    /*gpuglmem*/ const double* part_weights = ParticlesData_getp1_weight(
+    		                                             particles, 0);
+    /*gpuglmem*/ const int64_t* part_state = ParticlesData_getp1_state(
+    		                                             particles, 0);
+    // TODO I am forgetting about charge_ratio and mass_ratio
+    const double q0_coulomb = QELEM * ParticlesData_get_q0(particles);
+
+    const int64_t n_cells = ((int64_t) nx) * ny * nz;
+    const int chunk_size = (nparticles + n_grids - 1) / n_grids;
+
+    #pragma omp parallel for //only_for_context cpu_openmp 
+    for (int igrid=0; igrid<n_grids; igrid++){ //vectorize_over igrid n_grids
+
+        /*gpuglmem*/ double* grid1d = grids + igrid * n_cells;
+        for (int64_t ii=0; ii<n_cells; ii++){
+            grid1d[ii] = 0.;
+        }
+
+        const int pstart = igrid * chunk_size;
+        const int pend = (pstart + chunk_size < nparticles) ?
+                                        pstart + chunk_size : nparticles;
+        for (int pidx=pstart; pidx<pend; pidx++){
+            if (part_state[pidx] > 0){
+                double pwei = part_weights[pidx] * q0_coulomb;
+
+                p2m_rectmesh3d_one_particle_shape_to_grid(
+                                    x[pidx], y[pidx], z[pidx], pwei,
+                                    x0, y0, z0, dx, dy, dz, nx, ny, nz,
+                                    shape_order, 0, grid1d);
+            }
+        }
+    }//end_vectorize
+}
+
+/*gpukern*/ void reduce_private_grids(
+        const int64_t n_cells,
+        const int n_grids,
+        /*gpuglmem*/ const double* grids,
+        // OUTPUTS:
+        /*gpuglmem*/ int8_t*  grid1d_buffer,
+	             int64_t  grid1d_offset){
+
+    /*gpuglmem*/ double* grid1d = 
+    	(/*gpuglmem*/ double*)(grid1d_buffer + grid1d_offset);
+
+    #pragma omp parallel for //only_for_context cpu_openmp 
+    for (int64_t ii=0; ii<n_cells; ii++){ //vectorize_over ii n_cells
+        double val = 0.;
+        for (int igrid=0; igrid<n_grids; igrid++){
+            val += grids[ii + igrid * n_cells];
+        }
+        grid1d[ii] += val;
+    }//end_vectorize
+}
+
+
+// Cell-sorted deposition: the particles are binned by cell (index of the
+// lower grid node) and each grid node gathers the contributions of the
+// particles in the eight surrounding cells. No atomics are needed and the
+// accesses to the grid are sequential.
+
+/*gpukern*/ void p2m_cell_index_xparticles(
+        // INPUTS:
+        const int nparticles,
+	ParticlesData particles,
+          // mesh origin
+        const double x0, const double y0, const double z0,
+          // mesh distances per cell
+        const double dx, const double dy, const double dz,
+          // mesh dimension (number of cells)
+        const int nx, const int ny, const int nz,
+        // OUTPUTS:
+          // cell of each particle (nx*ny*nz if lost or outside the grid)
+        /*gpuglmem*/ int64_t* cell_index){
+
+    /*gpuglmem*/ const double* x = ParticlesData_getp1_x(particles, 0); 
+    /*gpuglmem*/ const double* y = ParticlesData_getp1_y(particles, 0); 
+    /*gpuglmem*/ const double* z = ParticlesData_getp1_zeta(particles, 0);
+    /*gpuglmem*/ const int64_t* part_state = ParticlesData_getp1_state(
+    		                                             particles, 0);
+
+    const int64_t n_cells = ((int64_t) nx) * ny * nz;
+
+    #pragma omp parallel for //only_for_context cpu_openmp 
+    for (int pidx=0; pidx<nparticles; pidx++){ //vectorize_over pidx nparticles
+
+        int64_t cell = n_cells;
+        if (part_state[pidx] > 0){
+            int jx = floor((x[pidx] - x0) / dx);
+            int ix = floor((y[pidx] - y0) / dy);
+            int kx = floor((z[pidx] - z0) / dz);
+            if (jx >= 0 && jx < nx - 1 && ix >= 0 && ix < ny - 1
+        	    && kx >= 0 && kx < nz - 1){
+                cell = jx + ((int64_t) ix)*nx + ((int64_t) kx)*nx*ny;
+            }
+        }
+        cell_index[pidx] = cell;
+
+    }//end_vectorize
+}
+
+/*gpukern*/ void p2m_rectmesh3d_xparticles_cell_sorted(
+        // INPUTS:
+        const int64_t n_nodes,
+	ParticlesData particles,
+          // particle indices sorted by cell
+        /*gpuglmem*/ const int64_t* sorted_particles,
+          // position in sorted_particles of the first particle of each cell
+        /*gpuglmem*/ const int64_t* cell_start,
+          // mesh origin
+        const double x0, const double y0, const double z0,
+          // mesh distances per cell
+        const double dx, const double dy, const double dz,
+          // mesh dimension (number of cells)
+        const int nx, const int ny, const int nz,
+        // OUTPUTS:
+        /*gpuglmem*/ int8_t*  grid1d_buffer,
+	             int64_t  grid1d_offset){
+
+    /*gpuglmem*/ const double* x = ParticlesData_getp1_x(particles, 0); 
+    /*gpuglmem*/ const double* y = ParticlesData_getp1_y(particles, 0); 
+    /*gpuglmem*/ const double* z = ParticlesData_getp1_zeta(particles, 0);
+    /*gpuglmem*/ const double* part_weights = ParticlesData_getp1_weight(
+    		                                             particles, 0);
+    // TODO I am forgetting about charge_ratio and mass_ratio
+    const double q0_coulomb = QELEM * ParticlesData_get_q0(particles);
+    const double vol_m1 = 1/(dx*dy*dz);
+
+    /*gpuglmem*/ double* grid1d = 
+    	(/*gpuglmem*/ double*)(grid1d_buffer + grid1d_offset);
+
+    #pragma omp parallel for //only_for_context cpu_openmp 
+    for (int64_t inode=0; inode<n_nodes; inode++){ //vectorize_over inode n_nodes
+
+        const int jn = inode % nx;
+        const int in = (inode / nx) % ny;
+        const int kn = inode / (((int64_t) nx) * ny);
+
+        double val = 0.;
+        for (int ck=0; ck<2; ck++){
+            const int kx = kn - ck;
+            if (kx < 0 || kx >= nz - 1) continue;
+            for (int ci=0; ci<2; ci++){
+                const int ix = in - ci;
+                if (ix < 0 || ix >= ny - 1) continue;
+                for (int cj=0; cj<2; cj++){
+                    const int jx = jn - cj;
+                    if (jx < 0 || jx >= nx - 1) continue;
+
+                    const int64_t cell = jx + ((int64_t) ix)*nx
+                                            + ((int64_t) kx)*nx*ny;
+                    for (int64_t ss=cell_start[cell]; ss<cell_start[cell+1];
+                                                                      ss++){
+                        const int64_t pidx = sorted_particles[ss];
+                        const double fx = (x[pidx] - (x0 + jx * dx)) / dx;
+                        const double fy = (y[pidx] - (y0 + ix * dy)) / dy;
+                        const double fz = (z[pidx] - (z0 + kx * dz)) / dz;
+                        val += part_weights[pidx] * q0_coulomb * vol_m1
+                               * (cj ? fx : 1. - fx)
+                               * (ci ? fy : 1. - fy)
+                               * (ck ? fz : 1. - fz);
+                    }
+                }
+            }
+        }
+        grid1d[inode] += val;
+
+    }//end_vectorize
+}
+
+
+// Factorized 2.5D deposition: the transverse charge density (C/m^2) is
+// deposited on a 2D grid and the line density (C/m) on a 1D grid. Only the
+// particles that would be deposited on the 3D grid are considered.
+
+/*gpufun*/ void p2m_rectmesh2p5d_one_particle(
+        const double x, 
+	const double y, 
+	const double z,
+	const double pwei,
+        const double x0, const double y0, const double z0,
+        const double dx, const double dy, const double dz,
+        const int nx, const int ny, const int nz,
+        // OUTPUTS:
+        /*gpuglmem*/ double *grid2d,
+        /*gpuglmem*/ double *line_density
+) {
+
+    // indices
+    int jx = floor((x - x0) / dx);
+    int ix = floor((y - y0) / dy);
+    int kx = floor((z - z0) / dz);
+
+    if (jx >= 0 && jx < nx - 1 && ix >= 0 && ix < ny - 1
+        	    && kx >= 0 && kx < nz - 1)
+    {
+        // normalized distances
+        double fx = (x - (x0 + jx * dx)) / dx;
+        double fy = (y - (y0 + ix * dy)) / dy;
+        double fz = (z - (z0 + kx * dz)) / dz;
+
+        double wxy = pwei / (dx * dy);
+        atomicAdd(&grid2d[jx   + ix*nx],     wxy * (1.-fx) * (1.-fy));
+        atomicAdd(&grid2d[jx+1 + ix*nx],     wxy * fx      * (1.-fy));
+        atomicAdd(&grid2d[jx   + (ix+1)*nx], wxy * (1.-fx) * fy);
+        atomicAdd(&grid2d[jx+1 + (ix+1)*nx], wxy * fx      * fy);
+
+        double wz = pwei / dz;
+        atomicAdd(&line_density[kx],   wz * (1.-fz));
+        atomicAdd(&line_density[kx+1], wz * fz);
+    }
+
+}
+
+/*gpukern*/ void p2m_rectmesh2p5d(
+        const int nparticles,
+        /*gpuglmem*/ const double* x, 
+	/*gpuglmem*/ const double* y, 
+	/*gpuglmem*/ const double* z,
+	/*gpuglmem*/ const double* part_weights,
+	/*gpuglmem*/ const int64_t* part_state,
+        const double x0, const double y0, const double z0,
+        const double dx, const double dy, const double dz,
+        const int nx, const int ny, const int nz,
+        // OUTPUTS:
+        /*gpuglmem*/ double* grid2d,
+        /*gpuglmem*/ double* line_density){
+
+    #pragma omp parallel for //only_for_context cpu_openmp 
+    for (int pidx=0; pidx<nparticles; pidx++){ //vectorize_over pidx nparticles
+        if (part_state[pidx] > 0){
+            p2m_rectmesh2p5d_one_particle(x[pidx], y[pidx], z[pidx],
+                                          part_weights[pidx],
+                                          x0, y0, z0, dx, dy, dz,
+                                          nx, ny, nz,
+                                          grid2d, line_density);
+        }
+    }//end_vectorize
+}
+
+/*gpukern*/ void p2m_rectmesh2p5d_xparticles(
+        const int nparticles,
+	ParticlesData particles,
+        const double x0, const double y0, const double z0,
+        const double dx, const double dy, const double dz,
+        const int nx, const int ny, const int nz,
+        // OUTPUTS:
+        /*gpuglmem*/ double* grid2d,
+        /*gpuglmem*/ double* line_density){
+
+    /*gpuglmem*/ const double* x = ParticlesData_getp1_x(particles, 0); 
+    /*gpuglmem*/ const double* y = ParticlesData_getp1_y(particles, 0); 
+    /*gpuglmem*/ const double* z = ParticlesData_getp1_zeta(particles, 0);
+    /*gpuglmem*/ const double* part_weights = ParticlesData_getp1_weight(
+    		                                             particles, 0);
+    /*gpuglmem*/ const int64_t* part_state = ParticlesData_getp1_state(
+    		                                             particles, 0);
+    // TODO I am forgetting about charge_ratio and mass_ratio
+    const double q0_coulomb = QELEM * ParticlesData_get_q0(particles);
+
+    #pragma omp parallel for //only_for_context cpu_openmp 
+    for (int pidx=0; pidx<nparticles; pidx++){ //vectorize_over pidx nparticles
+        if (part_state[pidx] > 0){
+            p2m_rectmesh2p5d_one_particle(x[pidx], y[pidx], z[pidx],
+                                          part_weights[pidx] * q0_coulomb,
+                                          x0, y0, z0, dx, dy, dz,
+                                          nx, ny, nz,
+                                          grid2d, line_density);
+        }
+    }//end_vectorize
+}
+
+// Grid statistics: the particles are split in n_chunks contiguous chunks,
+// each accumulating (without atomics) in its own row of stats:
+// [n_on_grid, n_out_of_grid, charge_on_grid, charge_out_of_grid,
+//  x_min, x_max, y_min, y_max, z_min, z_max] (bounding box of the active
+// particles). A particle is out of grid if its stencil (depending on the
+// shape order) is not fully on the grid, in which case it is not deposited
+// and it gets no field from the interpolators.
+
+#define P2M_N_GRID_STATS 10
+
+/*gpufun*/ int p2m_is_on_grid(
+        const double x, const double y, const double z,
+        const double x0, const double y0, const double z0,
+        const double dx, const double dy, const double dz,
+        const int nx, const int ny, const int nz,
+        const int shape_order){
+
+    if (shape_order == 2){
+        const int jx = floor((x - x0) / dx + 0.5);
+        const int ix = floor((y - y0) / dy + 0.5);
+        const int kx = floor((z - z0) / dz + 0.5);
+        return (jx >= 1 && jx < nx - 1 && ix >= 1 && ix < ny - 1
+                && kx >= 1 && kx < nz - 1);
+    }
+    const int jx = floor((x - x0) / dx);
+    const int ix = floor((y - y0) / dy);
+    const int kx = floor((z - z0) / dz);
+    return (jx >= 0 && jx < nx - 1 && ix >= 0 && ix < ny - 1
+            && kx >= 0 && kx < nz - 1);
+}
+
+/*gpufun*/ void p2m_grid_stats_one_chunk(
+        const int pstart, const int pend,
+        /*gpuglmem*/ const double* x, 
+	/*gpuglmem*/ const double* y, 
+	/*gpuglmem*/ const double* z,
+	/*gpuglmem*/ const double* part_weights,
+	/*gpuglmem*/ const int64_t* part_state,
+        const double weight_factor,
+        const double x0, const double y0, const double z0,
+        const double dx, const double dy, const double dz,
+        const int nx, const int ny, const int nz,
+        const int shape_order,
+        // OUTPUTS:
+        /*gpuglmem*/ double* stats){
+
+    double n_on = 0., n_out = 0., q_on = 0., q_out = 0.;
+    double x_min = 1e300, y_min = 1e300, z_min = 1e300;
+    double x_max = -1e300, y_max = -1e300, z_max = -1e300;
+
+    for (int pidx=pstart; pidx<pend; pidx++){
+        if (part_state[pidx] > 0){
+            const double pwei = part_weights[pidx] * weight_factor;
+            if (p2m_is_on_grid(x[pidx], y[pidx], z[pidx],
+                               x0, y0, z0, dx, dy, dz, nx, ny, nz,
+                               shape_order)){
+                n_on += 1.;
+                q_on += pwei;
+            }
+            else{
+                n_out += 1.;
+                q_out += pwei;
+            }
+            if (x[pidx] < x_min) x_min = x[pidx];
+            if (x[pidx] > x_max) x_max = x[pidx];
+            if (y[pidx] < y_min) y_min = y[pidx];
+            if (y[pidx] > y_max) y_max = y[pidx];
+            if (z[pidx] < z_min) z_min = z[pidx];
+            if (z[pidx] > z_max) z_max = z[pidx];
+        }
+    }
+
+    stats[0] = n_on;
+    stats[1] = n_out;
+    stats[2] = q_on;
+    stats[3] = q_out;
+    stats[4] = x_min;
+    stats[5] = x_max;
+    stats[6] = y_min;
+    stats[7] = y_max;
+    stats[8] = z_min;
+    stats[9] = z_max;
+}
+
+/*gpukern*/ void p2m_grid_stats(
+        // INPUTS:
+          // length of x, y, z arrays
+        const int nparticles,
+          // particle positions
+        /*gpuglmem*/ const double* x, 
+	/*gpuglmem*/ const double* y, 
+	/*gpuglmem*/ const double* z,
+	  // particle weights and stat flags
+	/*gpuglmem*/ const double* part_weights,
+	/*gpuglmem*/ const int64_t* part_state,
+          // mesh origin
+        const double x0, const double y0, const double z0,
+          // mesh distances per cell
+        const double dx, const double dy, const double dz,
+          // mesh dimension (number of cells)
+        const int nx, const int ny, const int nz,
+          // 1: cloud in cell, 2: triangular shaped cloud
+        const int shape_order,
+          // number of chunks
+        const int n_chunks,
+        // OUTPUTS:
+        /*gpuglmem*/ double* stats){
+
+    const int chunk_size = (nparticles + n_chunks - 1) / n_chunks;
+
+    #pragma omp parallel for //only_for_context cpu_openmp 
+    for (int ichunk=0; ichunk<n_chunks; ichunk++){ //vectorize_over ichunk n_chunks
+        const int pstart = ichunk * chunk_size;
+        const int pend = (pstart + chunk_size < nparticles) ?
+                                        pstart + chunk_size : nparticles;
+        p2m_grid_stats_one_chunk(pstart, pend, x, y, z,
+                                 part_weights, part_state, 1.,
+                                 x0, y0, z0, dx, dy, dz, nx, ny, nz,
+                                 shape_order,
+                                 stats + ichunk * P2M_N_GRID_STATS);
+    }//end_vectorize
+}
+
+/*gpukern*/ void p2m_grid_stats_xparticles(
+        // INPUTS:
+          // length of x, y, z arrays
+        const int nparticles,
+	ParticlesData particles,
+          // mesh origin
+        const double x0, const double y0, const double z0,
+          // mesh distances per cell
+        const double dx, const double dy, const double dz,
+          // mesh dimension (number of cells)
+        const int nx, const int ny, const int nz,
+          // 1: cloud in cell, 2: triangular shaped cloud
+        const int shape_order,
+          // number of chunks
+        const int n_chunks,
+        // OUTPUTS:
+        /*gpuglmem*/ double* stats){
+
+    /*gpuglmem*/ const double* x = ParticlesData_getp1_x(particles, 0); 
+    /*gpuglmem*/ const double* y = ParticlesData_getp1_y(particles, 0); 
+    /*gpuglmem*/ const double* z = ParticlesData_getp1_zeta(particles, 0);
+    /*gpuglmem*/ const double* part_weights = ParticlesData_getp1_weight(
+    		                                             particles, 0);
+    /*gpuglmem*/ const int64_t* part_state = ParticlesData_getp1_state(
+    		                                             particles, 0);
+    // TODO I am forgetting about charge_ratio and mass_ratio
+    const double q0_coulomb = QELEM * ParticlesData_get_q0(particles);
+
+    const int chunk_size = (nparticles + n_chunks - 1) / n_chunks;
+
+    #pragma omp parallel for //only_for_context cpu_openmp 
+    for (int ichunk=0; ichunk<n_chunks; ichunk++){ //vectorize_over ichunk n_chunks
+        const int pstart = ichunk * chunk_size;
+        const int pend = (pstart + chunk_size < nparticles) ?
+                                        pstart + chunk_size : nparticles;
+        p2m_grid_stats_one_chunk(pstart, pend, x, y, z,
+                                 part_weights, part_state, q0_coulomb,
+                                 x0, y0, z0, dx, dy, dz, nx, ny, nz,
+                                 shape_order,
+                                 stats + ichunk * P2M_N_GRID_STATS);
+    }//end_vectorize
+}
+
 #endif
@@ -33,10 +33,178 @@ void TriCubicInterpolatedFieldMap_construct_b(
     return ;
 }
 
+// Coefficients of the cell (ix, iy, iz), taken from the coefficient cache
+// if the cell is in the cached box or from the cell table of the cell-grouped
+// evaluation if the cell is registered in it, and computed from phi_taylor
+// otherwise
 /*gpufun*/
-int TriCubicInterpolatedFieldMap_interpolate_grad(
+void TriCubicInterpolatedFieldMap_get_coefficients(
+	TriCubicInterpolatedFieldMapData fmap,
+	   const int64_t ix, const int64_t iy, const int64_t iz, 
+       double* coefs){
+
+    const int64_t jx = ix - TriCubicInterpolatedFieldMapData_get_cache_ix0(fmap);
+    const int64_t jy = iy - TriCubicInterpolatedFieldMapData_get_cache_iy0(fmap);
+    const int64_t jz = iz - TriCubicInterpolatedFieldMapData_get_cache_iz0(fmap);
+    const int64_t cache_nx = TriCubicInterpolatedFieldMapData_get_cache_nx(fmap);
+    const int64_t cache_ny = TriCubicInterpolatedFieldMapData_get_cache_ny(fmap);
+    const int64_t cache_nz = TriCubicInterpolatedFieldMapData_get_cache_nz(fmap);
+
+    if (jx >= 0 && jx < cache_nx && jy >= 0 && jy < cache_ny
+            && jz >= 0 && jz < cache_nz){
+        /*gpuglmem*/ double* cached = TriCubicInterpolatedFieldMapData_getp1_coefs(
+                fmap, 64 * (jx + cache_nx * (jy + cache_ny * jz)));
+        for (int l = 0; l < 64; l++){
+            coefs[l] = cached[l];
+        }
+        return;
+    }
+
+    if (TriCubicInterpolatedFieldMapData_len_cell_slot(fmap) > 0){
+        const int64_t nx = TriCubicInterpolatedFieldMapData_get_nx(fmap);
+        const int64_t ny = TriCubicInterpolatedFieldMapData_get_ny(fmap);
+        const int64_t slot = TriCubicInterpolatedFieldMapData_get_cell_slot(
+                fmap, ix + (nx - 1) * (iy + (ny - 1) * iz));
+        if (slot >= 0){
+            /*gpuglmem*/ double* stored = TriCubicInterpolatedFieldMapData_getp1_slot_coefs(
+                    fmap, 64 * slot);
+            for (int l = 0; l < 64; l++){
+                coefs[l] = stored[l];
+            }
+            return;
+        }
+    }
+
+    double b_vector[64];
+    TriCubicInterpolatedFieldMap_construct_b(fmap, ix, iy, iz, b_vector);
+    TriCubicInterpolatedFieldMap_construct_coefficients(b_vector, coefs);
+}
+
+// Fills the coefficient cache (one thread per cached cell)
+/*gpukern*/
+void TriCubicInterpolatedFieldMap_build_coefficient_cache(
+	TriCubicInterpolatedFieldMapData fmap,
+	   const int64_t n_cells){
+
+    const int64_t ix0 = TriCubicInterpolatedFieldMapData_get_cache_ix0(fmap);
+    const int64_t iy0 = TriCubicInterpolatedFieldMapData_get_cache_iy0(fmap);
+    const int64_t iz0 = TriCubicInterpolatedFieldMapData_get_cache_iz0(fmap);
+    const int64_t cache_nx = TriCubicInterpolatedFieldMapData_get_cache_nx(fmap);
+    const int64_t cache_ny = TriCubicInterpolatedFieldMapData_get_cache_ny(fmap);
+    /*gpuglmem*/ double* cache = TriCubicInterpolatedFieldMapData_getp1_coefs(fmap, 0);
+
+    #pragma omp parallel for //only_for_context cpu_openmp 
+    for (int64_t ic=0; ic<n_cells; ic++){ //vectorize_over ic n_cells
+        const int64_t ix = ix0 + ic % cache_nx;
+        const int64_t iy = iy0 + (ic / cache_nx) % cache_ny;
+        const int64_t iz = iz0 + ic / (cache_nx * cache_ny);
+
+        double b_vector[64];
+        double coefs[64];
+        TriCubicInterpolatedFieldMap_construct_b(fmap, ix, iy, iz, b_vector);
+        TriCubicInterpolatedFieldMap_construct_coefficients(b_vector, coefs);
+        for (int l = 0; l < 64; l++){
+            cache[64 * ic + l] = coefs[l];
+        }
+    }//end_vectorize
+}
+
+// Computes the coefficients of the given cells once (one thread per cell)
+// and registers them in the cell table, so that all the particles located
+// in these cells share them
+/*gpukern*/
+void TriCubicInterpolatedFieldMap_build_slot_coefficients(
+	TriCubicInterpolatedFieldMapData fmap,
+	   const int64_t n_slots,
+	   /*gpuglmem*/ const int64_t* slot_cells){
+
+    const int64_t nx = TriCubicInterpolatedFieldMapData_get_nx(fmap);
+    const int64_t ny = TriCubicInterpolatedFieldMapData_get_ny(fmap);
+    /*gpuglmem*/ int64_t* cell_slot = TriCubicInterpolatedFieldMapData_getp1_cell_slot(fmap, 0);
+    /*gpuglmem*/ double* slot_coefs = TriCubicInterpolatedFieldMapData_getp1_slot_coefs(fmap, 0);
+
+    #pragma omp parallel for //only_for_context cpu_openmp 
+    for (int64_t islot=0; islot<n_slots; islot++){ //vectorize_over islot n_slots
+        const int64_t ic = slot_cells[islot];
+        const int64_t ix = ic % (nx - 1);
+        const int64_t iy = (ic / (nx - 1)) % (ny - 1);
+        const int64_t iz = ic / ((nx - 1) * (ny - 1));
+
+        double b_vector[64];
+        double coefs[64];
+        TriCubicInterpolatedFieldMap_construct_b(fmap, ix, iy, iz, b_vector);
+        TriCubicInterpolatedFieldMap_construct_coefficients(b_vector, coefs);
+        for (int l = 0; l < 64; l++){
+            slot_coefs[64 * islot + l] = coefs[l];
+        }
+        cell_slot[ic] = islot;
+    }//end_vectorize
+}
+
+// Fills phi_taylor from the potential phi (F-ordered, nx * ny * nz nodes)
+// in a single pass (one thread per node). The derivatives are normalized to
+// the cell size and computed with central differences, nested as
+// d2phi/dxdy = D_x(D_y(phi)), and are set to zero on the boundary planes of
+// the differentiated axes.
+/*gpukern*/
+void TriCubicInterpolatedFieldMap_phi_taylor_from_phi(
+	TriCubicInterpolatedFieldMapData fmap,
+	   const int64_t n_nodes,
+	   /*gpuglmem*/ const double* phi){
+
+    const int64_t nx = TriCubicInterpolatedFieldMapData_get_nx(fmap);
+    const int64_t ny = TriCubicInterpolatedFieldMapData_get_ny(fmap);
+    const int64_t nz = TriCubicInterpolatedFieldMapData_get_nz(fmap);
+    /*gpuglmem*/ double* phi_taylor = TriCubicInterpolatedFieldMapData_getp1_phi_taylor(fmap, 0);
+
+    const int64_t sy = nx;
+    const int64_t sz = nx * ny;
+
+    #pragma omp parallel for //only_for_context cpu_openmp 
+    for (int64_t ii=0; ii<n_nodes; ii++){ //vectorize_over ii n_nodes
+        const int64_t ix = ii % nx;
+        const int64_t iy = (ii / sy) % ny;
+        const int64_t iz = ii / sz;
+
+        const int inner_x = (ix > 0) && (ix < nx - 1);
+        const int inner_y = (iy > 0) && (iy < ny - 1);
+        const int inner_z = (iz > 0) && (iz < nz - 1);
+
+        /*gpuglmem*/ double* out = phi_taylor + 8 * ii;
+
+        out[0] = phi[ii];
+        out[1] = inner_x ? 0.5 * (phi[ii + 1] - phi[ii - 1]) : 0.;
+        out[2] = inner_y ? 0.5 * (phi[ii + sy] - phi[ii - sy]) : 0.;
+        out[3] = inner_z ? 0.5 * (phi[ii + sz] - phi[ii - sz]) : 0.;
+        out[4] = (inner_x && inner_y) ?
+                   0.25 * ( (phi[ii + 1 + sy] - phi[ii + 1 - sy])
+                          - (phi[ii - 1 + sy] - phi[ii - 1 - sy]) ) : 0.;
+        out[5] = (inner_x && inner_z) ?
+                   0.25 * ( (phi[ii + 1 + sz] - phi[ii + 1 - sz])
+                          - (phi[ii - 1 + sz] - phi[ii - 1 - sz]) ) : 0.;
+        out[6] = (inner_y && inner_z) ?
+                   0.25 * ( (phi[ii + sy + sz] - phi[ii + sy - sz])
+                          - (phi[ii - sy + sz] - phi[ii - sy - sz]) ) : 0.;
+        out[7] = (inner_x && inner_y && inner_z) ?
+                   0.125 * ( ( (phi[ii + 1 + sy + sz] - phi[ii + 1 + sy - sz])
+                             - (phi[ii + 1 - sy + sz] - phi[ii + 1 - sy - sz]) )
+                           - ( (phi[ii - 1 + sy + sz] - phi[ii - 1 + sy - sz])
+                             - (phi[ii - 1 - sy + sz] - phi[ii - 1 - sy - sz]) ) ) : 0.;
+    }//end_vectorize
+}
+
+// Computes the potential (if compute_phi is non-zero) and its gradient at
+// (x, y, z). The outputs are expected to be zero-initialized: phi is
+// accumulated into *phi, while the gradient components are accumulated in
+// normalized units and then scaled in place by sign / cell size, so any
+// previous content of *dphi_dx, *dphi_dy and *dphi_dtau is scaled as well.
+// Returns 1 (leaving the outputs untouched) if the point is outside the
+// grid.
+/*gpufun*/
+int TriCubicInterpolatedFieldMap_interpolate(
 	TriCubicInterpolatedFieldMapData fmap,
 	   const double x, const double y, const double z, 
+	   const int compute_phi, double* phi,
 	   double* dphi_dx, double* dphi_dy, double* dphi_dtau){
 	
     double const x_min = TriCubicInterpolatedFieldMapData_get_x_min(fmap);
@@ -87,11 +255,8 @@ int TriCubicInterpolatedFieldMap_interpolate_grad(
         return 1;                // no need for interpolation
     }
 
-    double b_vector[64];
-    TriCubicInterpolatedFieldMap_construct_b(fmap, ix, iy, iz, b_vector);
-
     double coefs[64];
-    TriCubicInterpolatedFieldMap_construct_coefficients(b_vector, coefs);
+    TriCubicInterpolatedFieldMap_get_coefficients(fmap, ix, iy, iz, coefs);
 
     double x_power[4], y_power[4], z_power[4];
     x_power[0] = 1;
@@ -110,6 +275,17 @@ int TriCubicInterpolatedFieldMap_interpolate_grad(
     y_power[3] = y_power[2] * yn;
     z_power[3] = z_power[2] * zn;
 
+    if (compute_phi){
+        for( int i = 0; i < 4; i++ ){
+            for( int j = 0; j < 4; j++ ){
+                for( int k = 0; k < 4; k++ ){
+                    *phi += ( ( coefs[i + 4 * j + 16 * k] * x_power[i] ) 
+                                * y_power[j] ) * z_power[k];
+                }
+            }
+        }
+    }
+
     for( int i = 1; i < 4; i++ ){
         for( int j = 0; j < 4; j++ ){
             for( int k = 0; k < 4; k++ ){
@@ -143,4 +319,60 @@ int TriCubicInterpolatedFieldMap_interpolate_grad(
 	return 0;
 }
 
+/*gpufun*/
+int TriCubicInterpolatedFieldMap_interpolate_grad(
+	TriCubicInterpolatedFieldMapData fmap,
+	   const double x, const double y, const double z, 
+	   double* dphi_dx, double* dphi_dy, double* dphi_dtau){
+
+    double phi = 0.;
+    return TriCubicInterpolatedFieldMap_interpolate(fmap, x, y, z,
+            0, &phi, dphi_dx, dphi_dy, dphi_dtau);
+}
+
+// Evaluates the selected quantities (phi, dphi_dx, dphi_dy, dphi_dz, in this
+// order) at n_points points (one thread per point). The output holds one
+// block of n_points values per selected quantity; zeros are returned for
+// the points outside the grid.
+/*gpukern*/
+void TriCubicInterpolatedFieldMap_interpolate_vector(
+	TriCubicInterpolatedFieldMapData fmap,
+	   const int64_t n_points,
+	   /*gpuglmem*/ const double* x,
+	   /*gpuglmem*/ const double* y,
+	   /*gpuglmem*/ const double* z,
+	   const int64_t return_phi,
+	   const int64_t return_dphi_dx,
+	   const int64_t return_dphi_dy,
+	   const int64_t return_dphi_dz,
+	   /*gpuglmem*/ double* out){
+
+    #pragma omp parallel for //only_for_context cpu_openmp 
+    for (int64_t ip=0; ip<n_points; ip++){ //vectorize_over ip n_points
+        double phi = 0.;
+        double dphi_dx = 0.;
+        double dphi_dy = 0.;
+        double dphi_dz = 0.;
+        TriCubicInterpolatedFieldMap_interpolate(fmap, x[ip], y[ip], z[ip],
+                (int) return_phi, &phi, &dphi_dx, &dphi_dy, &dphi_dz);
+
+        int64_t iq = 0;
+        if (return_phi){
+            out[iq * n_points + ip] = phi;
+            iq++;
+        }
+        if (return_dphi_dx){
+            out[iq * n_points + ip] = dphi_dx;
+            iq++;
+        }
+        if (return_dphi_dy){
+            out[iq * n_points + ip] = dphi_dy;
+            iq++;
+        }
+        if (return_dphi_dz){
+            out[iq * n_points + ip] = dphi_dz;
+        }
+    }//end_vectorize
+}
+
 #endif
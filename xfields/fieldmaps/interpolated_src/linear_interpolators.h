@@ -103,6 +103,119 @@ double TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar(
     return val;
 }
 
+/*gpufun*/
+void TriLinearInterpolatedFieldMap_interpolate_3d_map_interleaved(
+	/*gpuglmem*/ const double* map,
+	   const IndicesAndWeights iw,
+	   const int64_t n_comp,
+	   double* vals){
+
+    // map contains 3 interleaved components per node, the first n_comp
+    // are interpolated
+    for (int64_t ic=0; ic<n_comp; ic++){
+        vals[ic] = 0.;
+    }
+
+    if (iw.ix < 0){
+	return;
+    }
+
+    const int64_t i000 = iw.ix + iw.iy * iw.nx + iw.iz * iw.nx * iw.ny;
+    const int64_t sy = iw.nx;
+    const int64_t sz = iw.nx * iw.ny;
+    for (int64_t ic=0; ic<n_comp; ic++){
+        vals[ic] = 
+    	       iw.w000 * map[3*(i000          ) + ic]
+    	     + iw.w100 * map[3*(i000 + 1      ) + ic]
+    	     + iw.w010 * map[3*(i000 + sy     ) + ic]
+    	     + iw.w110 * map[3*(i000 + 1 + sy ) + ic]
+    	     + iw.w001 * map[3*(i000 + sz     ) + ic]
+    	     + iw.w101 * map[3*(i000 + 1 + sz ) + ic]
+    	     + iw.w011 * map[3*(i000 + sy + sz) + ic]
+    	     + iw.w111 * map[3*(i000 + 1 + sy + sz) + ic];
+    }
+}
+
+typedef struct{
+    int64_t ix;
+    int64_t iy;
+    int64_t iz;
+    int64_t nx;
+    int64_t ny;
+    double wx[3];
+    double wy[3];
+    double wz[3];
+}TSCIndicesAndWeights;
+
+/*gpufun*/
+void TriLinearInterpolatedFieldMap_tsc_weights(const double u,
+                                               int64_t* i_center, double* w){
+    // u is the position in units of the grid spacing from the first node
+    const int64_t ic = floor(u + 0.5);
+    const double d = u - ic;
+    *i_center = ic;
+    w[0] = 0.5 * (0.5 - d) * (0.5 - d);
+    w[1] = 0.75 - d * d;
+    w[2] = 0.5 * (0.5 + d) * (0.5 + d);
+}
+
+/*gpufun*/
+TSCIndicesAndWeights TriLinearInterpolatedFieldMap_compute_tsc_indeces_and_weights(
+	TriLinearInterpolatedFieldMapData fmap,
+	double x, double y, double z){
+
+	TSCIndicesAndWeights iw;
+
+	const double dx = TriLinearInterpolatedFieldMapData_get_dx(fmap);
+	const double dy = TriLinearInterpolatedFieldMapData_get_dy(fmap);
+	const double dz = TriLinearInterpolatedFieldMapData_get_dz(fmap);
+	const double x0 = TriLinearInterpolatedFieldMapData_get_x_min(fmap);
+	const double y0 = TriLinearInterpolatedFieldMapData_get_y_min(fmap);
+	const double z0 = TriLinearInterpolatedFieldMapData_get_z_min(fmap);
+	const int64_t nx = TriLinearInterpolatedFieldMapData_get_nx(fmap);
+	const int64_t ny = TriLinearInterpolatedFieldMapData_get_ny(fmap);
+	const int64_t nz = TriLinearInterpolatedFieldMapData_get_nz(fmap);
+
+    	iw.nx = nx;
+    	iw.ny = ny;
+
+	TriLinearInterpolatedFieldMap_tsc_weights((x - x0) / dx, &iw.ix, iw.wx);
+	TriLinearInterpolatedFieldMap_tsc_weights((y - y0) / dy, &iw.iy, iw.wy);
+	TriLinearInterpolatedFieldMap_tsc_weights((z - z0) / dz, &iw.iz, iw.wz);
+
+	// The full stencil needs to be on the grid
+    	if (!(iw.ix >= 1 && iw.ix < nx - 1 && iw.iy >= 1 && iw.iy < ny - 1
+	    	    && iw.iz >= 1 && iw.iz < nz - 1)){
+            iw.ix = -999; 
+            iw.iy = -999; 
+            iw.iz = -999; 
+	}
+	return iw;
+}
+
+/*gpufun*/
+double TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar_tsc(
+	/*gpuglmem*/ const double* map,
+	   const TSCIndicesAndWeights iw){
+
+    if (iw.ix < 0){
+	 return 0.;
+    }
+
+    double val = 0.;
+    for (int kk=0; kk<3; kk++){
+        for (int ii=0; ii<3; ii++){
+            const int64_t offset = (iw.ix - 1) + (iw.iy - 1 + ii) * iw.nx
+                                 + (iw.iz - 1 + kk) * iw.nx * iw.ny;
+            const double wyz = iw.wy[ii] * iw.wz[kk];
+            val += wyz * (iw.wx[0] * map[offset]
+                        + iw.wx[1] * map[offset + 1]
+                        + iw.wx[2] * map[offset + 2]);
+        }
+    }
+    return val;
+}
+
 /*gpukern*/
 void TriLinearInterpolatedFieldMap_interpolate_3d_map_vector(
     TriLinearInterpolatedFieldMapData  fmap,
@@ -118,14 +231,27 @@ void TriLinearInterpolatedFieldMap_interpolate_3d_map_vector(
     #pragma omp parallel for //only_for_context cpu_openmp 
     for (int pidx=0; pidx<n_points; pidx++){ //vectorize_over pidx n_points
 
-	const IndicesAndWeights iw = 
+	if (TriLinearInterpolatedFieldMapData_get_shape_order(fmap) == 2){
+	    const TSCIndicesAndWeights iw = 
+		TriLinearInterpolatedFieldMap_compute_tsc_indeces_and_weights(
+	                                      fmap, x[pidx], y[pidx], z[pidx]);
+    	    for (int iq=0; iq<n_quantities; iq++){
+	        particles_quantities[iq*n_points + pidx] = 
+		    TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar_tsc(
+	               (/*gpuglmem*/ double*)(buffer_mesh_quantities + offsets_mesh_quantities[iq]),
+		       iw);
+	    }
+	}
+	else{
+	    const IndicesAndWeights iw = 
 		TriLinearInterpolatedFieldMap_compute_indeces_and_weights(
 	                                      fmap, x[pidx], y[pidx], z[pidx]);
-    	for (int iq=0; iq<n_quantities; iq++){
-	    particles_quantities[iq*n_points + pidx] = 
-		TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar(
-	           (/*gpuglmem*/ double*)(buffer_mesh_quantities + offsets_mesh_quantities[iq]),
-		   iw);
+    	    for (int iq=0; iq<n_quantities; iq++){
+	        particles_quantities[iq*n_points + pidx] = 
+		    TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar(
+	               (/*gpuglmem*/ double*)(buffer_mesh_quantities + offsets_mesh_quantities[iq]),
+		       iw);
+	    }
 	}
     }//end_vectorize
 }
@@ -0,0 +1,69 @@
+// copyright ################################# //
+// This file is part of the Xfields Package.   //
+// Copyright (c) CERN, 2021.                   //
+// ########################################### //
+
+#ifndef XFIELDS_TRICUBIC_CELL_GROUPING_H
+#define XFIELDS_TRICUBIC_CELL_GROUPING_H
+
+// Cell of the field map in which each particle is interpolated (as in
+// TriCubicInterpolatedFieldMap_interpolate, with the coordinates shifted as
+// in ElectronCloud and tau = zeta / beta0). Lost particles and particles
+// outside the grid are assigned to the cell index n_cells, which is not
+// stored.
+/*gpukern*/
+void TriCubicInterpolatedFieldMap_cell_of_particles(
+	TriCubicInterpolatedFieldMapData fmap,
+	   const int64_t nparticles,
+	   ParticlesData particles,
+	   const double x_shift,
+	   const double y_shift,
+	   const double tau_shift,
+	   /*gpuglmem*/ int64_t* cell){
+
+    const double x_min = TriCubicInterpolatedFieldMapData_get_x_min(fmap);
+    const double y_min = TriCubicInterpolatedFieldMapData_get_y_min(fmap);
+    const double z_min = TriCubicInterpolatedFieldMapData_get_z_min(fmap);
+    const double inv_dx = 1. / TriCubicInterpolatedFieldMapData_get_dx(fmap);
+    const double inv_dy = 1. / TriCubicInterpolatedFieldMapData_get_dy(fmap);
+    const double inv_dz = 1. / TriCubicInterpolatedFieldMapData_get_dz(fmap);
+    const int64_t nx = TriCubicInterpolatedFieldMapData_get_nx(fmap);
+    const int64_t ny = TriCubicInterpolatedFieldMapData_get_ny(fmap);
+    const int64_t nz = TriCubicInterpolatedFieldMapData_get_nz(fmap);
+    const int64_t mirror_x = TriCubicInterpolatedFieldMapData_get_mirror_x(fmap);
+    const int64_t mirror_y = TriCubicInterpolatedFieldMapData_get_mirror_y(fmap);
+    const int64_t mirror_z = TriCubicInterpolatedFieldMapData_get_mirror_z(fmap);
+    const int64_t n_cells = (nx - 1) * (ny - 1) * (nz - 1);
+
+    /*gpuglmem*/ const double* x = ParticlesData_getp1_x(particles, 0);
+    /*gpuglmem*/ const double* y = ParticlesData_getp1_y(particles, 0);
+    /*gpuglmem*/ const double* zeta = ParticlesData_getp1_zeta(particles, 0);
+    /*gpuglmem*/ const double* beta0 = ParticlesData_getp1_beta0(particles, 0);
+    /*gpuglmem*/ const int64_t* state = ParticlesData_getp1_state(particles, 0);
+
+    #pragma omp parallel for //only_for_context cpu_openmp
+    for (int64_t pidx=0; pidx<nparticles; pidx++){ //vectorize_over pidx nparticles
+        double fx = (x[pidx] - x_shift - x_min) * inv_dx;
+        double fy = (y[pidx] - y_shift - y_min) * inv_dy;
+        double fz = (zeta[pidx] / beta0[pidx] - tau_shift - z_min) * inv_dz;
+        if (mirror_x == 1 && fx < 0.) fx = -fx;
+        if (mirror_y == 1 && fy < 0.) fy = -fy;
+        if (mirror_z == 1 && fz < 0.) fz = -fz;
+
+        const double ixf = floor(fx);
+        const double iyf = floor(fy);
+        const double izf = floor(fz);
+
+        const int inside = (state[pidx] > 0)
+                        && (ixf >= 0.) && (ixf <= (double) (nx - 2))
+                        && (iyf >= 0.) && (iyf <= (double) (ny - 2))
+                        && (izf >= 0.) && (izf <= (double) (nz - 2));
+
+        cell[pidx] = inside ?
+                ((int64_t) ixf) + (nx - 1) * (((int64_t) iyf)
+                                              + (ny - 1) * ((int64_t) izf))
+                : n_cells;
+    }//end_vectorize
+}
+
+#endif
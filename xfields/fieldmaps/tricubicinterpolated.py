@@ -65,6 +65,56 @@ _TriCubicInterpolatedFieldMap_kernels = {
             ],
         n_threads='nparticles'
         ),
+    'TriCubicInterpolatedFieldMap_build_coefficient_cache': xo.Kernel(
+        args=[
+            xo.Arg(xo.ThisClass, pointer=False, name='fmap'),
+            xo.Arg(xo.Int64,   pointer=False, name='n_cells'),
+            ],
+        n_threads='n_cells'
+        ),
+    'TriCubicInterpolatedFieldMap_build_slot_coefficients': xo.Kernel(
+        args=[
+            xo.Arg(xo.ThisClass, pointer=False, name='fmap'),
+            xo.Arg(xo.Int64,   pointer=False, name='n_slots'),
+            xo.Arg(xo.Int64,   pointer=True,  name='slot_cells'),
+            ],
+        n_threads='n_slots'
+        ),
+    'TriCubicInterpolatedFieldMap_cell_of_particles': xo.Kernel(
+        args=[
+            xo.Arg(xo.ThisClass, pointer=False, name='fmap'),
+            xo.Arg(xo.Int64,   pointer=False, name='nparticles'),
+            xo.Arg(xp.Particles, pointer=False, name='particles'),
+            xo.Arg(xo.Float64, pointer=False, name='x_shift'),
+            xo.Arg(xo.Float64, pointer=False, name='y_shift'),
+            xo.Arg(xo.Float64, pointer=False, name='tau_shift'),
+            xo.Arg(xo.Int64,   pointer=True,  name='cell'),
+            ],
+        n_threads='nparticles'
+        ),
+    'TriCubicInterpolatedFieldMap_phi_taylor_from_phi': xo.Kernel(
+        args=[
+            xo.Arg(xo.ThisClass, pointer=False, name='fmap'),
+            xo.Arg(xo.Int64,   pointer=False, name='n_nodes'),
+            xo.Arg(xo.Float64, pointer=True,  name='phi'),
+            ],
+        n_threads='n_nodes'
+        ),
+    'TriCubicInterpolatedFieldMap_interpolate_vector': xo.Kernel(
+        args=[
+            xo.Arg(xo.ThisClass, pointer=False, name='fmap'),
+            xo.Arg(xo.Int64,   pointer=False, name='n_points'),
+            xo.Arg(xo.Float64, pointer=True,  name='x'),
+            xo.Arg(xo.Float64, pointer=True,  name='y'),
+            xo.Arg(xo.Float64, pointer=True,  name='z'),
+            xo.Arg(xo.Int64,   pointer=False, name='return_phi'),
+            xo.Arg(xo.Int64,   pointer=False, name='return_dphi_dx'),
+            xo.Arg(xo.Int64,   pointer=False, name='return_dphi_dy'),
+            xo.Arg(xo.Int64,   pointer=False, name='return_dphi_dz'),
+            xo.Arg(xo.Float64, pointer=True,  name='out'),
+            ],
+        n_threads='n_points'
+        ),
     }
 
 
@@ -129,6 +179,32 @@ class TriCubicInterpolatedFieldMap(xo.HybridClass):
             (1.,1.,1.).
         updatable (bool): If ``True`` the field map can be updated after
             creation. Default is ``True``.
+        cache_coefficients (bool): If ``True``, the 64 coefficients of the
+            interpolating polynomial of each cell are computed once and
+            stored, so that the interpolation does not rebuild them at each
+            call. The cache takes 64 doubles per cell (8 times the memory of
+            ``phi_taylor`` when it covers the whole grid). It is filled at
+            creation and needs to be refreshed with
+            ``update_coefficient_cache`` when ``phi_taylor`` is modified.
+            The default is ``False``.
+        coefficient_cache_range (tuple): Region covered by the coefficient
+            cache, as ``((x_min, x_max), (y_min, y_max), (z_min, z_max))``
+            in meters (in the mirrored coordinates if mirroring is enabled),
+            to bound its memory to the region populated by the particles.
+            The coefficients of the cells outside the region are computed
+            at each call. If ``None`` (default), the cache covers the whole
+            grid.
+        max_grouped_cells (int): Number of cells whose coefficients can be
+            stored by the cell-grouped evaluation of ``ElectronCloud``
+            (option ``cell_grouped``), in which the coefficients of each
+            cell occupied by the particles are computed once and shared by
+            all the particles in the cell. The store takes 64 doubles per
+            stored cell, plus a cell -> slot table of one int64 per cell of
+            the grid, i.e. (nx-1)*(ny-1)*(nz-1) integers, which is
+            allocated only if ``max_grouped_cells`` > 0. If more cells are
+            occupied, the most populated ones are stored and the
+            coefficients of the others are computed for each particle. If 0
+            (default), no store is allocated.
     Returns:
         (TriCubicInterpolatedFieldMap): Interpolator object.
     """
@@ -146,7 +222,16 @@ class TriCubicInterpolatedFieldMap(xo.HybridClass):
         'dx': xo.Float64,
         'dy': xo.Float64,
         'dz': xo.Float64,
+        'cache_ix0': xo.Int64,
+        'cache_iy0': xo.Int64,
+        'cache_iz0': xo.Int64,
+        'cache_nx': xo.Int64,
+        'cache_ny': xo.Int64,
+        'cache_nz': xo.Int64,
         'phi_taylor': xo.Float64[:],
+        'coefs': xo.Float64[:],
+        'cell_slot': xo.Int64[:],
+        'slot_coefs': xo.Float64[:],
     }
 
     # I add undescores in front of the names so that I can define custom
@@ -159,6 +244,7 @@ class TriCubicInterpolatedFieldMap(xo.HybridClass):
         _pkg_root.joinpath('fieldmaps/interpolated_src/cubic_interpolators.h'),
         _pkg_root.joinpath('fieldmaps/interpolated_src/central_diff.h'),
         _pkg_root.joinpath('fieldmaps/interpolated_src/charge_deposition.h'),
+        _pkg_root.joinpath('fieldmaps/interpolated_src/tricubic_cell_grouping.h'),
         ]
 
     _depends_on = [xp.Particles]
@@ -181,6 +267,9 @@ class TriCubicInterpolatedFieldMap(xo.HybridClass):
                  phi_taylor=None,
                  scale_coordinates_in_solver=(1.,1.,1.),
                  updatable=True,
+                 cache_coefficients=False,
+                 coefficient_cache_range=None,
+                 max_grouped_cells=0,
                  ):
 
         if _xobject is not None:
@@ -196,6 +285,18 @@ class TriCubicInterpolatedFieldMap(xo.HybridClass):
         self._z_grid = _configure_grid('z', z_grid, dz, z_range, nz)
 
         nelem = self.nx*self.ny*self.nz*8
+
+        cache_box = [(0, 0)] * 3
+        if cache_coefficients:
+            if coefficient_cache_range is None:
+                coefficient_cache_range = (None, None, None)
+            cache_box = [_get_cached_cells(grid, rr) for grid, rr in zip(
+                            (self._x_grid, self._y_grid, self._z_grid),
+                            coefficient_cache_range)]
+        n_cached_cells = int(np.prod([nn for _, nn in cache_box]))
+        n_cells = (self.nx - 1) * (self.ny - 1) * (self.nz - 1)
+        max_grouped_cells = min(max_grouped_cells, n_cells)
+
         self.xoinitialize(
                  _context=_context,
                  _buffer=_buffer,
@@ -212,8 +313,18 @@ class TriCubicInterpolatedFieldMap(xo.HybridClass):
                  mirror_x = mirror_x,
                  mirror_y = mirror_y,
                  mirror_z = mirror_z,
-                 phi_taylor = nelem
+                 cache_ix0 = cache_box[0][0],
+                 cache_iy0 = cache_box[1][0],
+                 cache_iz0 = cache_box[2][0],
+                 cache_nx = cache_box[0][1],
+                 cache_ny = cache_box[1][1],
+                 cache_nz = cache_box[2][1],
+                 phi_taylor = nelem,
+                 coefs = 64 * n_cached_cells,
+                 cell_slot = (n_cells if max_grouped_cells > 0 else 0),
+                 slot_coefs = 64 * max_grouped_cells,
                  )
+        self._cell_slot[:] = -1
 
         self.compile_kernels(only_if_needed=True)
 
@@ -231,29 +342,54 @@ class TriCubicInterpolatedFieldMap(xo.HybridClass):
                 if solver is not None and rho is not None:
                     self.update_phi_from_rho()
 
+        self.update_coefficient_cache()
+
     def _assert_updatable(self):
         assert self.updatable, 'This FieldMap is not updatable!'
 
-    #@profile
+    def update_coefficient_cache(self):
+
+        """
+        Recomputes the cached coefficients of the interpolating polynomials
+        from ``phi_taylor``. It needs to be called after ``phi_taylor`` is
+        modified when ``cache_coefficients`` is ``True`` (it does nothing
+        otherwise).
+        """
+
+        n_cells = self._cache_nx * self._cache_ny * self._cache_nz
+        if n_cells == 0:
+            return
+        self._buffer.context.kernels.TriCubicInterpolatedFieldMap_build_coefficient_cache(
+                fmap=self._xobject, n_cells=n_cells)
+
+    @property
+    def cache_coefficients(self):
+        """
+        ``True`` if the coefficients of (part of) the cells are cached.
+        """
+        return self._cache_nx * self._cache_ny * self._cache_nz > 0
+
     def get_values_at_points(self,
             x, y, z,
-            return_rho=True,
+            return_rho=False,
             return_phi=True,
             return_dphi_dx=True,
             return_dphi_dy=True,
-            return_dphi_dz=True):
+            return_dphi_dz=True,
+            out=None):
 
         """
-        Returns the charge density, the field potential and its derivatives
-        at the points specified by x, y, z. The output can be customized (see below).
+        Returns the field potential and its derivatives at the points
+        specified by x, y, z, evaluated with the tricubic interpolation in a
+        single kernel launch. The output can be customized (see below).
         Zeros are returned for points outside the grid.
 
         Args:
             x (float64 array): Horizontal coordinates at which the field is evaluated.
             y (float64 array): Vertical coordinates at which the field is evaluated.
             z (float64 array): Longitudinal coordinates at which the field is evaluated.
-            return_rho (bool): If ``True``, the charge density at the given points is
-                returned.
+            return_rho (bool): Not available for this map, as the charge
+                density is not stored. Must be ``False`` (default).
             return_phi (bool): If ``True``, the potential at the given points is returned.
             return_dphi_dx (bool): If ``True``, the horizontal derivative of the potential
                 at the given points is returned.
@@ -261,52 +397,49 @@ class TriCubicInterpolatedFieldMap(xo.HybridClass):
                 at the given points is returned.
             return_dphi_dz: If ``True``, the longitudinal derivative of the potential
                 at the given points is returned.
+            out (float64 array): Array of the context with
+                ``n_quantities * len(x)`` elements in which the result is
+                written, to avoid allocating it at each call. The returned
+                arrays are views of it.
         Returns:
             (tuple of float64 array): The required quantities at the provided points.
         """
 
-        #raise Exception("Method not checked/implemented.")
-        raise NotImplementedError
+        if return_rho:
+            raise ValueError('The charge density is not stored in a '
+                             'TriCubicInterpolatedFieldMap')
 
         assert len(x) == len(y) == len(z)
 
-        pos_in_buffer_of_maps_to_interp = []
-        if return_rho:
-            pos_in_buffer_of_maps_to_interp.append(
-                    self._xobject.rho._offset + self._xobject.rho._data_offset)
-        if return_phi:
-            pos_in_buffer_of_maps_to_interp.append(
-                    self._xobject.phi._offset + self._xobject.phi._data_offset)
-        if return_dphi_dx:
-            pos_in_buffer_of_maps_to_interp.append(
-                    self._xobject.dphi_dx._offset + self._xobject.dphi_dx._data_offset)
-        if return_dphi_dy:
-            pos_in_buffer_of_maps_to_interp.append(
-                    self._xobject.dphi_dy._offset + self._xobject.dphi_dy._data_offset)
-        if return_dphi_dz:
-            pos_in_buffer_of_maps_to_interp.append(
-                    self._xobject.dphi_dz._offset + self._xobject.dphi_dz._data_offset)
-
         context = self._buffer.context
+        n_points = len(x)
+        selection = (return_phi, return_dphi_dx, return_dphi_dy,
+                     return_dphi_dz)
+        n_quantities = sum(bool(ss) for ss in selection)
+
+        if out is None:
+            buffer_out = context.zeros(
+                    shape=(n_quantities * n_points,), dtype=np.float64)
+        else:
+            assert out.dtype == np.float64
+            assert out.size == n_quantities * n_points, (
+                f'out must have {n_quantities * n_points} elements')
+            buffer_out = out.reshape(-1)
 
-        pos_in_buffer_of_maps_to_interp = context.nparray_to_context_array(
-                        np.array(pos_in_buffer_of_maps_to_interp, dtype=np.int64))
-        nmaps_to_interp = len(pos_in_buffer_of_maps_to_interp)
-        buffer_out = context.zeros(
-                shape=(nmaps_to_interp * len(x),), dtype=np.float64)
-        if nmaps_to_interp > 0:
-            context.kernels.TriLinearInterpolatedFieldMap_interpolate_3d_map_vector(
+        if n_quantities > 0 and n_points > 0:
+            context.kernels.TriCubicInterpolatedFieldMap_interpolate_vector(
                     fmap=self._xobject,
-                    n_points=len(x),
+                    n_points=n_points,
                     x=x, y=y, z=z,
-                    n_quantities=nmaps_to_interp,
-                    buffer_mesh_quantities=self._buffer.buffer,
-                    offsets_mesh_quantities=pos_in_buffer_of_maps_to_interp,
-                    particles_quantities=buffer_out)
+                    return_phi=int(bool(return_phi)),
+                    return_dphi_dx=int(bool(return_dphi_dx)),
+                    return_dphi_dy=int(bool(return_dphi_dy)),
+                    return_dphi_dz=int(bool(return_dphi_dz)),
+                    out=buffer_out)
 
         # Split buffer 
-        particles_quantities = [buffer_out[ii*len(x):(ii+1)*len(x)]
-                                        for ii in range(nmaps_to_interp)]
+        particles_quantities = [buffer_out[ii*n_points:(ii+1)*n_points]
+                                        for ii in range(n_quantities)]
 
         return particles_quantities
 
@@ -337,11 +470,15 @@ class TriCubicInterpolatedFieldMap(xo.HybridClass):
     def update_phi(self, phi, reset=True, force=False):
 
         """
-        Updates the potential on the grid. The stored derivatives are also
-        updated.
+        Updates the potential on the grid. The Taylor components stored in
+        ``phi_taylor`` are computed from it on the device in a single pass
+        (derivatives from central differences, set to zero on the boundary
+        planes of the grid) and the coefficient cache is refreshed.
 
         Args:
-            rho (float64 array): Potential at the grid points.
+            phi (float64 array): Potential at the grid points, with shape
+                (nx, ny, nz). It can be a numpy array or an array of the
+                context.
             reset (bool): If ``True`` the stored potential is overwritten
                 with the provided one. If ``False`` the provided potential
                 is added to the stored one. The default is ``True``.
@@ -352,48 +489,22 @@ class TriCubicInterpolatedFieldMap(xo.HybridClass):
         if not force:
             self._assert_updatable()
 
-        if reset:
-            self.phi.T[:,:,:] = phi.T
-        else:
+        if not reset:
             raise ValueError('Not implemented!')
 
+        assert tuple(phi.shape) == (self.nx, self.ny, self.nz)
+
         context = self._buffer.context
 
-        # Compute gradient
-        context.kernels.central_diff(
-                nelem = self.phi.size,
-                row_size = self.nx,
-                stride_in_dbl = self.phi.strides[0]/8,
-                factor = 1/(2*self.dx),
-                matrix_buffer = self._xobject.phi._buffer.buffer,
-                matrix_offset = (self._xobject.phi._offset
-                               + self._xobject.phi._data_offset),
-                res_buffer = self._xobject.dphi_dx._buffer.buffer,
-                res_offset = (self._xobject.dphi_dx._offset
-                            + self._xobject.dphi_dx._data_offset))
-        context.kernels.central_diff(
-                nelem = self.phi.size,
-                row_size = self.ny,
-                stride_in_dbl = self.phi.strides[1]/8,
-                factor = 1/(2*self.dy),
-                matrix_buffer = self._xobject.phi._buffer.buffer,
-                matrix_offset = (self._xobject.phi._offset
-                               + self._xobject.phi._data_offset),
-                res_buffer = self._xobject.dphi_dy._buffer.buffer,
-                res_offset = (self._xobject.dphi_dy._offset
-                            + self._xobject.dphi_dy._data_offset))
-        context.kernels.central_diff(
-                nelem = self.phi.size,
-                row_size = self.nz,
-                stride_in_dbl = self.phi.strides[2]/8,
-                factor = 1/(2*self.dz),
-                matrix_buffer = self._xobject.phi._buffer.buffer,
-                matrix_offset = (self._xobject.phi._offset
-                               + self._xobject.phi._data_offset),
-                res_buffer = self._xobject.dphi_dz._buffer.buffer,
-                res_offset = (self._xobject.dphi_dz._offset
-                            + self._xobject.dphi_dz._data_offset))
+        phi = phi.ravel(order='F')
+        if isinstance(phi, np.ndarray):
+            phi = context.nparray_to_context_array(
+                                    np.ascontiguousarray(phi, dtype=np.float64))
+
+        context.kernels.TriCubicInterpolatedFieldMap_phi_taylor_from_phi(
+                fmap=self._xobject, n_nodes=len(phi), phi=phi)
 
+        self.update_coefficient_cache()
 
     def update_phi_from_rho(self, solver=None):
 
@@ -519,3 +630,85 @@ class TriCubicInterpolatedFieldMap(xo.HybridClass):
         return self.z_grid[1] - self.z_grid[0]
 
 
+class _CellGroupedCoefficients:
+
+    # Registers in the cell table of a TriCubicInterpolatedFieldMap the cells
+    # occupied by the particles and computes their coefficients once, so that
+    # the interpolation shares them among all the particles of a cell. Used
+    # by ElectronCloud when tracking with ``cell_grouped=True``. The table is
+    # shared by all the users of the map and is read by every evaluation, so
+    # it is registered only for the duration of a track (``update`` ...
+    # ``reset``) and is left clean otherwise.
+
+    def __init__(self, fieldmap):
+
+        if not isinstance(fieldmap, TriCubicInterpolatedFieldMap):
+            fieldmap = TriCubicInterpolatedFieldMap(_xobject=fieldmap)
+        if len(fieldmap._slot_coefs) == 0:
+            raise ValueError('The field map has no store for the cell-grouped '
+                             'evaluation (see `max_grouped_cells`)')
+        fieldmap.compile_kernels(only_if_needed=True)
+
+        self.fieldmap = fieldmap
+        self.slot_cells = None
+        self.n_occupied_cells = 0
+        self.n_updates = 0
+        self._cell = None
+
+    def update(self, particles, n_particles, x_shift, y_shift, tau_shift):
+
+        fmap = self.fieldmap
+        context = fmap._buffer.context
+        if isinstance(context, xo.ContextPyopencl):
+            raise NotImplementedError(
+                'The cell-grouped evaluation is not available on pyopencl '
+                'contexts')
+        nplike = context.nplike_lib
+
+        # Cell of each particle, computed on the device from the particles
+        # (cells outside the grid and lost particles are binned in the last
+        # bin, which is not stored)
+        if self._cell is None or len(self._cell) < n_particles:
+            self._cell = context.zeros(n_particles, dtype=np.int64)
+        cell = self._cell[:n_particles]
+        context.kernels.TriCubicInterpolatedFieldMap_cell_of_particles(
+                fmap=fmap._xobject, nparticles=n_particles,
+                particles=particles, x_shift=x_shift, y_shift=y_shift,
+                tau_shift=tau_shift, cell=cell)
+        n_cells = len(fmap._cell_slot)
+
+        counts = nplike.bincount(cell, minlength=n_cells + 1)[:n_cells]
+        occupied = nplike.nonzero(counts)[0]
+        self.n_occupied_cells = len(occupied)
+        n_slots = len(fmap._slot_coefs) // 64
+        if len(occupied) > n_slots:
+            occupied = occupied[nplike.argsort(-counts[occupied],
+                                               kind='stable')[:n_slots]]
+
+        # The coefficients are rebuilt at each update, so that they follow
+        # the changes of phi_taylor
+        self.slot_cells = occupied.astype(nplike.int64)
+        if len(self.slot_cells) > 0:
+            context.kernels.TriCubicInterpolatedFieldMap_build_slot_coefficients(
+                    fmap=fmap._xobject, n_slots=len(self.slot_cells),
+                    slot_cells=self.slot_cells)
+        self.n_updates += 1
+
+    def reset(self):
+
+        # Unregisters the cells, so that the slots (which are reused by the
+        # next update, possibly from another element) are no longer read
+        if self.slot_cells is not None and len(self.slot_cells) > 0:
+            self.fieldmap._cell_slot[self.slot_cells] = -1
+        self.slot_cells = None
+
+
+def _get_cached_cells(grid, coord_range):
+    # First cell and number of cells overlapping the given range
+    n_cells = len(grid) - 1
+    if coord_range is None:
+        return 0, n_cells
+    step = grid[1] - grid[0]
+    i_start = max(int(np.floor((coord_range[0] - grid[0]) / step)), 0)
+    i_end = min(int(np.floor((coord_range[1] - grid[0]) / step)) + 1, n_cells)
+    return i_start, max(i_end - i_start, 0)
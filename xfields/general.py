@@ -3,5 +3,36 @@
 # Copyright (c) CERN, 2021.                   #
 # ########################################### #
 
+import time
 from pathlib import Path
 _pkg_root = Path(__file__).parent.absolute()
+
+
+def _get_num_particles_to_process(particles):
+    # On CPU the tracker keeps the active particles at the beginning of the
+    # arrays and stores their number (negative if not known, e.g. on GPU or
+    # before the first reorganization). Lost particles that are still
+    # within this range are skipped by the kernels through their state.
+    n_active = int(particles._num_active_particles)
+    if n_active >= 0:
+        return min(n_active, int(particles._capacity))
+    return int(particles._capacity)
+
+
+def _start_timer(timings, context):
+    # Returns None if no timing is requested
+    if timings is None:
+        return None
+    context.synchronize()
+    return time.perf_counter()
+
+
+def _record_time(timings, stage, context, t_start):
+    # Adds the time elapsed since t_start to timings[stage] and returns the
+    # current time
+    if timings is None:
+        return None
+    context.synchronize()
+    t_now = time.perf_counter()
+    timings[stage] = timings.get(stage, 0.) + (t_now - t_start)
+    return t_now
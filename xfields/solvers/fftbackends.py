@@ -0,0 +1,235 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import pickle
+from pathlib import Path
+
+import numpy as np
+
+from xobjects import ContextCpu, ContextCupy
+
+try:
+    import pyfftw
+    pyfftw_available = True
+except ImportError:
+    pyfftw_available = False
+
+
+class FFTPlanScipy:
+
+    '''
+    In-place FFT plan for CPU contexts based on ``scipy.fft``, which can use
+    several threads. The twiddle factors are cached by scipy and reused
+    across calls.
+
+    Args:
+        data (np.ndarray): Array to be transformed.
+        axes (tuple): Axes over which the transform is computed.
+        workers (int): Number of threads.
+    Returns:
+        (FFTPlanScipy): FFT plan object.
+    '''
+
+    def __init__(self, data, axes, workers=1):
+
+        import scipy.fft
+
+        self._fft = scipy.fft
+        self.axes = axes
+        self.workers = workers
+
+        # I perform one fft to have scipy cache the plan
+        _ = scipy.fft.ifftn(scipy.fft.fftn(data, axes=axes, workers=workers),
+                            axes=axes, workers=workers)
+
+    def transform(self, data):
+        """The transform is done inplace"""
+        data[:] = self._fft.fftn(data, axes=self.axes, workers=self.workers)
+
+    def itransform(self, data):
+        """The transform is done inplace"""
+        data[:] = self._fft.ifftn(data, axes=self.axes, workers=self.workers)
+
+
+class FFTPlanFFTW:
+
+    '''
+    In-place FFT plan for CPU contexts based on FFTW (through pyfftw), which
+    can use several threads. The plan is bound to the array provided at
+    creation. The planning can be made faster across runs by importing
+    previously exported wisdom (see ``import_fftw_wisdom`` and
+    ``export_fftw_wisdom``).
+
+    Args:
+        data (np.ndarray): Array to be transformed.
+        axes (tuple): Axes over which the transform is computed.
+        threads (int): Number of threads.
+        flags (tuple): FFTW planner flags.
+    Returns:
+        (FFTPlanFFTW): FFT plan object.
+    '''
+
+    def __init__(self, data, axes, threads=1, flags=('FFTW_MEASURE',)):
+
+        if not pyfftw_available:
+            raise ImportError('pyfftw is needed for the fftw backend')
+
+        self.axes = axes
+        self.threads = threads
+        self.data = data
+
+        # The planner can overwrite the array
+        data_backup = data.copy()
+        self.fftw = pyfftw.FFTW(data, data, axes=axes, threads=threads,
+                                direction='FFTW_FORWARD', flags=flags)
+        self.ifftw = pyfftw.FFTW(data, data, axes=axes, threads=threads,
+                                 direction='FFTW_BACKWARD', flags=flags)
+        data[:] = data_backup
+
+    def transform(self, data):
+        """The transform is done inplace"""
+        assert data is self.data
+        self.fftw.execute()
+
+    def itransform(self, data):
+        """The transform is done inplace"""
+        assert data is self.data
+        self.ifftw.execute()
+        data *= 1. / self.ifftw.N
+
+
+class _FFTFunctions:
+
+    # Out-of-place transforms from a scipy.fft-like module, with the number
+    # of threads bound
+
+    def __init__(self, module, workers):
+        self.module = module
+        self.workers = workers
+
+    def fftn(self, a, axes):
+        return self.module.fftn(a, axes=axes, workers=self.workers)
+
+    def ifftn(self, a, axes):
+        return self.module.ifftn(a, axes=axes, workers=self.workers)
+
+    def rfftn(self, a, axes):
+        return self.module.rfftn(a, axes=axes, workers=self.workers)
+
+    def irfftn(self, a, s, axes):
+        return self.module.irfftn(a, s=s, axes=axes, workers=self.workers)
+
+
+def _get_cpu_threads(context, fft_backend, threads):
+    if not isinstance(context, ContextCpu):
+        raise ValueError(
+            f'The {fft_backend} FFT backend is available only on CPU contexts')
+    if threads is None:
+        threads = context.omp_num_threads
+    return max(threads, 1)
+
+
+def plan_fft(context, data, axes, fft_backend=None, threads=None):
+
+    '''
+    Generates an in-place FFT plan on the given array.
+
+    Args:
+        context (XfContext): Context of the array.
+        data (array): Array to be transformed.
+        axes (tuple): Axes over which the transform is computed.
+        fft_backend (str): ``None`` for the plan provided by the context,
+            ``'scipy'`` or ``'fftw'`` for the multi-threaded CPU backends.
+        threads (int): Number of threads used by the CPU backends. If
+            ``None``, ``context.omp_num_threads`` is used.
+    Returns:
+        (FFT plan object): Object providing in-place ``transform`` and
+        ``itransform`` methods.
+    '''
+
+    if fft_backend is None:
+        return context.plan_FFT(data, axes=axes)
+
+    threads = _get_cpu_threads(context, fft_backend, threads)
+    if fft_backend == 'scipy':
+        return FFTPlanScipy(data, axes=axes, workers=threads)
+    elif fft_backend == 'fftw':
+        return FFTPlanFFTW(data, axes=axes, threads=threads)
+    else:
+        raise ValueError(f'fft_backend {fft_backend} not recognized')
+
+
+def get_fft_functions(context, fft_backend=None, threads=None):
+
+    '''
+    Returns an object providing the out-of-place transforms ``fftn``,
+    ``ifftn``, ``rfftn`` and ``irfftn`` for the given context and backend
+    (see ``plan_fft``).
+    '''
+
+    if fft_backend is None:
+        if isinstance(context, ContextCpu):
+            return np.fft
+        elif isinstance(context, ContextCupy):
+            import cupy
+            return cupy.fft
+        else:
+            raise NotImplementedError(
+                f'Real and batched transforms are not available for '
+                f'{context.__class__}')
+
+    threads = _get_cpu_threads(context, fft_backend, threads)
+    if fft_backend == 'scipy':
+        import scipy.fft
+        return _FFTFunctions(scipy.fft, workers=threads)
+    elif fft_backend == 'fftw':
+        if not pyfftw_available:
+            raise ImportError('pyfftw is needed for the fftw backend')
+        import pyfftw.interfaces.scipy_fft
+        pyfftw.interfaces.cache.enable()
+        return _FFTFunctions(pyfftw.interfaces.scipy_fft, workers=threads)
+    else:
+        raise ValueError(f'fft_backend {fft_backend} not recognized')
+
+
+def import_fftw_wisdom(filename):
+
+    '''
+    Imports FFTW wisdom from a file written by ``export_fftw_wisdom``, so
+    that the FFTW plans do not need to be measured again. Nothing is done
+    if the file does not exist.
+
+    Args:
+        filename (str or Path): Wisdom file.
+    Returns:
+        (bool): ``True`` if the wisdom was imported.
+    '''
+
+    if not pyfftw_available:
+        raise ImportError('pyfftw is needed to import FFTW wisdom')
+
+    filename = Path(filename)
+    if not filename.exists():
+        return False
+    with open(filename, 'rb') as fid:
+        wisdom = pickle.load(fid)
+    pyfftw.import_wisdom(wisdom)
+    return True
+
+
+def export_fftw_wisdom(filename):
+
+    '''
+    Saves the FFTW wisdom accumulated by the plans created so far.
+
+    Args:
+        filename (str or Path): Wisdom file.
+    '''
+
+    if not pyfftw_available:
+        raise ImportError('pyfftw is needed to export FFTW wisdom')
+
+    with open(filename, 'wb') as fid:
+        pickle.dump(pyfftw.export_wisdom(), fid)
@@ -8,14 +8,12 @@ from scipy.constants import epsilon_0
 from numpy import pi
 
 from .base import Solver
+from .green_function_cache import GreenFunctionCache
+from .fftbackends import plan_fft, get_fft_functions
 
+import xobjects as xo
 from xobjects import context_default
 
-class FFTSolver2D(Solver):
-
-    def solve(self, rho):
-        pass
-
 class FFTSolver3D(Solver):
 
     '''
@@ -31,65 +29,74 @@ class FFTSolver3D(Solver):
         dz (float): Longitudinal cell size in meters.
         context (XfContext): identifies the :doc:`context <contexts>`
             on which the computation is executed.
+        fftplan (FFT plan object): FFT plan to be used by the solver. If not
+            provided, a plan is generated on the solver workspace.
+        reuse_workspace (bool): If ``True`` (default) the padded workspace
+            is allocated once and reused at each call of ``solve``, which
+            returns a view on it. If ``False``, a new workspace is allocated
+            at each call (not available with the ``'fftw'`` backend).
+        green_function_cache (GreenFunctionCache): If provided, the
+            transformed Green function is taken from the cache when
+            available and stored in it otherwise.
+        spectral_gradients (bool): If ``True``, the derivatives of phi
+            along the transformed axes can be computed in Fourier space
+            together with phi (see ``solve_with_gradients``). Available on
+            CPU and cupy contexts. The default is ``False``.
+        precision (str): Floating point precision of the solver, either
+            ``'double'`` (default) or ``'single'``. In single precision the
+            workspace, the transformed Green function and the transforms use
+            float32/complex64 (the Green function is computed in double
+            precision and then rounded). Only the solver is affected: the
+            field maps keep double precision arrays.
+        fft_backend (str): FFT implementation. If ``None`` (default) the
+            one provided by the context is used. On CPU contexts, ``'scipy'``
+            (scipy.fft) and ``'fftw'`` (pyfftw) use ``fft_threads``
+            threads. FFTW wisdom can be persisted with
+            ``import_fftw_wisdom``/``export_fftw_wisdom``.
+        fft_threads (int): Number of threads used by the CPU FFT backends.
+            If ``None`` (default), ``context.omp_num_threads`` is used.
+        spectral_filter (str or callable): Smoothing filter folded into the
+            transformed Green function at construction, hence applied to
+            the potential at no extra cost per solve. Accepted values are
+            ``'gaussian'``, ``'binomial'`` or a function that receives the
+            frequencies along the transformed axes (in cycles per cell, as
+            broadcastable arrays, x first) and returns the real filter
+            factors. Only the transformed axes are filtered (x and y in the
+            2.5D and 2D solvers). If ``None`` (default) no filter is applied.
+        spectral_filter_width (float): For the ``'gaussian'`` filter, rms
+            smoothing length in cells. For the ``'binomial'`` filter, number
+            of passes of the (1/4, 1/2, 1/4) filter. The default is 1.
+        keep_gint_rep (bool): If ``True``, a copy of the integrated Green
+            function before the transform is kept in ``_gint_rep`` (for
+            debugging). The default is ``False``.
     Returns:
         (FFTSolver3D): Poisson solver object.
     '''
 
-    def __init__(self, dx, dy, dz, nx, ny, nz, context=None, fftplan=None):
+    _green_function_slab_bytes = 2**25
+
+    def __init__(self, dx, dy, dz, nx, ny, nz, context=None, fftplan=None,
+                 reuse_workspace=True, green_function_cache=None,
+                 keep_gint_rep=False, spectral_gradients=False,
+                 precision='double', fft_backend=None, fft_threads=None,
+                 spectral_filter=None, spectral_filter_width=1.):
 
         if context is None:
             context = context_default
 
-        self.context = context
-
-        # Prepare arrays
-        workspace_dev = context.nparray_to_context_array(
-                    np.zeros((2*nx, 2*ny, 2*nz), dtype=np.complex128, order='F'))
-
-
-        # Build grid for primitive function
-        xg_F = np.arange(0, nx+2) * dx - dx/2
-        yg_F = np.arange(0, ny+2) * dy - dy/2
-        zg_F = np.arange(0, nz+2) * dz - dz/2
-        XX_F, YY_F, ZZ_F = np.meshgrid(xg_F, yg_F, zg_F, indexing='ij')
-
-        # Compute primitive
-        F_temp = primitive_func_3d(XX_F, YY_F, ZZ_F)
-
-        # Integrated Green Function (I will transform inplace)
-        gint_rep= np.zeros((2*nx, 2*ny, 2*nz), dtype=np.complex128, order='F')
-        gint_rep[:nx+1, :ny+1, :nz+1] = (F_temp[ 1:,  1:,  1:]
-                                       - F_temp[:-1,  1:,  1:]
-                                       - F_temp[ 1:, :-1,  1:]
-                                       + F_temp[:-1, :-1,  1:]
-                                       - F_temp[ 1:,  1:, :-1]
-                                       + F_temp[:-1,  1:, :-1]
-                                       + F_temp[ 1:, :-1, :-1]
-                                       - F_temp[:-1, :-1, :-1])
-
-        # Replicate
-        # To define how to make the replicas I have a look at:
-        # np.abs(np.fft.fftfreq(10))*10
-        # = [0., 1., 2., 3., 4., 5., 4., 3., 2., 1.]
-        gint_rep[nx+1:, :ny+1, :nz+1] = gint_rep[nx-1:0:-1, :ny+1,     :nz+1    ]
-        gint_rep[:nx+1, ny+1:, :nz+1] = gint_rep[:nx+1,     ny-1:0:-1, :nz+1    ]
-        gint_rep[nx+1:, ny+1:, :nz+1] = gint_rep[nx-1:0:-1, ny-1:0:-1, :nz+1    ]
-        gint_rep[:nx+1, :ny+1, nz+1:] = gint_rep[:nx+1,     :ny+1,     nz-1:0:-1]
-        gint_rep[nx+1:, :ny+1, nz+1:] = gint_rep[nx-1:0:-1, :ny+1,     nz-1:0:-1]
-        gint_rep[:nx+1, ny+1:, nz+1:] = gint_rep[:nx+1,     ny-1:0:-1, nz-1:0:-1]
-        gint_rep[nx+1:, ny+1:, nz+1:] = gint_rep[nx-1:0:-1, ny-1:0:-1, nz-1:0:-1]
-
-        self._gint_rep = gint_rep.copy()
+        if fft_backend == 'fftw' and not reuse_workspace:
+            # FFTW plans are bound to the workspace they are created on
+            raise ValueError('The fftw backend requires reuse_workspace=True')
 
-        # Tranasfer to device
-        gint_rep_dev = context.nparray_to_context_array(gint_rep)
-
-        # Prepare fft plan
-        if fftplan is None:
-            fftplan = context.plan_FFT(workspace_dev, axes=(0,1,2))
-
-        # Transform the green function (in place)
-        fftplan.transform(gint_rep_dev)
+        self.context = context
+        self.fft_backend = fft_backend
+        self.fft_threads = fft_threads
+        self.precision = precision
+        self._real_dtype, self._complex_dtype = _get_dtypes(precision)
+        self._workspace_dtype = self._complex_dtype
+        self.reuse_workspace = reuse_workspace
+        self.keep_gint_rep = keep_gint_rep
+        self.n_workspace_allocations = 0
 
         self.dx = dx
         self.dy = dy
@@ -97,10 +104,192 @@ class FFTSolver3D(Solver):
         self.nx = nx
         self.ny = ny
         self.nz = nz
+
+        # Prepare workspace and fft plan
+        workspace_dev = self._allocate_workspace(self._workspace_shape())
+        if fftplan is None:
+            fftplan = plan_fft(context, workspace_dev,
+                               axes=self._fftplan_axes(),
+                               fft_backend=fft_backend,
+                               threads=fft_threads)
         self._workspace_dev = workspace_dev
-        self._gint_rep_transf_dev = gint_rep_dev
         self.fftplan = fftplan
 
+        self._init_spectral_filter(spectral_filter, spectral_filter_width)
+        self._gint_rep_transf_dev = self._get_transformed_green_function(
+                                                        green_function_cache)
+
+        self._init_spectral_gradients(spectral_gradients)
+
+    def _init_spectral_gradients(self, spectral_gradients):
+
+        self.spectral_gradients = spectral_gradients
+        if not spectral_gradients:
+            return
+
+        self._fft = get_fft_functions(self.context, self.fft_backend,
+                                self.fft_threads)
+
+        # Central difference in Fourier space:
+        # (phi[i+1] - phi[i-1]) / (2 d) -> phi_hat * 1j * sin(2 pi f) / d
+        # As the potential is computed on the full padded domain, it is
+        # exact also at the edges of the grid.
+        workspace_shape = self._workspace_shape()
+        spectral_axes = self._spectral_axes()
+        ndim = len(workspace_shape)
+        self._gradient_factors_dev = []
+        for ii, dd in enumerate((self.dx, self.dy, self.dz)[:ndim]):
+            if ii not in spectral_axes:
+                self._gradient_factors_dev.append(None)
+                continue
+            if ii == self._halved_axis():
+                freq = np.fft.rfftfreq(workspace_shape[ii])
+            else:
+                freq = np.fft.fftfreq(workspace_shape[ii])
+            shape = [1] * ndim
+            shape[ii] = len(freq)
+            self._gradient_factors_dev.append(
+                    self.context.nparray_to_context_array(
+                        np.asfortranarray(
+                            (1j * np.sin(2 * pi * freq) / dd).reshape(shape),
+                            dtype=self._complex_dtype)))
+
+    def _grid_shape(self):
+        return (self.nx, self.ny, self.nz)
+
+    def _workspace_shape(self):
+        return (2*self.nx, 2*self.ny, 2*self.nz)
+
+    def _fftplan_axes(self):
+        return (0, 1, 2)
+
+    def _spectral_axes(self):
+        return self._fftplan_axes()
+
+    def _halved_axis(self):
+        return None
+
+    def _forward_transform(self, _workspace_dev):
+        return self._fft.fftn(_workspace_dev, axes=self._spectral_axes())
+
+    def _inverse_transform(self, phi_rep_hat):
+        return self._fft.ifftn(phi_rep_hat, axes=self._spectral_axes()).real
+
+    def _compute_transformed_green_function(self):
+
+        nx, ny, nz = self.nx, self.ny, self.nz
+        context = self.context
+        _workspace_dev = self._workspace_dev
+
+        # Integrated Green Function, filled slab by slab into the workspace
+        # (z slabs are contiguous in F order) and transformed in place
+        for k0, k1, gint_slab in _integrated_green_function_3d_slabs(
+                self.dx, self.dy, self.dz, nx, ny, nz,
+                dtype=self._workspace_dtype,
+                max_slab_bytes=self._green_function_slab_bytes):
+            _workspace_dev[:, :, k0:k1] = context.nparray_to_context_array(
+                                                                    gint_slab)
+            # Replica in z of planes 1 to nz - 1 (plane k goes to 2*nz - k)
+            m0 = max(k0, 1)
+            m1 = min(k1, nz)
+            if m1 > m0:
+                i_stop = m0 - k0 - 1 if m0 > k0 else None
+                _workspace_dev[:, :, 2*nz-m1+1:2*nz-m0+1] = (
+                        context.nparray_to_context_array(np.asfortranarray(
+                            gint_slab[:, :, m1-k0-1:i_stop:-1])))
+
+        if self.keep_gint_rep:
+            self._gint_rep = context.nparray_from_context_array(
+                                                    _workspace_dev).copy()
+
+        self.fftplan.transform(_workspace_dev)
+
+        gint_rep_transf_dev = context.zeros(_workspace_dev.shape,
+                                dtype=_workspace_dev.dtype, order='F')
+        gint_rep_transf_dev[:] = _workspace_dev
+
+        return gint_rep_transf_dev
+
+    def _get_transformed_green_function(self, green_function_cache):
+
+        if green_function_cache is None:
+            return self._apply_spectral_filter(
+                                self._compute_transformed_green_function())
+
+        # The cache holds the unfiltered kernel, which can be shared by
+        # solvers using different filters
+        key = GreenFunctionCache.make_key(self.__class__.__name__,
+                self.dx, self.dy, self.dz, self.nx, self.ny, self.nz,
+                self._workspace_dtype)
+        gint_rep_transf = green_function_cache.get(key,
+                lambda: self.context.nparray_from_context_array(
+                                self._compute_transformed_green_function()))
+
+        # Transfer to GPU (if needed)
+        return self._apply_spectral_filter(
+                self.context.nparray_to_context_array(gint_rep_transf))
+
+    def _init_spectral_filter(self, spectral_filter, spectral_filter_width):
+
+        if not (spectral_filter is None or callable(spectral_filter)
+                or spectral_filter in ('gaussian', 'binomial')):
+            raise ValueError(f'Spectral filter {spectral_filter} '
+                             'not recognized')
+        self.spectral_filter = spectral_filter
+        self.spectral_filter_width = spectral_filter_width
+
+    def _apply_spectral_filter(self, gint_rep_transf_dev):
+
+        if self.spectral_filter is None:
+            return gint_rep_transf_dev
+
+        # Frequencies (in cycles per cell) along the transformed axes of
+        # the padded domain, shaped to broadcast on the Green function
+        workspace_shape = self._workspace_shape()
+        ndim = len(workspace_shape)
+        freqs = []
+        for ii in sorted(self._spectral_axes()):
+            if ii == self._halved_axis():
+                freq = np.fft.rfftfreq(workspace_shape[ii])
+            else:
+                freq = np.fft.fftfreq(workspace_shape[ii])
+            shape = [1] * ndim
+            shape[ii] = len(freq)
+            freqs.append(freq.reshape(shape))
+
+        factor = np.asfortranarray(np.broadcast_to(
+                _spectral_filter_factor(self.spectral_filter,
+                                        self.spectral_filter_width, freqs),
+                gint_rep_transf_dev.shape), dtype=self._real_dtype)
+
+        # A new array is allocated as the unfiltered one can be owned by a
+        # GreenFunctionCache
+        filtered_dev = self.context.zeros(gint_rep_transf_dev.shape,
+                            dtype=gint_rep_transf_dev.dtype, order='F')
+        filtered_dev[:] = (gint_rep_transf_dev
+                           * self.context.nparray_to_context_array(factor))
+        return filtered_dev
+
+    def _allocate_workspace(self, shape):
+        self.n_workspace_allocations += 1
+        return self.context.zeros(shape, dtype=self._workspace_dtype,
+                                  order='F')
+
+    def _get_clean_workspace(self):
+
+        if not self.reuse_workspace:
+            return self._allocate_workspace(self._workspace_dev.shape)
+
+        # After a solve the whole workspace is dirty. The region
+        # [:nx, :ny, :nz] is overwritten by rho, so only the padding needs
+        # to be zeroed.
+        _workspace_dev = self._workspace_dev
+        _workspace_dev.T[:, :, self.nx:] = 0.
+        _workspace_dev.T[:, self.ny:, :self.nx] = 0.
+        if _workspace_dev.shape[2] > self.nz:
+            _workspace_dev.T[self.nz:, :self.ny, :self.nx] = 0.
+        return _workspace_dev
+
     #@profile
     def solve(self, rho):
 
@@ -112,13 +301,11 @@ class FFTSolver3D(Solver):
                 Coulomb/m^3.
         Returns:
             phi (float64 array): electric potential at the grid points in Volts.
+                If ``reuse_workspace`` is ``True``, this is a view on the
+                solver workspace, which is overwritten by the next call.
         '''
 
-        nz_alloc = self.nz
-        if self._gint_rep_transf_dev.shape[2] > 1:
-            nz_alloc = self._gint_rep_transf_dev.shape[2]
-        _workspace_dev = self.context.zeros(
-                (2*self.nx, 2*self.ny, nz_alloc), dtype=np.complex128, order='F')
+        _workspace_dev = self._get_clean_workspace()
 
         # The transposes make it faster in cupy (C-contigous arrays)
         _workspace_dev.T[:self.nz, :self.ny, :self.nx] = rho.T
@@ -135,6 +322,100 @@ class FFTSolver3D(Solver):
         self.fftplan.itransform(_workspace_dev) #phi_rep
         return _workspace_dev.real[:self.nx, :self.ny, :self.nz]
 
+    def solve_with_gradients(self, rho):
+
+        '''
+        Solves Poisson's equation in free space for a given charge density
+        and computes the derivatives of the potential in Fourier space
+        (central differences with the solver grid spacing). It requires the
+        solver to be created with ``spectral_gradients=True``.
+
+        Args:
+            rho (float64 array): charge density at the grid points in
+                Coulomb/m^3.
+        Returns:
+            phi (float64 array): electric potential at the grid points in
+                Volts.
+            gradients (list of float64 arrays): derivatives of phi along
+                x, y (and z) in V/m. The entry is ``None`` for axes that are
+                not transformed by the solver (z in the 2.5D solvers).
+        '''
+
+        assert self.spectral_gradients, (
+                'The solver was not created with spectral_gradients=True')
+
+        grid_slices = tuple(slice(None, nn) for nn in self._grid_shape())
+
+        _workspace_dev = self._get_clean_workspace()
+        _workspace_dev.T[grid_slices[::-1]] = rho.T
+
+        phi_rep_hat = self._forward_transform(_workspace_dev)
+        phi_rep_hat *= self._gint_rep_transf_dev
+
+        phi = self._inverse_transform(phi_rep_hat)[grid_slices]
+        gradients = []
+        for factor_dev in self._gradient_factors_dev:
+            if factor_dev is None:
+                gradients.append(None)
+            else:
+                gradients.append(self._inverse_transform(
+                                    phi_rep_hat * factor_dev)[grid_slices])
+
+        return phi, gradients
+
+    def solve_batch(self, rho_batch):
+
+        '''
+        Solves Poisson's equation in free space for a stack of charge
+        densities defined on the same grid. A single batched FFT is
+        performed over the leading axis of the stack. Available on CPU and
+        cupy contexts.
+
+        Args:
+            rho_batch (float64 array or sequence of float64 arrays): charge
+                densities at the grid points in Coulomb/m^3, stacked along
+                the first axis, i.e. with shape (n_batch, nx, ny, nz).
+        Returns:
+            phi_batch (float64 array): electric potentials at the grid points
+                in Volts, with shape (n_batch, nx, ny, nz).
+        '''
+
+        fft = get_fft_functions(self.context, self.fft_backend,
+                                self.fft_threads)
+
+        grid_slices = tuple(slice(None, nn) for nn in self._grid_shape())
+
+        _workspace_dev = self._get_batch_workspace(len(rho_batch))
+        for ii, rho in enumerate(rho_batch):
+            _workspace_dev[ii].T[grid_slices[::-1]] = rho.T
+
+        phi_rep = self._convolve_batch(fft, _workspace_dev)
+
+        return phi_rep[(slice(None),) + grid_slices]
+
+    def _get_batch_workspace(self, n_batch):
+
+        # The batch workspace is real and the transforms are not done in
+        # place, hence its padding stays clean. Each grid of the stack is
+        # contiguous (F order).
+        _workspace_dev = getattr(self, '_batch_workspace_dev', None)
+        if (not self.reuse_workspace or _workspace_dev is None
+                or _workspace_dev.shape[0] != n_batch):
+            self.n_workspace_allocations += 1
+            ndim = len(self._workspace_shape())
+            _workspace_dev = self.context.zeros(
+                    self._workspace_shape() + (n_batch,),
+                    dtype=self._real_dtype, order='F').transpose(
+                                                ndim, *range(ndim))
+            self._batch_workspace_dev = _workspace_dev
+        return _workspace_dev
+
+    def _convolve_batch(self, fft, _workspace_dev):
+        axes = tuple(aa + 1 for aa in self._fftplan_axes())
+        phi_rep_hat = fft.fftn(_workspace_dev, axes=axes)
+        phi_rep_hat *= self._gint_rep_transf_dev[None, ...]
+        return fft.ifftn(phi_rep_hat, axes=axes).real
+
 class FFTSolver2p5D(FFTSolver3D):
 
     '''
@@ -150,53 +431,256 @@ class FFTSolver2p5D(FFTSolver3D):
         dz (float): Longitudinal cell size in meters.
         context (XfContext): identifies the :doc:`context <contexts>`
             on which the computation is executed.
+        fftplan (FFT plan object): FFT plan to be used by the solver. If not
+            provided, a plan is generated on the solver workspace.
+        reuse_workspace, green_function_cache, spectral_gradients,
+        precision, fft_backend, fft_threads, spectral_filter,
+        spectral_filter_width: see ``FFTSolver3D``.
     Returns:
         (FFTSolver3D): Poisson solver object.
     '''
 
-    def __init__(self, dx, dy, dz, nx, ny, nz, context=None, fftplan=None):
+    def __init__(self, *args, **kwargs):
+        self._compacted_workspaces = {}
+        super().__init__(*args, **kwargs)
 
-        if context is None:
-            context = context_default
-        self.context = context
+    def _workspace_shape(self):
+        return (2*self.nx, 2*self.ny, self.nz)
 
-        # Build grid for primitive function
-        xg_F = np.arange(0, nx+2) * dx - dx/2
-        yg_F = np.arange(0, ny+2) * dy - dy/2
-        XX_F, YY_F= np.meshgrid(xg_F, yg_F, indexing='ij')
+    def _fftplan_axes(self):
+        return (0, 1)
 
-        # Compute primitive
-        F_temp = primitive_func_2p5d(XX_F, YY_F)
+    def _compute_transformed_green_function(self):
 
-        # Integrated Green Function (I will transform inplace)
-        gint_rep= np.zeros((2*nx, 2*ny), dtype=np.complex128, order='F')
-        gint_rep[:nx+1, :ny+1] = (F_temp[ 1:,  1:]
-                                - F_temp[:-1,  1:]
-                                - F_temp[ 1:, :-1]
-                                + F_temp[:-1, :-1])
+        # Integrated Green Function
+        gint_rep = _integrated_green_function_2p5d(
+                self.dx, self.dy, self.nx, self.ny, dtype=np.complex128)
 
-        # Replicate
-        # To define how to make the replicas I have a look at:
-        # np.abs(np.fft.fftfreq(10))*10
-        # = [0., 1., 2., 3., 4., 5., 4., 3., 2., 1.]
-        gint_rep[nx+1:, :ny+1] = gint_rep[nx-1:0:-1, :ny+1]
-        gint_rep[:nx+1, ny+1:] = gint_rep[:nx+1, ny-1:0:-1]
-        gint_rep[nx+1:, ny+1:] = gint_rep[nx-1:0:-1, ny-1:0:-1]
+        # Transform the green function
+        gint_rep_transf = np.fft.fftn(gint_rep, axes=(0,1))
+
+        # Transfer to GPU (if needed)
+        return self.context.nparray_to_context_array(
+                np.atleast_3d(gint_rep_transf).astype(self._workspace_dtype))
+
+    def _get_compacted_workspace(self, n_occupied):
+
+        # Workspaces (and their FFT plans) for the compacted transforms are
+        # allocated on first use, one per power of two of the number of
+        # slices, and then reused. The additional memory is at most twice
+        # that of the main workspace.
+        n_slices = 1 << (n_occupied - 1).bit_length()
+        if n_slices not in self._compacted_workspaces:
+            workspace_dev = self._allocate_workspace(
+                    (2*self.nx, 2*self.ny, n_slices))
+            fftplan = plan_fft(self.context, workspace_dev, axes=(0, 1),
+                               fft_backend=self.fft_backend,
+                               threads=self.fft_threads)
+            self._compacted_workspaces[n_slices] = (workspace_dev, fftplan)
+        return self._compacted_workspaces[n_slices]
 
+    #@profile
+    def solve(self, rho):
 
-        # Prepare fft plan
-        if fftplan is None:
-            temp_dev = context.zeros((2*nx, 2*ny, nz),
-                                    dtype=np.complex128, order='F')
-            fftplan = context.plan_FFT(temp_dev, axes=(0,1))
-            del(temp_dev)
+        '''
+        Solves Poisson's equation in free space for a given charge density.
+        Only the z slices containing charge are transformed (compacted in a
+        separate workspace), the potential is set to zero on the other
+        slices (on CPU and cupy contexts). Finding the occupied slices
+        requires a synchronization with the host at each call.
+
+        Args:
+            rho (float64 array): charge density at the grid points in
+                Coulomb/m^3.
+        Returns:
+            phi (float64 array): electric potential at the grid points in Volts.
+                If ``reuse_workspace`` is ``True``, this is a view on the
+                solver workspace, which is overwritten by the next call.
+        '''
+
+        if isinstance(self.context, xo.ContextPyopencl):
+            return super().solve(rho)
+
+        i_occupied = np.flatnonzero(self.context.nparray_from_context_array(
+                                            (rho != 0).any(axis=(0, 1))))
+        n_occupied = len(i_occupied)
+        if 2 * n_occupied > self.nz:
+            return super().solve(rho)
+
+        if self.reuse_workspace:
+            _workspace_dev = self._workspace_dev
+        else:
+            _workspace_dev = self._allocate_workspace(
+                                            self._workspace_dev.shape)
+
+        _workspace_dev.T[:, :self.ny, :self.nx] = 0.
+        if n_occupied == 0:
+            return _workspace_dev.real[:self.nx, :self.ny, :self.nz]
+
+        i_occupied = self.context.nparray_to_context_array(i_occupied)
+        compacted_dev, fftplan = self._get_compacted_workspace(n_occupied)
+
+        # Compact the occupied slices at the beginning of the workspace
+        compacted_dev.T[:, :, :] = 0.
+        compacted_dev.T[:n_occupied, :self.ny, :self.nx] = rho.T[i_occupied]
+
+        fftplan.transform(compacted_dev) # rho_rep_hat
+        compacted_dev.T[:, :, :] *= self._gint_rep_transf_dev.T # phi_rep_hat
+        fftplan.itransform(compacted_dev) # phi_rep
+
+        _workspace_dev.T[i_occupied, :self.ny, :self.nx] = (
+                            compacted_dev.T[:n_occupied, :self.ny, :self.nx])
+
+        return _workspace_dev.real[:self.nx, :self.ny, :self.nz]
+
+
+class FFTSolver2D(FFTSolver3D):
+
+    '''
+    Creates a Poisson solver object that solves the 2D (transverse) Poisson
+    equation using the FFT method (free space). The charge density is
+    defined on a 2D grid (line charge density per unit volume, in
+    Coulomb/m^3, as for the 2.5D solver).
+
+    Args:
+        nx (int): Number of cells in the horizontal direction.
+        ny (int): Number of cells in the vertical direction.
+        dx (float): Horizontal cell size in meters.
+        dy (float): Vertical cell size in meters.
+        context (XfContext): identifies the :doc:`context <contexts>`
+            on which the computation is executed.
+        fftplan (FFT plan object): FFT plan to be used by the solver. If not
+            provided, a plan is generated on the solver workspace.
+        reuse_workspace, green_function_cache, spectral_gradients,
+        precision, fft_backend, fft_threads, spectral_filter,
+        spectral_filter_width: see ``FFTSolver3D``.
+    Returns:
+        (FFTSolver2D): Poisson solver object.
+    '''
+
+    def __init__(self, dx, dy, nx, ny, context=None, fftplan=None,
+                 reuse_workspace=True, green_function_cache=None,
+                 spectral_gradients=False, precision='double',
+                 fft_backend=None, fft_threads=None, spectral_filter=None,
+                 spectral_filter_width=1.):
+
+        # The 2D solver is handled as a 3D one with a single (not
+        # transformed) longitudinal cell
+        super().__init__(dx=dx, dy=dy, dz=1., nx=nx, ny=ny, nz=1,
+                         context=context, fftplan=fftplan,
+                         reuse_workspace=reuse_workspace,
+                         green_function_cache=green_function_cache,
+                         spectral_gradients=spectral_gradients,
+                         precision=precision, fft_backend=fft_backend,
+                         fft_threads=fft_threads,
+                         spectral_filter=spectral_filter,
+                         spectral_filter_width=spectral_filter_width)
+
+    def _grid_shape(self):
+        return (self.nx, self.ny)
+
+    def _workspace_shape(self):
+        return (2*self.nx, 2*self.ny)
+
+    def _fftplan_axes(self):
+        return (0, 1)
+
+    def _compute_transformed_green_function(self):
+
+        # Integrated Green Function
+        gint_rep = _integrated_green_function_2p5d(
+                self.dx, self.dy, self.nx, self.ny, dtype=np.complex128)
 
         # Transform the green function
         gint_rep_transf = np.fft.fftn(gint_rep, axes=(0,1))
 
         # Transfer to GPU (if needed)
-        gint_rep_transf_dev = context.nparray_to_context_array(
-                                       np.atleast_3d(gint_rep_transf))
+        return self.context.nparray_to_context_array(
+                            gint_rep_transf.astype(self._workspace_dtype))
+
+    def _get_clean_workspace(self):
+
+        if not self.reuse_workspace:
+            return self._allocate_workspace(self._workspace_dev.shape)
+
+        _workspace_dev = self._workspace_dev
+        _workspace_dev.T[:, self.nx:] = 0.
+        _workspace_dev.T[self.ny:, :self.nx] = 0.
+        return _workspace_dev
+
+    #@profile
+    def solve(self, rho):
+
+        '''
+        Solves Poisson's equation in free space for a given charge density.
+
+        Args:
+            rho (float64 array): charge density at the grid points in
+                Coulomb/m^3, with shape (nx, ny).
+        Returns:
+            phi (float64 array): electric potential at the grid points in Volts.
+                If ``reuse_workspace`` is ``True``, this is a view on the
+                solver workspace, which is overwritten by the next call.
+        '''
+
+        _workspace_dev = self._get_clean_workspace()
+
+        # The transposes make it faster in cupy (C-contigous arrays)
+        _workspace_dev.T[:self.ny, :self.nx] = rho.T
+        self.fftplan.transform(_workspace_dev) # rho_rep_hat
+        _workspace_dev *= self._gint_rep_transf_dev # phi_rep_hat
+        self.fftplan.itransform(_workspace_dev) #phi_rep
+
+        return _workspace_dev.real[:self.nx, :self.ny]
+
+
+class RFFTSolver3D(FFTSolver3D):
+
+    '''
+    Creates a Poisson solver object that solves the full 3D Poisson
+    equation using the FFT method (free space) with real-to-complex
+    transforms. As rho is real, only the non-redundant half of its spectrum
+    is computed. As the integrated Green function is also even, its
+    transform is real and is stored as a real array. Available on CPU and
+    cupy contexts.
+
+    Args:
+        nx (int): Number of cells in the horizontal direction.
+        ny (int): Number of cells in the vertical direction.
+        nz (int): Number of cells in the vertical direction.
+        dx (float): Horizontal cell size in meters.
+        dy (float): Vertical cell size in meters.
+        dz (float): Longitudinal cell size in meters.
+        context (XfContext): identifies the :doc:`context <contexts>`
+            on which the computation is executed.
+        reuse_workspace, green_function_cache, spectral_gradients,
+        precision, fft_backend, fft_threads, spectral_filter,
+        spectral_filter_width: see ``FFTSolver3D``.
+    Returns:
+        (RFFTSolver3D): Poisson solver object.
+    '''
+
+    # The spectrum is halved along the last of the transformed axes, which
+    # is chosen to be the contiguous one (x, as arrays are in F order)
+    _fft_axes = (2, 1, 0)
+
+    def __init__(self, dx, dy, dz, nx, ny, nz, context=None,
+                 reuse_workspace=True, green_function_cache=None,
+                 spectral_gradients=False, precision='double',
+                 fft_backend=None, fft_threads=None, spectral_filter=None,
+                 spectral_filter_width=1.):
+
+        if context is None:
+            context = context_default
+        self.context = context
+        self.fft_backend = fft_backend
+        self.fft_threads = fft_threads
+        self.precision = precision
+        self._real_dtype, self._complex_dtype = _get_dtypes(precision)
+        self._workspace_dtype = self._real_dtype
+        self.reuse_workspace = reuse_workspace
+        self.n_workspace_allocations = 0
+        self._fft = get_fft_functions(context, fft_backend, fft_threads)
 
         self.dx = dx
         self.dy = dy
@@ -204,9 +688,224 @@ class FFTSolver2p5D(FFTSolver3D):
         self.nx = nx
         self.ny = ny
         self.nz = nz
-        self._gint_rep_transf_dev = gint_rep_transf_dev
-        self.fftplan = fftplan
 
+        self._workspace_dev = self._allocate_workspace(
+                                                    self._workspace_shape())
+
+        self._init_spectral_filter(spectral_filter, spectral_filter_width)
+        self._gint_rep_transf_dev = self._get_transformed_green_function(
+                                                        green_function_cache)
+
+        self._init_spectral_gradients(spectral_gradients)
+
+    def _spectral_axes(self):
+        return self._fft_axes
+
+    def _halved_axis(self):
+        return self._fft_axes[-1]
+
+    def _forward_transform(self, _workspace_dev):
+        return self._fft.rfftn(_workspace_dev, axes=self._fft_axes)
+
+    def _inverse_transform(self, phi_rep_hat):
+        return self._fft.irfftn(phi_rep_hat,
+                    s=[self._workspace_dev.shape[aa] for aa in self._fft_axes],
+                    axes=self._fft_axes)
+
+    def _get_clean_workspace(self):
+        # The transforms are not done in place, hence only the rho region
+        # of the workspace is ever written and the padding stays clean
+        if self.reuse_workspace:
+            return self._workspace_dev
+        return self._allocate_workspace(self._workspace_dev.shape)
+
+    def _compute_transformed_green_function(self):
+
+        gint_rep = _integrated_green_function_3d(
+                self.dx, self.dy, self.dz, self.nx, self.ny, self.nz,
+                dtype=np.float64)
+        gint_rep_transf = np.fft.rfftn(gint_rep, axes=self._fft_axes).real
+
+        return self.context.nparray_to_context_array(np.asfortranarray(
+                            gint_rep_transf, dtype=self._workspace_dtype))
+
+    #@profile
+    def solve(self, rho):
+
+        '''
+        Solves Poisson's equation in free space for a given charge density.
+
+        Args:
+            rho (float64 array): charge density at the grid points in
+                Coulomb/m^3.
+        Returns:
+            phi (float64 array): electric potential at the grid points in Volts.
+        '''
+
+        _workspace_dev = self._get_clean_workspace()
+
+        # The transposes make it faster in cupy (C-contigous arrays)
+        _workspace_dev.T[:self.nz, :self.ny, :self.nx] = rho.T
+
+        phi_rep_hat = self._forward_transform(_workspace_dev)
+        phi_rep_hat *= self._gint_rep_transf_dev
+        phi_rep = self._inverse_transform(phi_rep_hat)
+
+        return phi_rep[:self.nx, :self.ny, :self.nz]
+
+    def _convolve_batch(self, fft, _workspace_dev):
+        axes = tuple(aa + 1 for aa in self._fft_axes)
+        phi_rep_hat = fft.rfftn(_workspace_dev, axes=axes)
+        phi_rep_hat *= self._gint_rep_transf_dev[None, ...]
+        return fft.irfftn(phi_rep_hat,
+                    s=[_workspace_dev.shape[aa] for aa in axes], axes=axes)
+
+
+class RFFTSolver2p5D(RFFTSolver3D):
+
+    '''
+    Creates a Poisson solver object that solve's Poisson equation in
+    the 2.5D approximation using the FFT method (free space) with
+    real-to-complex transforms (see ``RFFTSolver3D``). Available on CPU and
+    cupy contexts.
+
+    Args:
+        nx (int): Number of cells in the horizontal direction.
+        ny (int): Number of cells in the vertical direction.
+        nz (int): Number of cells in the vertical direction.
+        dx (float): Horizontal cell size in meters.
+        dy (float): Vertical cell size in meters.
+        dz (float): Longitudinal cell size in meters.
+        context (XfContext): identifies the :doc:`context <contexts>`
+            on which the computation is executed.
+        reuse_workspace, green_function_cache, spectral_gradients,
+        precision, fft_backend, fft_threads, spectral_filter,
+        spectral_filter_width: see ``FFTSolver3D``.
+    Returns:
+        (RFFTSolver2p5D): Poisson solver object.
+    '''
+
+    _fft_axes = (1, 0)
+
+    def _workspace_shape(self):
+        return (2*self.nx, 2*self.ny, self.nz)
+
+    def _compute_transformed_green_function(self):
+
+        gint_rep = _integrated_green_function_2p5d(
+                self.dx, self.dy, self.nx, self.ny, dtype=np.float64)
+        gint_rep_transf = np.fft.rfftn(gint_rep, axes=self._fft_axes).real
+
+        return self.context.nparray_to_context_array(np.asfortranarray(
+                np.atleast_3d(gint_rep_transf), dtype=self._workspace_dtype))
+
+
+def _spectral_filter_factor(spectral_filter, width, freqs):
+    if callable(spectral_filter):
+        return np.real(spectral_filter(*freqs))
+    factor = 1.
+    for ff in freqs:
+        if spectral_filter == 'gaussian':
+            factor = factor * np.exp(-2 * (pi * width * ff)**2)
+        else:
+            # Transfer function of the (1/4, 1/2, 1/4) filter: cos(pi f)^2
+            factor = factor * np.cos(pi * ff)**(2 * width)
+    return factor
+
+
+def _get_dtypes(precision):
+    if precision == 'double':
+        return np.float64, np.complex128
+    elif precision == 'single':
+        return np.float32, np.complex64
+    else:
+        raise ValueError(f'precision {precision} not recognized')
+
+
+def _integrated_green_function_3d_slabs(dx, dy, dz, nx, ny, nz, dtype,
+                                        max_slab_bytes=2**25):
+
+    '''
+    Generates the integrated Green function in slabs of z planes, already
+    replicated in x and y. Yields (k0, k1, gint_slab), where gint_slab has
+    shape (2*nx, 2*ny, k1-k0) and contains the planes k0 to k1-1 of the
+    first nz+1 planes of the replicated Green function. Only a slab of the
+    primitive (instead of the full 3D meshgrid) is in memory at any time.
+    '''
+
+    # Grid for primitive function (kept 1D and broadcast)
+    xg_F = (np.arange(0, nx+2) * dx - dx/2)[:, None, None]
+    yg_F = (np.arange(0, ny+2) * dy - dy/2)[None, :, None]
+    zg_F = np.arange(0, nz+2) * dz - dz/2
+
+    n_planes = max(1, min(nz+1, max_slab_bytes // (8*(nx+2)*(ny+2))))
+
+    for k0 in range(0, nz+1, n_planes):
+        k1 = min(k0 + n_planes, nz+1)
+
+        # Compute primitive on planes k0 to k1 (included)
+        F_temp = primitive_func_3d(xg_F, yg_F, zg_F[None, None, k0:k1+1])
+
+        gint_slab = np.zeros((2*nx, 2*ny, k1-k0), dtype=dtype, order='F')
+        gint_slab[:nx+1, :ny+1, :] = (F_temp[ 1:,  1:,  1:]
+                                    - F_temp[:-1,  1:,  1:]
+                                    - F_temp[ 1:, :-1,  1:]
+                                    + F_temp[:-1, :-1,  1:]
+                                    - F_temp[ 1:,  1:, :-1]
+                                    + F_temp[:-1,  1:, :-1]
+                                    + F_temp[ 1:, :-1, :-1]
+                                    - F_temp[:-1, :-1, :-1])
+        del(F_temp)
+
+        # Replicate in x and y
+        # To define how to make the replicas I have a look at:
+        # np.abs(np.fft.fftfreq(10))*10
+        # = [0., 1., 2., 3., 4., 5., 4., 3., 2., 1.]
+        gint_slab[nx+1:, :ny+1, :] = gint_slab[nx-1:0:-1, :ny+1,     :]
+        gint_slab[:nx+1, ny+1:, :] = gint_slab[:nx+1,     ny-1:0:-1, :]
+        gint_slab[nx+1:, ny+1:, :] = gint_slab[nx-1:0:-1, ny-1:0:-1, :]
+
+        yield k0, k1, gint_slab
+
+def _integrated_green_function_3d(dx, dy, dz, nx, ny, nz, dtype):
+
+    # Integrated Green Function (filled in place slab by slab)
+    gint_rep= np.zeros((2*nx, 2*ny, 2*nz), dtype=dtype, order='F')
+    for k0, k1, gint_slab in _integrated_green_function_3d_slabs(
+                                        dx, dy, dz, nx, ny, nz, dtype=dtype):
+        gint_rep[:, :, k0:k1] = gint_slab
+
+    # Replicate in z
+    gint_rep[:, :, nz+1:] = gint_rep[:, :, nz-1:0:-1]
+
+    return gint_rep
+
+def _integrated_green_function_2p5d(dx, dy, nx, ny, dtype):
+
+    # Build grid for primitive function
+    xg_F = np.arange(0, nx+2) * dx - dx/2
+    yg_F = np.arange(0, ny+2) * dy - dy/2
+    XX_F, YY_F= np.meshgrid(xg_F, yg_F, indexing='ij')
+
+    # Compute primitive
+    F_temp = primitive_func_2p5d(XX_F, YY_F)
+
+    # Integrated Green Function
+    gint_rep= np.zeros((2*nx, 2*ny), dtype=dtype, order='F')
+    gint_rep[:nx+1, :ny+1] = (F_temp[ 1:,  1:]
+                            - F_temp[:-1,  1:]
+                            - F_temp[ 1:, :-1]
+                            + F_temp[:-1, :-1])
+
+    # Replicate
+    # To define how to make the replicas I have a look at:
+    # np.abs(np.fft.fftfreq(10))*10
+    # = [0., 1., 2., 3., 4., 5., 4., 3., 2., 1.]
+    gint_rep[nx+1:, :ny+1] = gint_rep[nx-1:0:-1, :ny+1]
+    gint_rep[:nx+1, ny+1:] = gint_rep[:nx+1, ny-1:0:-1]
+    gint_rep[nx+1:, ny+1:] = gint_rep[nx-1:0:-1, ny-1:0:-1]
+
+    return gint_rep
 
 def primitive_func_3d(x,y,z):
     abs_r = np.sqrt(x * x + y * y + z * z)
@@ -0,0 +1,110 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import os
+import hashlib
+import tempfile
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+
+class GreenFunctionCache:
+
+    '''
+    Cache of transformed integrated Green functions, keyed by solver type,
+    grid spacing, grid size and data type. Solvers sharing the same cache
+    and the same grid geometry load the transformed kernel instead of
+    recomputing it. On CPU contexts the solvers use the cached arrays
+    directly (no copy), hence they must not be modified.
+
+    Args:
+        max_entries (int): Maximum number of kernels kept in memory. When
+            the limit is exceeded the least recently used kernel is evicted.
+        cache_dir (str or Path): If provided, kernels are also stored in
+            this directory as ``.npy`` files and are loaded memory-mapped,
+            so that they can be reused by other processes.
+    Returns:
+        (GreenFunctionCache): Cache object.
+    '''
+
+    def __init__(self, max_entries=4, cache_dir=None):
+
+        self.max_entries = max_entries
+        if cache_dir is not None:
+            cache_dir = Path(cache_dir)
+            cache_dir.mkdir(parents=True, exist_ok=True)
+        self.cache_dir = cache_dir
+
+        self._entries = OrderedDict()
+        self.n_hits = 0
+        self.n_misses = 0
+
+    @staticmethod
+    def make_key(solver_type, dx, dy, dz, nx, ny, nz, dtype):
+        return (solver_type, float(dx), float(dy), float(dz),
+                int(nx), int(ny), int(nz), np.dtype(dtype).str)
+
+    def get(self, key, compute):
+
+        '''
+        Returns the kernel associated to the given key. If it is not found
+        in memory nor on disk, it is computed using the provided function.
+
+        Args:
+            key (tuple): Key generated by ``make_key``.
+            compute (callable): Function without arguments returning the
+                transformed Green function as a numpy array.
+        Returns:
+            (np.ndarray): The transformed Green function.
+        '''
+
+        if key in self._entries:
+            self.n_hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+        arr = self._load_from_disk(key)
+        if arr is None:
+            self.n_misses += 1
+            arr = compute()
+            self._save_to_disk(key, arr)
+        else:
+            self.n_hits += 1
+
+        self._entries[key] = arr
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+        return arr
+
+    def clear(self):
+        '''
+        Removes all kernels from memory (files on disk are kept).
+        '''
+        self._entries.clear()
+
+    def _filename(self, key):
+        hh = hashlib.sha1(repr(key).encode()).hexdigest()
+        return self.cache_dir.joinpath(f'{key[0]}_{hh}.npy')
+
+    def _load_from_disk(self, key):
+        if self.cache_dir is None:
+            return None
+        fname = self._filename(key)
+        if not fname.exists():
+            return None
+        return np.load(fname, mmap_mode='r')
+
+    def _save_to_disk(self, key, arr):
+        if self.cache_dir is None:
+            return
+        # Write to a temporary file and rename, so that other processes
+        # never see incomplete files
+        fd, tmpname = tempfile.mkstemp(dir=self.cache_dir, suffix='.npy')
+        with os.fdopen(fd, 'wb') as fid:
+            np.save(fid, arr)
+        os.replace(tmpname, self._filename(key))